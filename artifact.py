@@ -0,0 +1,194 @@
+from pathlib import Path
+import contextlib
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+
+
+# 成果物を保存するデフォルトのディレクトリ
+CACHE_DIR = Path.home() / ".cache" / "dolphin" / "artifacts"
+
+# キャッシュの合計サイズのデフォルトの上限 (MiB)
+CACHE_SIZE = 10 * 1024
+
+# キャッシュを操作する時のプロセス内のロック
+lock = threading.Lock()
+
+# このプロセスが使用中の成果物と、削除されないよう共有ロックを取ったファイル
+pinned = {}
+
+
+def fingerprint(local_path, kind, content=False):
+    """
+    ディレクトリの中身から成果物のキーを作成する
+    パス・サイズ・更新日時・パーミッション・シンボリックリンクの指す先を使用し、
+    content が True の場合はファイルの中身のハッシュ値も使用する
+    kind には圧縮方式など成果物の作り方を表す文字列を渡す
+    """
+
+    digest = hashlib.sha256()
+    digest.update(kind.encode())
+    digest.update(str(Path(local_path).resolve()).encode())
+
+    root = Path(local_path)
+    for p in [root] + sorted(root.rglob("*")):
+        st = p.lstat()
+        name = p.relative_to(root).as_posix()
+        digest.update("\0{}\0{}\0{}\0{}".format(name, st.st_size, st.st_mtime_ns, st.st_mode).encode())
+        if p.is_symlink():
+            digest.update(os.readlink(p).encode())
+        elif content and p.is_file():
+            with open(p, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def file_lock(cache_dir):
+    """
+    複数のプロセスから同時にキャッシュを操作しないようロックを取る
+    fcntl が使えない環境ではプロセス内のロックのみを使用する
+    """
+
+    with lock:
+        try:
+            import fcntl
+        except ImportError:
+            yield
+            return
+
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        with open(Path(cache_dir) / ".lock", "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def get(cache_dir, key, name, build, max_size=CACHE_SIZE):
+    """
+    キーに対応する成果物のパスを返す
+    キャッシュになければ build(出力先のパス) で作成してキャッシュに追加する
+    キャッシュの合計サイズが max_size (MiB) を超えた場合は使われていない順に削除する
+    """
+
+    cache_dir = Path(cache_dir).expanduser()
+    entry = cache_dir / key[:2] / key
+    output = entry / name
+
+    with file_lock(cache_dir):
+        if output.exists():
+            # 最後に使用した日時を更新する
+            os.utime(entry)
+            pin(entry)
+            return str(output)
+
+    # 作成中の成果物が使われないよう一時ディレクトリで作成してから移動する
+    work = cache_dir / "tmp" / uuid.uuid4().hex
+    work.mkdir(parents=True, exist_ok=True)
+    try:
+        build(str(work / name))
+        with file_lock(cache_dir):
+            if not output.exists():
+                entry.parent.mkdir(parents=True, exist_ok=True)
+                shutil.rmtree(entry, ignore_errors=True)
+                os.replace(work, entry)
+            os.utime(entry)
+            pin(entry)
+            evict(cache_dir, max_size)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    return str(output)
+
+
+def pin(entry):
+    """
+    成果物を使用中として、release するまで他の実行・プロセスの evict で削除されないようにする
+    file_lock の中で呼び出す
+    """
+
+    if entry in pinned:
+        return
+
+    f = None
+    try:
+        import fcntl
+        f = open(Path(entry) / ".pin", "a")
+        fcntl.flock(f, fcntl.LOCK_SH)
+    except ImportError:
+        pass
+
+    pinned[entry] = f
+
+
+def release():
+    """
+    このプロセスが使用中にした成果物を削除できるようにする
+    """
+
+    with lock:
+        for f in pinned.values():
+            if f != None:
+                f.close()
+        pinned.clear()
+
+
+def in_use(entry):
+    """
+    成果物がこのプロセス・他のプロセスで使用中かどうかを返す
+    使用中でない場合は、削除が終わるまで使用中にされないよう排他ロックを取ったファイルを返す
+    """
+
+    if entry in pinned:
+        return True, None
+
+    try:
+        import fcntl
+    except ImportError:
+        return False, None
+
+    f = open(entry / ".pin", "a")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return True, None
+
+    return False, f
+
+
+def evict(cache_dir, max_size):
+    """
+    キャッシュの合計サイズが max_size (MiB) 以下になるまで、使われていない成果物から削除する
+    実行中の転送が使用している成果物は削除しない
+    file_lock の中で呼び出す
+    """
+
+    entries = []
+    total = 0
+    for entry in Path(cache_dir).glob("??/*"):
+        if not entry.is_dir():
+            continue
+        size = sum(p.stat().st_size for p in entry.rglob("*") if p.is_file())
+        entries.append((entry.stat().st_mtime, size, entry))
+        total += size
+
+    limit = max_size * 1024 * 1024
+    for mtime, size, entry in sorted(entries, key=lambda e: e[0]):
+        if total <= limit:
+            break
+        busy, f = in_use(entry)
+        if busy:
+            continue
+        try:
+            shutil.rmtree(entry, ignore_errors=True)
+        finally:
+            if f != None:
+                f.close()
+        total -= size
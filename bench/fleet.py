@@ -0,0 +1,335 @@
+import ipaddress
+import os
+import socket
+import subprocess
+import threading
+import time
+import paramiko
+
+
+class Handle(paramiko.SFTPHandle):
+    """
+    ローカルのファイルを読み書きする SFTP のファイルハンドル
+    """
+
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+    def chattr(self, attr):
+        return paramiko.SFTP_OK
+
+
+class LocalSFTP(paramiko.SFTPServerInterface):
+    """
+    ホストごとのルートディレクトリを相対パスの起点とする SFTP サーバー
+    """
+
+    def __init__(self, server, *args, **kwargs):
+        self.root = server.root
+        super().__init__(server, *args, **kwargs)
+
+
+    def __path(self, path):
+        if path.startswith("/"):
+            return path
+        return os.path.join(self.root, path)
+
+
+    def canonicalize(self, path):
+        return os.path.normpath(self.__path(path))
+
+
+    def list_folder(self, path):
+        try:
+            folder = self.__path(path)
+            result = []
+            for name in os.listdir(folder):
+                attr = paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(folder, name)))
+                attr.filename = name
+                result.append(attr)
+            return result
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self.__path(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+    def lstat(self, path):
+        return self.stat(path)
+
+
+    def open(self, path, flags, attr):
+        path = self.__path(path)
+        try:
+            fd = os.open(path, flags, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "r+b"
+        else:
+            mode = "rb"
+
+        f = os.fdopen(fd, mode)
+        handle = Handle(flags)
+        handle.filename = path
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+
+    def remove(self, path):
+        os.remove(self.__path(path))
+        return paramiko.SFTP_OK
+
+
+    def rename(self, oldpath, newpath):
+        os.rename(self.__path(oldpath), self.__path(newpath))
+        return paramiko.SFTP_OK
+
+
+    def posix_rename(self, oldpath, newpath):
+        return self.rename(oldpath, newpath)
+
+
+    def mkdir(self, path, attr):
+        os.mkdir(self.__path(path))
+        return paramiko.SFTP_OK
+
+
+    def rmdir(self, path):
+        os.rmdir(self.__path(path))
+        return paramiko.SFTP_OK
+
+
+    def chattr(self, path, attr):
+        return paramiko.SFTP_OK
+
+
+class SFTPServer(paramiko.SFTPServer):
+    """
+    終了時に終了コードを返す SFTP サブシステム
+    """
+
+    def finish_subsystem(self):
+        try:
+            self.sock.send_exit_status(0)
+        except Exception:
+            pass
+        super().finish_subsystem()
+
+
+class Server(paramiko.ServerInterface):
+    """
+    全ての認証を受け入れ、コマンドをローカルの sh で実行する SSH サーバー
+    踏み台として使用できるよう direct-tcpip の転送にも対応する
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.forward = {}
+
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+
+    def get_allowed_auths(self, username):
+        return "password,publickey"
+
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        self.forward[chanid] = destination
+        return paramiko.OPEN_SUCCEEDED
+
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+
+    def check_channel_env_request(self, *args):
+        return True
+
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=execute, args=(channel, command.decode(), self.root),
+                         daemon=True).start()
+        return True
+
+
+    def check_channel_shell_request(self, channel):
+        threading.Thread(target=execute, args=(channel, "exec sh", self.root),
+                         daemon=True).start()
+        return True
+
+
+class Fleet():
+    """
+    ループバックアドレス上に SSH サーバーを複数起動する、ベンチマーク用のターゲットマシンの代わり
+    サーバーごとに別のアドレスを使用し、ホストごとのルートディレクトリで実行する
+    """
+
+    def __init__(self, root, port=22220, address="127.0.1.1"):
+        """
+        Fleet クラス コンストラクタ
+        root の下にホストごとのディレクトリを作成する
+        """
+        self.root = root
+        self.port = port
+        self.address = ipaddress.IPv4Address(address)
+        self.hosts = []
+        self.__sockets = []
+        self.__key = paramiko.RSAKey.generate(2048)
+
+
+    def start(self, count):
+        """
+        SSH サーバーを count 台起動し、ホストのアドレスの一覧を返す
+        """
+
+        hosts = []
+        for _ in range(count):
+            host = str(self.address + len(self.hosts))
+            root = os.path.join(self.root, host)
+            os.makedirs(root, exist_ok=True)
+
+            listener = socket.socket()
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((host, self.port))
+            listener.listen(128)
+            self.__sockets.append(listener)
+
+            threading.Thread(target=self.__accept, args=(listener, root), daemon=True).start()
+            self.hosts.append(host)
+            hosts.append(host)
+
+        return hosts
+
+
+    def stop(self):
+        """
+        全ての SSH サーバーの待ち受けを終了する
+        """
+
+        for listener in self.__sockets:
+            try:
+                listener.close()
+            except Exception:
+                pass
+        self.__sockets = []
+
+
+    def __accept(self, listener, root):
+        while True:
+            try:
+                sock, _ = listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.__handle, args=(sock, root), daemon=True).start()
+
+
+    def __handle(self, sock, root):
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(self.__key)
+        transport.set_subsystem_handler("sftp", SFTPServer, LocalSFTP)
+        server = Server(root)
+        try:
+            transport.start_server(server=server)
+        except Exception:
+            return
+
+        channels = []
+        while transport.is_active():
+            channel = transport.accept(1)
+            if channel == None:
+                channels = [c for c in channels if not c.closed]
+                continue
+            channels.append(channel)
+            if channel.get_id() in server.forward:
+                destination = server.forward.pop(channel.get_id())
+                threading.Thread(target=forward, args=(channel, destination),
+                                 daemon=True).start()
+
+
+def execute(channel, command, root):
+    """
+    コマンドをホストのルートディレクトリで実行し、入出力をチャンネルと中継する
+    """
+
+    env = dict(os.environ, HOME=root)
+    process = subprocess.Popen(["sh", "-c", command], cwd=root, env=env,
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE
+                              )
+
+    def stdin():
+        try:
+            for data in iter(lambda: channel.recv(32768), b""):
+                process.stdin.write(data)
+                process.stdin.flush()
+        except Exception:
+            pass
+        try:
+            process.stdin.close()
+        except Exception:
+            pass
+
+    def stderr():
+        for data in iter(lambda: process.stderr.read1(32768), b""):
+            channel.sendall_stderr(data)
+
+    threading.Thread(target=stdin, daemon=True).start()
+    err = threading.Thread(target=stderr, daemon=True)
+    err.start()
+
+    for data in iter(lambda: process.stdout.read1(32768), b""):
+        channel.sendall(data)
+
+    err.join()
+    channel.send_exit_status(process.wait())
+    time.sleep(0.01)
+    channel.close()
+
+
+def forward(channel, destination):
+    """
+    踏み台として受けた転送をローカルの接続先と中継する
+    """
+
+    sock = socket.create_connection(destination)
+
+    def upstream():
+        try:
+            for data in iter(lambda: channel.recv(32768), b""):
+                sock.sendall(data)
+        except Exception:
+            pass
+        try:
+            sock.shutdown(socket.SHUT_WR)
+        except Exception:
+            pass
+
+    threading.Thread(target=upstream, daemon=True).start()
+    try:
+        for data in iter(lambda: sock.recv(32768), b""):
+            channel.sendall(data)
+    except Exception:
+        pass
+    channel.close()
@@ -0,0 +1,80 @@
+from pathlib import Path
+import os
+import toml
+
+
+# ベンチマークの接続に使用するユーザ名・パスワード
+USER = "bench"
+PASSWORD = "bench"
+
+
+def make_file(path, size):
+    """
+    size bytes のランダムな内容のファイルを作成する
+    """
+
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as f:
+        rest = size
+        while rest > 0:
+            chunk = min(rest, 1024 * 1024)
+            f.write(os.urandom(chunk))
+            rest -= chunk
+
+    return str(path)
+
+
+def make_tree(path, files, depth, size):
+    """
+    depth 段の階層に files 個のファイルを持つディレクトリを作成する
+    各ファイルの大きさは size bytes になる
+    """
+
+    root = Path(path)
+    root.mkdir(parents=True, exist_ok=True)
+    for index in range(files):
+        directory = root
+        for level in range(depth):
+            directory = directory / "d{}-{}".format(level, index % (level + 2))
+        make_file(directory / "f{}.bin".format(index), size)
+
+    return str(root)
+
+
+def generate(path, hosts, port, files=[], commands=1, proxies=[], fail=False, remote="dest"):
+    """
+    hosts に files を転送し、commands 個のコマンドを実行する TOML ファイルを path に作成する
+    proxies が指定された場合は順番に経由する踏み台とする
+    fail が True の場合は最後に失敗するコマンドを実行する
+    """
+
+    command = ["mkdir -p {}".format(remote)]
+    command += ["echo {} > /dev/null".format(index) for index in range(commands)]
+    if fail:
+        command.append("false")
+    rollback = ["rm -rf {}".format(remote)]
+
+    data = {}
+    if len(files) > 0:
+        data["file"] = [{"path": f, "to": remote} for f in files]
+    if len(proxies) > 0:
+        data["proxy"] = [{
+            "host": host,
+            "port": str(port),
+            "user": USER,
+            "password": PASSWORD
+        } for host in proxies]
+    data["target"] = [{
+        "host": host,
+        "port": str(port),
+        "user": USER,
+        "password": PASSWORD,
+        "command": command,
+        "rollback": rollback
+    } for host in hosts]
+
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        toml.dump(data, f)
+
+    return str(path)
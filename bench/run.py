@@ -0,0 +1,261 @@
+#! python3
+
+
+from pathlib import Path
+import json
+import os
+import shlex
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import fleet
+import playbook
+
+
+# dolphin.py の場所
+DOLPHIN = Path(__file__).resolve().parent.parent / "dolphin.py"
+
+# 結果を保存するデフォルトのファイル
+RESULTS = Path(__file__).resolve().parent / "results" / "history.jsonl"
+
+# 計測できるシナリオ
+SCENARIOS = ["sequential", "parallel", "transfer", "rollback", "failback"]
+
+
+def arg():
+    """
+    コマンド引数の読み込み
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Dolphin benchmark with a local SSH fleet")
+    parser.add_argument("--hosts", help="number of target hosts (default is 10)",
+                        type=int, default=10)
+    parser.add_argument("--proxies", help="number of chained proxy hops (default is 0)",
+                        type=int, default=0)
+    parser.add_argument("--file-size", help="size of the single file in KiB (default is 1024)",
+                        type=int, default=1024)
+    parser.add_argument("--dir-files", help="number of files in the directory (default is 100)",
+                        type=int, default=100)
+    parser.add_argument("--dir-depth", help="depth of the directory tree (default is 2)",
+                        type=int, default=2)
+    parser.add_argument("--dir-file-size", help="size of each directory file in KiB (default is 16)",
+                        type=int, default=16)
+    parser.add_argument("--commands", help="number of commands per target (default is 5)",
+                        type=int, default=5)
+    parser.add_argument("--repeat", help="number of runs per scenario (default is 3)",
+                        type=int, default=3)
+    parser.add_argument("--scenario", help="scenario to run (default is all)",
+                        choices=SCENARIOS, action="append")
+    parser.add_argument("--dolphin-args", help="extra arguments passed to dolphin (must be the last option)",
+                        nargs=argparse.REMAINDER, default=[])
+    parser.add_argument("--port", help="port of the local SSH servers (default is 22220)",
+                        type=int, default=22220)
+    parser.add_argument("--address", help="first loopback address of the fleet (default is 127.0.1.1)",
+                        default="127.0.1.1")
+    parser.add_argument("--results", help="file the results are appended to",
+                        default=str(RESULTS))
+    parser.add_argument("--threshold", help="percent slower than the last result to report as a regression (default is 10)",
+                        type=float, default=10)
+    parser.add_argument("--fail-on-regression", help="exit with 1 if a regression is found",
+                        action="store_true")
+    args = parser.parse_args()
+
+    return args
+
+
+def scenario_args(scenario):
+    """
+    シナリオごとの dolphin の引数と、失敗するコマンドを含めるかどうかを返す
+    """
+
+    if scenario == "sequential":
+        return [], False
+    if scenario == "parallel":
+        return ["--parallel"], False
+    if scenario == "transfer":
+        return ["--parallel"], False
+    if scenario == "rollback":
+        return ["--parallel", "--rollback"], False
+    if scenario == "failback":
+        return ["--parallel", "--failback"], True
+
+    raise ValueError(scenario)
+
+
+def reset(hosts, root, remote="dest"):
+    """
+    ターゲットの転送先のディレクトリを空にする
+    """
+
+    for host in hosts:
+        path = Path(root) / host / remote
+        shutil.rmtree(path, ignore_errors=True)
+        path.mkdir(parents=True)
+
+
+def run(path, options, metrics_path):
+    """
+    dolphin を一回実行し、かかった時間(秒)と集計結果を返す
+    """
+
+    # 前回の実行で記録したフィンガープリントで省略されないよう、毎回全ターゲットを実行する
+    command = [sys.executable, str(DOLPHIN), path, "--no-enter", "--force",
+               "--metrics-json", metrics_path] + options
+
+    start = time.monotonic()
+    completed = subprocess.run(command, stdin=subprocess.DEVNULL,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    elapsed = time.monotonic() - start
+
+    if completed.returncode != 0:
+        raise RuntimeError("dolphin failed: {}".format(completed.stderr.decode(errors="replace")))
+
+    with open(metrics_path, encoding="utf-8") as f:
+        summary = json.load(f)
+
+    return elapsed, summary
+
+
+def commit():
+    """
+    計測したリポジトリのコミットを返す
+    """
+
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              cwd=DOLPHIN.parent, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(results, entry, threshold):
+    """
+    同じ条件の前回の結果と比較し、threshold % 以上遅くなったシナリオの一覧を返す
+    """
+
+    previous = None
+    path = Path(results)
+    if path.exists():
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                data = json.loads(line)
+                if data["params"] == entry["params"]:
+                    previous = data
+
+    if previous == None:
+        print("no previous result with the same parameters")
+        return []
+
+    print("compared with {} ({})".format(previous["commit"], previous["time"]))
+
+    regressions = []
+    for scenario, data in entry["scenarios"].items():
+        if not scenario in previous["scenarios"]:
+            continue
+        before = previous["scenarios"][scenario]["median"]
+        after = data["median"]
+        change = (after - before) / before * 100 if before > 0 else 0
+        mark = ""
+        if change >= threshold:
+            mark = " \033[31mREGRESSION\033[0m"
+            regressions.append(scenario)
+        print("  {:<12} {:8.3f}s -> {:8.3f}s ({:+.1f}%){}".format(
+            scenario, before, after, change, mark))
+
+    return regressions
+
+
+def main():
+    """
+    メイン関数
+    """
+
+    args = arg()
+    scenarios = args.scenario if args.scenario != None else SCENARIOS
+    # 残りの引数は全て dolphin に渡す
+    options = args.dolphin_args
+
+    work = tempfile.mkdtemp(prefix="dolphin-bench-")
+    try:
+        # ターゲット・踏み台の SSH サーバーを起動する
+        servers = fleet.Fleet(os.path.join(work, "fleet"), args.port, args.address)
+        hosts = servers.start(args.hosts)
+        proxies = servers.start(args.proxies)
+
+        # 転送するファイルを作成する
+        local = Path(work) / "local"
+        files = [
+            playbook.make_file(local / "file.bin", args.file_size * 1024),
+            playbook.make_tree(local / "tree", args.dir_files, args.dir_depth,
+                               args.dir_file_size * 1024)
+        ]
+
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": commit(),
+            "params": {
+                "hosts": args.hosts,
+                "proxies": args.proxies,
+                "file_size": args.file_size,
+                "dir_files": args.dir_files,
+                "dir_depth": args.dir_depth,
+                "dir_file_size": args.dir_file_size,
+                "commands": args.commands,
+                "dolphin_args": shlex.join(options)
+            },
+            "scenarios": {}
+        }
+
+        for scenario in scenarios:
+            extra, fail = scenario_args(scenario)
+            path = playbook.generate(Path(work) / "{}.toml".format(scenario),
+                                     hosts, args.port,
+                                     files=files if scenario != "rollback" else [],
+                                     commands=args.commands if scenario != "transfer" else 0,
+                                     proxies=proxies,
+                                     fail=fail)
+
+            times = []
+            phases = None
+            for number in range(args.repeat):
+                reset(hosts, servers.root)
+                elapsed, summary = run(path, extra + options,
+                                       os.path.join(work, "metrics.json"))
+                times.append(elapsed)
+                phases = summary["phases"]
+                print("[{}] run {}: {:.3f}s".format(scenario, number + 1, elapsed))
+
+            entry["scenarios"][scenario] = {
+                "median": statistics.median(times),
+                "min": min(times),
+                "max": max(times),
+                "runs": times,
+                "phases": phases
+            }
+
+        regressions = compare(args.results, entry, args.threshold)
+
+        # 結果を追記する
+        Path(args.results).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.results, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+        print("results appended to {}".format(args.results))
+
+        servers.stop()
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    if args.fail_on_regression and len(regressions) > 0:
+        exit(code=1)
+
+
+if __name__ == "__main__":
+    """
+    このファイルが実行された場合に main 関数を実行する
+    """
+    main()
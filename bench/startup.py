@@ -0,0 +1,149 @@
+#! python3
+
+
+from pathlib import Path
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import run
+
+
+# 結果を保存するデフォルトのファイル
+RESULTS = Path(__file__).resolve().parent / "results" / "startup.jsonl"
+
+
+def arg():
+    """
+    コマンド引数の読み込み
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Dolphin startup time benchmark")
+    parser.add_argument("--binary", help="also measure this frozen binary (e.g. dist/dolphin)")
+    parser.add_argument("--repeat", help="number of runs per case (default is 10)",
+                        type=int, default=10)
+    parser.add_argument("--importtime", help="show the slowest imports of dolphin.py --help",
+                        action="store_true")
+    parser.add_argument("--results", help="file the results are appended to",
+                        default=str(RESULTS))
+    parser.add_argument("--threshold", help="percent slower than the last result to report as a regression (default is 10)",
+                        type=float, default=10)
+    parser.add_argument("--fail-on-regression", help="exit with 1 if a regression is found",
+                        action="store_true")
+    args = parser.parse_args()
+
+    return args
+
+
+def measure(command, repeat):
+    """
+    コマンドを repeat 回実行し、かかった時間(秒)の一覧を返す
+    終了コードは問わない
+    """
+
+    times = []
+    for _ in range(repeat):
+        start = time.monotonic()
+        subprocess.run(command, stdin=subprocess.DEVNULL,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.monotonic() - start)
+
+    return times
+
+
+def importtime(command):
+    """
+    -X importtime の結果から、読み込みに時間のかかったモジュールを表示する
+    """
+
+    completed = subprocess.run([sys.executable, "-X", "importtime"] + command,
+                               stdin=subprocess.DEVNULL, capture_output=True, text=True)
+
+    modules = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # 他のモジュールから読み込まれたものは除き、最上位のモジュールのみを表示する
+        if name.startswith("  "):
+            continue
+        modules.append((int(cumulative), name.strip()))
+
+    for cumulative, name in sorted(modules, reverse=True)[:10]:
+        print("  {:>8.1f} ms  {}".format(cumulative / 1000, name))
+
+
+def main():
+    """
+    メイン関数
+    """
+
+    args = arg()
+
+    work = tempfile.mkdtemp(prefix="dolphin-startup-")
+    try:
+        # 読み込みに失敗する TOML ファイル
+        invalid = os.path.join(work, "invalid.toml")
+        with open(invalid, "w", encoding="utf-8") as f:
+            f.write("[[target]\nhost = \n")
+
+        cases = {
+            "help": ["--help"],
+            "invalid-toml": [invalid, "--no-enter"]
+        }
+
+        programs = {"source": [sys.executable, str(run.DOLPHIN)]}
+        if args.binary != None:
+            programs["binary"] = [str(Path(args.binary).resolve())]
+
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": run.commit(),
+            "params": {
+                "python": sys.version.split()[0],
+                "binary": args.binary
+            },
+            "scenarios": {}
+        }
+
+        for program, command in programs.items():
+            for case, options in cases.items():
+                times = measure(command + options, args.repeat)
+                name = "{}-{}".format(program, case)
+                entry["scenarios"][name] = {
+                    "median": statistics.median(times),
+                    "min": min(times),
+                    "max": max(times),
+                    "runs": times
+                }
+                print("[{}] median {:.3f}s (min {:.3f}s, max {:.3f}s)".format(
+                    name, statistics.median(times), min(times), max(times)))
+
+        if args.importtime:
+            print("slowest imports of dolphin.py --help:")
+            importtime([str(run.DOLPHIN), "--help"])
+
+        regressions = run.compare(args.results, entry, args.threshold)
+
+        # 結果を追記する
+        Path(args.results).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.results, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+        print("results appended to {}".format(args.results))
+    finally:
+        import shutil
+        shutil.rmtree(work, ignore_errors=True)
+
+    if args.fail_on_regression and len(regressions) > 0:
+        exit(code=1)
+
+
+if __name__ == "__main__":
+    """
+    このファイルが実行された場合に main 関数を実行する
+    """
+    main()
@@ -0,0 +1,189 @@
+from pathlib import Path
+import collections
+import fabric
+import functools
+import threading
+
+
+# メモリに保持する出力の末尾のデフォルトの文字数
+TAIL_SIZE = 64 * 1024
+
+# ログファイルに書き込む時のロック
+lock = threading.Lock()
+
+
+class Tail():
+    """
+    末尾の max_size 文字のみを保持するバッファ
+    invoke の出力のバッファと同じく append で追加し、"".join で連結できる
+    """
+
+    def __init__(self, max_size=TAIL_SIZE):
+        """
+        Tail クラス コンストラクタ
+        """
+        self.__max_size = max_size
+        self.__size = 0
+        self.__buffer = collections.deque()
+
+
+    def append(self, data):
+        """
+        末尾に追加し、max_size を超えた分を先頭から捨てる
+        """
+
+        self.__buffer.append(data)
+        self.__size += len(data)
+
+        while self.__size > self.__max_size and len(self.__buffer) > 1:
+            self.__size -= len(self.__buffer.popleft())
+
+        if self.__size > self.__max_size:
+            # 一度に max_size を超える出力があった場合はその末尾のみを残す
+            self.__buffer[0] = tail(self.__buffer[0], self.__max_size)
+            self.__size = len(self.__buffer[0])
+
+
+    def __iter__(self):
+        return iter(self.__buffer)
+
+
+class Log():
+    """
+    コマンドの出力をファイルに書き出し、echo が指定されていればそちらにも書き出すストリーム
+    """
+
+    def __init__(self, file, echo=None, tail=TAIL_SIZE):
+        """
+        Log クラス コンストラクタ
+        """
+        self.__file = file
+        self.__echo = echo
+        self.tail = tail
+
+
+    def write(self, data):
+        with lock:
+            self.__file.write(data)
+        if self.__echo != None:
+            self.__echo.write(data)
+
+
+    def flush(self):
+        with lock:
+            self.__file.flush()
+        if self.__echo != None:
+            self.__echo.flush()
+
+
+class Remote(fabric.runners.Remote):
+    """
+    出力先が Log の場合に、実行結果に出力の末尾のみを保持するランナー
+    それ以外の場合は fabric のランナーと同じく全ての出力を保持する
+    """
+
+    def _handle_output(self, buffer_, hide, output, reader):
+        if not isinstance(output, Log):
+            return super()._handle_output(buffer_, hide, output, reader)
+
+        tail = Tail(output.tail)
+        super()._handle_output(tail, hide, output, reader)
+        buffer_.extend(tail)
+
+
+class Capture():
+    """
+    コマンドの出力をホストごとのログファイルに書き出し、実行結果には末尾のみを残す
+    実行結果の log 属性にログファイルのパスを設定する
+    """
+
+    def __init__(self, run, path, tail=TAIL_SIZE):
+        """
+        Capture クラス コンストラクタ
+        run には connect.run または Session.run を渡す
+        """
+        self.__run = run
+        self.__tail = tail
+        self.path = str(path)
+
+
+    def __call__(self, command, **kwargs):
+        """
+        run と同じくコマンドを実行し、実行結果を返す
+        """
+
+        import invoke
+
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+
+        run = self.__run
+        connect = getattr(self.__run, "__self__", None)
+        if isinstance(connect, fabric.Connection):
+            # 出力の末尾のみを保持するランナーをこの実行にのみ使用する
+            # 共有している接続の設定は変更しない
+            run = functools.partial(self.__remote_run, connect)
+
+        with open(self.path, "a", encoding="utf-8", errors="replace") as f:
+            with lock:
+                f.write("$ {}\n".format(command))
+            # 出力はログファイルにのみ書き出し、標準出力・標準エラー出力には表示しない
+            out_stream = Log(f, None, self.__tail)
+            err_stream = Log(f, None, self.__tail)
+            try:
+                result = run(command, out_stream=out_stream, err_stream=err_stream, **kwargs)
+            except invoke.exceptions.UnexpectedExit as e:
+                self.__truncate(e.result)
+                raise e
+
+        return self.__truncate(result)
+
+
+    def __remote_run(self, connect, command, **kwargs):
+        """
+        fabric の Connection.run と同じくコマンドを実行する
+        ランナーには設定の代わりに出力の末尾のみを保持する Remote を使用する
+        """
+
+        connect.open()
+        runner = Remote(context=connect, inline_env=connect.inline_ssh_env)
+        return connect._run(runner, command, **kwargs)
+
+
+    def spill(self, result):
+        """
+        出力を保持した実行結果をログファイルに書き出し、末尾のみを残す
+        fabric 以外で実行したコマンドの実行結果に使用する
+        """
+
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+
+        with lock:
+            with open(self.path, "a", encoding="utf-8", errors="replace") as f:
+                f.write("$ {}\n".format(result.command))
+                f.write(result.stdout)
+                f.write(result.stderr)
+
+        return self.__truncate(result)
+
+
+    def __truncate(self, result):
+        """
+        実行結果の出力を末尾のみにし、ログファイルのパスを設定する
+        """
+
+        result.stdout = tail(result.stdout, self.__tail)
+        result.stderr = tail(result.stderr, self.__tail)
+        result.log = self.path
+
+        return result
+
+
+def tail(text, size):
+    """
+    文字列の末尾の size 文字を返す
+    """
+
+    if size <= 0:
+        return ""
+
+    return text[-size:]
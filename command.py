@@ -1,14 +1,185 @@
 
 
 import fabric
-from fabric import Connection
 from fabric.transfer import Transfer
 from pathlib import Path
 from getpass import getpass
-from concurrent.futures import ThreadPoolExecutor
-import paramiko
+from concurrent.futures import Future, ThreadPoolExecutor
+import copy
+import functools
+import hashlib
+import shlex
 import shutil
 import tempfile
+import threading
+import artifact
+import capture
+import compress
+import connection
+import event
+import fingerprint
+import inventory
+import metrics
+import mirror
+import prepare
+import session
+
+
+# incremental で転送したコミットを記録する送信先のファイル
+COMMIT_MARKER = ".dolphin-commit"
+
+# incremental で削除されたファイルの一覧を送るファイル
+DELETED_LIST = ".dolphin-deleted"
+
+
+class Cancelled(Exception):
+    """
+    実行されなかったターゲットの実行結果
+    """
+    pass
+
+
+class FailureLimit():
+    """
+    失敗したターゲットの数が上限を超えた場合に、残りのターゲットの実行を取り消す
+    manager が指定された場合は、失敗の数と取り消しをワーカープロセスと共有する
+    """
+
+    def __init__(self, limit, manager=None):
+        """
+        FailureLimit クラス コンストラクタ
+        """
+        self.limit = limit
+        if manager == None:
+            self.__event = threading.Event()
+            self.__lock = threading.Lock()
+            self.__failed = [0]
+        else:
+            self.__event = manager.Event()
+            self.__lock = manager.Lock()
+            self.__failed = manager.list([0])
+
+
+    def fail(self, host, error):
+        """
+        ターゲットの失敗を数え、上限を超えた場合は残りのターゲットの実行を取り消す
+        取り消されたターゲットは失敗として数えない
+        """
+
+        if isinstance(error, Cancelled):
+            return
+
+        with self.__lock:
+            self.__failed[0] += 1
+            failed = self.__failed[0]
+
+        if failed > self.limit and not self.__event.is_set():
+            self.__event.set()
+            print("\033[31m[{}] {} targets failed (max fail {}), cancelling the rest\033[0m".format(
+                host, failed, self.limit))
+
+
+    def cancelled(self):
+        """
+        実行が取り消されたかどうかを返す
+        """
+        return self.__event.is_set()
+
+
+    def check(self):
+        """
+        実行が取り消されていれば Cancelled を送出する
+        """
+
+        if self.__event.is_set():
+            raise Cancelled("cancelled by max fail")
+
+
+class Step():
+    """
+    全ターゲットに共通するコマンドプールの要素
+    ターゲットごとのコマンドプールの要素は保存せず、参照する度に bind で作成する
+    """
+
+    def __init__(self, bind):
+        """
+        Step クラス コンストラクタ
+        bind には (ターゲットの番号, ターゲット) を受け取り、コマンドプールの要素の一覧を返す関数を渡す
+        """
+        self.bind = bind
+
+
+class HostPool():
+    """
+    一つのターゲットのコマンドプール
+    要素は Step から参照する度に作成する
+    rollback の場合は target のコマンドのみを返す
+    """
+
+    def __init__(self, steps, index, target, rollback=False):
+        """
+        HostPool クラス コンストラクタ
+        """
+        self.__steps = steps
+        self.__index = index
+        self.__target = target
+        self.__rollback = rollback
+
+
+    def __iter__(self):
+        for step in self.__steps:
+            if not isinstance(step, Step):
+                continue
+            for pool in step.bind(self.__index, self.__target):
+                if self.__rollback and not "target" in pool["type"]:
+                    continue
+                yield pool
+
+
+    def __len__(self):
+        return sum(1 for pool in self)
+
+
+    def __getitem__(self, index):
+        return list(self)[index]
+
+
+def run_shard(name, data, option, rollback, limit=None, prepared=None):
+    """
+    プロセスプールのワーカーで実行する関数
+    ワーカー側で Command を構築し、担当するターゲットのキューを実行した結果と
+    ワーカーで記録した実行時間・転送量を返す
+    limit には親プロセスと共有する FailureLimit を渡す
+    prepared には親プロセスで準備した転送するファイルを渡し、ワーカーでは準備をやり直さない
+    """
+
+    prepare.executor.set_max_workers(getattr(option, "prepare_workers", None))
+    if getattr(option, "events", None) != None:
+        event.writer.open(getattr(option, "events_file", None))
+    if getattr(option, "metrics_json", None) != None or getattr(option, "metrics_prom", None) != None:
+        metrics.recorder.enable()
+
+    try:
+        command = Command(name, data, option, prepared)
+        return command.run_shard(rollback, limit), metrics.recorder.samples()
+    finally:
+        # ワーカーが作成した接続はワーカーで閉じる
+        connection.pool.close()
+        event.writer.close()
+        artifact.release()
+
+
+def measured(fn):
+    """
+    Command の実行メソッドにかかった時間を TOML ファイル全体の実行時間として記録する
+    """
+
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        with metrics.recorder.measure(fn.__name__, None, self.name):
+            return fn(self, *args, **kwargs)
+
+    return wrapper
 
 
 class Command():
@@ -16,16 +187,54 @@ class Command():
     コマンド解析・構築・実行クラス
     """
     
-    def __init__(self, name, data):
+    def __init__(self, name, data, option=None, prepared=None):
         """
         Command クラス コンストラクタ
+        prepared にはプロセスプールのワーカーで、親プロセスで準備した転送するファイルを渡す
         """
         self.__command_pool = []  # 構築したコマンドプールの保存
         self.__command_result = [] # コマンドプールの実行結果
         self.__target_list = []   # ターゲットの一覧
+        self.__entry = {}         # ホストごとのワーカーに渡すターゲットの設定
+        self.__target = {}        # ホストごとの (ターゲットの番号, ターゲット)
+        self.__connection = {}    # ホストごとの接続
+        self.__session = {}       # ホストごとのリモートシェルのセッション
+        self.__failback = set()   # failback で rollback 済みのターゲット
+        self.__limit = None       # 並列実行中の失敗したターゲットの数の上限
         self.__worker_dir = tempfile.TemporaryDirectory() # 作業用一時ディレクトリ
+        self.__prepared = prepared # 親プロセスで準備した転送するファイル
+        self.__futures = []       # 転送するファイルの準備の Future (ワーカーでは準備の結果)
+        self.__prepare_dir = self.__worker_dir.name # 転送するファイルを準備するディレクトリ
+        self.__archive = {}       # 圧縮方式ごとに作成した tar のパス
+        self.__archive_lock = threading.Lock()
+        self.__archive_key_lock = {} # 圧縮方式ごとの tar の作成用のロック
+        self.__incremental = {}   # 送信先のコミットごとに作成した差分の tar のパス
+        self.__incremental_lock = threading.Lock()
+        self.__remote_codec = {}  # ターゲットで使用できる展開コマンド
+        self.__throughput = {}    # 踏み台の経路ごとの回線速度
+        self.__throughput_lock = threading.Lock()
+        self.__throughput_key_lock = {} # 踏み台の経路ごとの回線速度の計測用のロック
+        self.__relay_probe = None # ターゲット間で中継できるかどうかの確認結果
+        self.__relay_probe_lock = threading.Lock()
+        self.__resolved = copy.deepcopy(data) # 入力されたユーザ名・パスワードを反映したデータ
         self.name = name
         self.data = data
+        self.option = option      # コマンドライン引数
+        # ターゲットごとのデプロイ内容のフィンガープリント
+        # rollback の場合は記録しないため、転送するファイルのキーを先に計算しない
+        self.__fingerprint = fingerprint.Fingerprint(name,
+                                                     getattr(option, "force", False),
+                                                     not getattr(option, "rollback", False) and prepared == None,
+                                                     getattr(option, "artifact_hash", False))
+
+        # ワーカーでは親プロセスが準備したファイル・圧縮した tar・フィンガープリントを使用する
+        if prepared != None:
+            self.__prepare_dir = prepared["worker_dir"]
+            self.__archive = dict(prepared["archive"])
+            self.__throughput = dict(prepared["throughput"])
+            self.__relay_probe = prepared["relay"]
+            self.__fingerprint.preset(prepared["fingerprint"])
+
         self.generate_command_pool()
 
 
@@ -36,6 +245,7 @@ class Command():
         return self.__command_result.copy()
 
 
+    @measured
     def run(self):
         """
         構築したコマンドの実行
@@ -48,322 +258,1822 @@ class Command():
         if len(self.__command_pool) <= 0:
             return []
 
+        # 事前の接続に失敗したターゲットは失敗として記録し、他のターゲットの実行を続ける
+        unreachable = set()
+        for host in self.hosts():
+            failed = connection.pool.failed(self.__target[host][1]["target"])
+            if failed != None:
+                unreachable.add(host)
+                self.__command_result.append({host: failed})
+
+        # 前回と同じ内容をデプロイ済みのターゲットは実行しない
+        skipped = set(host for host in self.hosts() if not host in unreachable and self.__deployed(host))
+        for host in skipped:
+            self.__command_result.append({host: self.__skip(host)})
+
         # 構築したコマンドの実行
-        for pool in self.__command_pool:
-            try:
-                if "target" in pool["type"]:
-                    command = pool["run"]
-                    arg = pool["command"]
-                    # command が存在すれば実行する
-                    if arg != None:
+        try:
+            for pool in self.__pools():
+                if "target" in pool and (pool["target"] in skipped or pool["target"] in unreachable):
+                    self.__release_relay([pool])
+                    continue
+                try:
+                    for result in self.__execute_command(pool):
                         host = pool["target"]
-                        result = command(arg, pty=True)
                         self.__command_result.append({host: result})
+                except invoke.exceptions.UnexpectedExit as e:
+                    self.__command_result.append({pool["target"]: e})
+                    raise e
 
-                elif "proxy" in pool["type"]:
-                    pass
+            # 全ての実行に成功したターゲットにフィンガープリントを記録する
+            for host in self.hosts():
+                if not host in skipped and not host in unreachable:
+                    self.__save_fingerprint(host)
+        finally:
+            self.__close_session()
+
+        # 各コマンドの実行結果を返す
+        return self.__command_result.copy()
+
+
+    def __parallel_command_runner(self, command_result, command_pool):
+        """
+        コマンドを逐次実行するためのコマンドランナー
+        """
+
+        try:
+            for pool in command_pool:
+                # 失敗したターゲットの数が上限を超えた場合、実行中のコマンドの後で止める
+                if self.__limit != None:
+                    self.__limit.check()
+                command_result.extend(self.__execute_command(pool))
+        finally:
+            self.__close_session([pool["target"] for pool in command_pool])
+
+
+    def __execute_command(self, pool):
+        """
+        コマンドプールの要素を一つ実行し、実行結果の一覧を返す
+        実行の開始・終了・失敗をイベントとして書き出す
+        """
+
+        # 実行するものがない要素はイベントを書き出さない
+        if not "target" in pool or ("target" in pool["type"] and pool["command"] == None):
+            return self.__execute_step(pool)
+
+        return self.__record(pool, False, self.__execute_step, pool)
+
+
+    def __execute_rollback(self, pool):
+        """
+        コマンドプールの要素の rollback コマンドを実行し、実行結果を返す
+        rollback が存在しない場合は None を返す
+        """
+
+        arg = pool["rollback"]
+        if arg == None:
+            return None
+
+        def rollback():
+            self.__check_connection(pool["target"])
+            return [pool["run"](arg, pty=True)]
+
+        return self.__record(pool, True, rollback)[0]
+
+
+    def __record(self, pool, rollback, fn, *args):
+        """
+        fn を実行し、開始・終了・失敗のイベントを書き出す
+        実行時間と転送量を記録する
+        """
+
+        import time
+
+        info = {
+            "playbook": self.name,
+            "host": pool["target"],
+            "step": "rollback" if rollback else pool["type"],
+            "command": event.describe(pool, rollback)
+        }
+
+        event.writer.emit("started", **info)
+        start = time.monotonic()
+        try:
+            result = fn(*args)
+        except Exception as e:
+            duration = time.monotonic() - start
+            metrics.recorder.record(metrics.phase(info["step"]), info["host"], duration,
+                                    playbook=self.name)
+            event.writer.emit("failed",
+                              duration=duration,
+                              exited=event.status(e),
+                              error=str(e).strip(),
+                              **info)
+            raise e
+
+        duration = time.monotonic() - start
+        size = event.transferred(result)
+        metrics.recorder.record(metrics.phase(info["step"]), info["host"], duration, size,
+                                playbook=self.name)
+        event.writer.emit("finished",
+                          duration=duration,
+                          bytes=size,
+                          **info)
+
+        return result
+
+
+    def __execute_step(self, pool):
+        """
+        コマンドプールの要素を一つ実行し、実行結果の一覧を返す
+        """
+
+        result = []
+
+        # 接続のヘルスチェック
+        if "target" in pool:
+            self.__check_connection(pool["target"])
+
+        if "target" in pool["type"]:
+            command = pool["run"]
+            arg = pool["command"]
+            # command が存在すれば実行する
+            if arg != None:
+                result.append(command(arg, pty=True))
+
+        elif "file" in pool["type"] or "relay" in pool["type"]:
+            command = pool["run"]
+            local_file = prepare.resolve(pool["local"])
+            remote_file = pool["remote"]
+            result.append(command(local_file, remote_file))
+
+        elif "sync" in pool["type"]:
+            # 差分のあるファイルのみ転送するため実行結果は複数になる
+            command = pool["run"]
+            local_file = prepare.resolve(pool["local"])
+            remote_file = pool["remote"]
+            result.extend(command(local_file, remote_file))
+
+        elif "incremental" in pool["type"]:
+            # 送信先のコミットの確認と差分の転送を行うため実行結果は複数になる
+            command = pool["run"]
+            local_file = prepare.resolve(pool["local"])
+            remote_dir = pool["remote"]
+            result.extend(command(local_file, remote_dir))
+
+        elif "stream" in pool["type"]:
+            command = pool["run"]
+            local_file = prepare.resolve(pool["local"])
+            remote_dir = pool["remote"]
+            result.append(command(local_file, remote_dir))
+
+        elif "cleanup" in pool["type"]:
+            command = pool["run"]
+            remote_file = pool["remote"]
+            result.append(command(remote_file))
+
+        elif "archive" in pool["type"]:
+            # 転送と展開を行うため実行結果は複数になる
+            command = pool["run"]
+            local_file = prepare.resolve(pool["local"])
+            remote_dir = pool["remote"]
+            result.extend(command(local_file, remote_dir))
+
+        return result
+
+
+    def __close_session(self, hosts=None):
+        """
+        リモートシェルのセッションを閉じる
+        hosts が指定されない場合は全てのホストのセッションを閉じる
+        """
+
+        for host, sessions in self.__session.items():
+            if hosts == None or host in hosts:
+                for s in sessions:
+                    s.close()
+
+
+    def __check_connection(self, host):
+        """
+        ホストへの接続のヘルスチェックを行い、切断されていれば再接続する
+        """
+
+        if host in self.__connection:
+            connection.pool.check(self.__connection[host])
+
+
+    def __deployed(self, host):
+        """
+        ターゲットに記録されたフィンガープリントが今回のデプロイ内容と一致するかどうかを返す
+        --force が指定された場合は確認しない
+        """
+
+        if not self.__fingerprint.check or not host in self.__connection:
+            return False
 
-                elif "file" in pool["type"]:
-                    command = pool["run"]
-                    local_file = pool["local"]
-                    remote_file = pool["remote"]
-                    host = pool["target"]
-                    result = command(local_file, remote_file)
+        self.__check_connection(host)
+        with metrics.recorder.measure("fingerprint", host, self.name):
+            recorded = self.__connection[host].run(self.__fingerprint.read_command(),
+                                                   hide=True, warn=True, pty=False)
+
+        return self.__fingerprint.deployed(host, recorded.stdout)
+
+
+    def __skip(self, host):
+        """
+        デプロイ済みのため実行しなかったターゲットの実行結果を返す
+        """
+
+        print("[{}] [{}] already deployed, skipped".format(self.name, host))
+        return fingerprint.Skipped("already deployed")
+
+
+    def __save_fingerprint(self, host):
+        """
+        全ての実行に成功したターゲットにフィンガープリントを記録する
+        記録に失敗してもターゲットの実行は失敗にしない
+        """
+
+        try:
+            self.__check_connection(host)
+            with metrics.recorder.measure("fingerprint", host, self.name):
+                self.__connection[host].run(self.__fingerprint.write_command(host),
+                                            hide=True, pty=False)
+        except Exception as e:
+            print("\033[33m[{}] [{}] failed to record fingerprint: {}\033[0m".format(
+                self.name, host, str(e).strip()))
+
+
+    def __remove_fingerprint(self, command_pool):
+        """
+        rollback するターゲットに記録したフィンガープリントを削除する
+        次のデプロイでは同じ内容でも実行されるようにする
+        """
+
+        hosts = set(pool["target"] for pool in command_pool
+                    if "target" in pool["type"] and pool["rollback"] != None)
+
+        for host in hosts:
+            self.__check_connection(host)
+            self.__connection[host].run(self.__fingerprint.remove_command(),
+                                        hide=True, warn=True, pty=False)
+
+
+    @measured
+    def parallel_run(self):
+        """
+        構築したコマンドの並列実行
+        """
+
+        # コマンドプールが空だった場合
+        # 空の配列を返す
+        if len(self.__command_pool) <= 0:
+            return []
+
+        # ターゲット別のキューを作成する
+        parallel_queue = self.__parallel_queue(False)
+
+        # コマンドプールのターゲット別並列実行
+        # failback の場合は失敗したターゲットから順にその場で rollback を実行する
+        self.__parallel_execute(parallel_queue, self.__parallel_command_runner, False)
+
+        # 各スレッドの実行結果を集約
+        for host, queue in parallel_queue.items():
+            for result in queue["result"]:
+                self.__command_result.append({host: result})
+            self.__command_result.append({host: queue["error"]})
+            if queue["failback"] != None:
+                self.__failback.add(host)
+                for result in queue["failback"]:
                     self.__command_result.append({host: result})
-            except invoke.exceptions.UnexpectedExit as e:
-                self.__command_result.append({pool["target"]: e})
-                raise e
 
         # 各コマンドの実行結果を返す
         return self.__command_result.copy()
 
 
-    def __parallel_command_runner(self, command_result, command_pool):
+    def __parallel_queue(self, rollback, hosts=None):
+        """
+        ターゲット別のキューを作成する
+        rollback の場合は target のコマンドのみをキューに入れる
+        hosts が指定された場合はそのターゲットのキューのみを作成する
+        failback には失敗したその場で実行した rollback の実行結果が入る
+        """
+
+        # ターゲットリストの数だけキューを作成する
+        # キューのコマンドは実行する時にターゲットごとに作成する
+        parallel_queue = {}
+        for index, target in enumerate(self.__target_list):
+            host = target["target"].host
+            if hosts != None and not host in hosts:
+                continue
+            parallel_queue[host] = {
+                "command_pool": HostPool(self.__command_pool, index, target, rollback),
+                "result": [],
+                "error": None,
+                "failback": None
+            }
+
+        return parallel_queue
+
+
+    def __pools(self):
+        """
+        構築したコマンドプールの要素を順番に返すジェネレーター
+        ターゲットごとの要素は Step から順番に作成する
+        """
+
+        for step in self.__command_pool:
+            if not isinstance(step, Step):
+                yield step
+                continue
+            for index, target in enumerate(self.__target_list):
+                for pool in step.bind(index, target):
+                    yield pool
+
+
+    def __host_pool(self, host, rollback=False):
+        """
+        一つのターゲットのコマンドプールを返す
+        """
+
+        if not host in self.__target:
+            return []
+
+        index, target = self.__target[host]
+        return HostPool(self.__command_pool, index, target, rollback)
+
+
+    def run_shard(self, rollback, limit=None):
+        """
+        プロセスプールのワーカーで全ターゲットのキューを実行し、ホストごとの実行結果を返す
+        実行結果は親プロセスに渡せるよう接続情報を取り除く
+        """
+
+        runner = self.__parallel_command_runner
+        if rollback:
+            runner = self.__parallel_rollback_runner
+
+        parallel_queue = self.__parallel_queue(rollback)
+        self.__parallel_execute(parallel_queue, runner, rollback, limit=limit)
+
+        result = {}
+        for host, queue in parallel_queue.items():
+            result[host] = {
+                "result": [self.__detach(r) for r in queue["result"]],
+                "error": self.__detach(queue["error"]),
+                "failback": None
+            }
+            if queue["failback"] != None:
+                result[host]["failback"] = [self.__detach(r) for r in queue["failback"]]
+
+        return result
+
+
+    def __detach(self, value):
+        """
+        実行結果から接続情報を取り除き、プロセス間で受け渡せる形にする
+        """
+
+        import pickle
+        import invoke
+
+        if type(value) == fabric.runners.Result:
+            result = fabric.runners.Result(connection=None,
+                                           command=value.command,
+                                           stdout=value.stdout,
+                                           stderr=value.stderr,
+                                           exited=value.exited,
+                                           pty=value.pty
+                                          )
+            # ログファイルに書き出した場合はそのパスを引き継ぐ
+            if hasattr(value, "log"):
+                result.log = value.log
+            # チャネルに直接書き込んだ転送量を引き継ぐ
+            if hasattr(value, "transferred"):
+                result.transferred = value.transferred
+            return result
+
+        if type(value) == fabric.transfer.Result:
+            return fabric.transfer.Result(orig_remote=value.orig_remote,
+                                          remote=value.remote,
+                                          orig_local=value.orig_local,
+                                          local=value.local,
+                                          connection=None
+                                         )
+
+        if isinstance(value, invoke.exceptions.UnexpectedExit):
+            return type(value)(self.__detach(value.result), value.reason)
+
+        # 受け渡せない例外はメッセージのみを引き継ぐ
+        try:
+            pickle.dumps(value)
+        except Exception:
+            return Exception(str(value))
+
+        return value
+
+
+    def __process_execute(self, parallel_queue, hosts, rollback):
+        """
+        ターゲットをプロセスプールのワーカーに分割して実行し、実行結果をキューに書き込む
+        各ワーカーは担当するターゲットへの接続を自分で作成する
+        """
+
+        import argparse
+        import math
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        processes = min(self.option.processes, len(hosts))
+        if processes <= 0:
+            return
+
+        # ターゲットをワーカーの数に分割する
+        shards = [hosts[i::processes] for i in range(processes)]
+
+        # ワーカーではプロセスを分割せず、バッチも親プロセスで制御する
+        option = argparse.Namespace(**vars(self.option))
+        option.processes = None
+        option.batch_size = None
+        option.max_fail = None
+        if option.max_workers != None:
+            option.max_workers = max(math.ceil(option.max_workers / processes), 1)
+
+        # 接続を引き継がないよう spawn でワーカーを起動する
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+            prepared = self.__prepared_data(hosts, rollback)
+            future_runner = {}
+            for shard in shards:
+                exc = executor.submit(
+                        run_shard,
+                        self.name,
+                        self.__shard_data(shard),
+                        option,
+                        rollback,
+                        self.__limit,
+                        prepared
+                    )
+                future_runner[exc] = shard
+
+            for future, shard in future_runner.items():
+                # ワーカー自体が失敗した場合は担当する全ターゲットを失敗とする
+                if future.exception() != None:
+                    for host in shard:
+                        parallel_queue[host]["error"] = future.exception()
+                    continue
+
+                result, samples = future.result()
+                metrics.recorder.extend(samples)
+                for host, queue in result.items():
+                    parallel_queue[host]["result"].extend(queue["result"])
+                    parallel_queue[host]["error"] = queue["error"]
+                    parallel_queue[host]["failback"] = queue["failback"]
+
+
+    def __shard_data(self, hosts):
+        """
+        指定されたホストのターゲットのみを含むデータを返す
+        """
+
+        data = copy.deepcopy(self.__resolved)
+
+        # 範囲指定・グループ・インベントリは展開済みのため、ホストごとのターゲットとして渡す
+        for key in ["inventory", "defaults", "group"]:
+            if key in data:
+                del data[key]
+        data["target"] = [dict(self.__entry[host], host=host) for host in hosts]
+
+        return data
+
+
+    def __prepared_data(self, hosts, rollback):
+        """
+        ワーカーに渡す、親プロセスで準備した転送するファイル・圧縮した tar・フィンガープリント・回線速度・中継の可否を返す
+        準備の完了を待ち、失敗した準備は例外として渡す
+        rollback では転送しないため準備の完了を待たない
+        """
+
+        artifacts = []
+        for future in self.__futures:
+            if rollback:
+                artifacts.append(None)
+                continue
+            try:
+                artifacts.append(prepare.resolve(future))
+            except Exception as e:
+                artifacts.append(self.__detach(e))
+
+        values = {}
+        if not rollback and self.__fingerprint.check:
+            for host in hosts:
+                try:
+                    values[host] = self.__fingerprint.value(host)
+                except Exception:
+                    # 準備に失敗したターゲットはワーカーで失敗させる
+                    pass
+
+        with self.__archive_lock:
+            archive = dict(self.__archive)
+
+        # compress_level が auto の場合は、ワーカーごとに計測しないよう経路ごとの回線速度を先に計測する
+        entries = self.data.get("file", []) + self.data.get("repo", [])
+        auto = any(c != None and c["level"] == "auto" for c in map(self.__compression, entries))
+        if not rollback and auto:
+            routes = set()
+            for host in hosts:
+                connect = self.__target[host][1]["target"]
+                if self.__route(connect) in routes:
+                    continue
+                routes.add(self.__route(connect))
+                try:
+                    self.__measure_throughput(connect)
+                except Exception:
+                    # 計測できなかった経路はワーカーで計測する
+                    pass
+
+        # relay する場合は、ワーカーごとに確認しないようターゲット間で中継できるかを先に確認する
+        relays = [r for r in (self.__relay(e, False) for e in entries) if r != None]
+        if not rollback and len(relays) > 0:
+            self.__relay_available(relays[0])
+
+        return {
+            "worker_dir": self.__prepare_dir,
+            "artifacts": artifacts,
+            "archive": archive,
+            "fingerprint": values,
+            "throughput": dict(self.__throughput),
+            "relay": self.__relay_probe
+        }
+
+
+    def __resolve(self, key, index, user, password):
+        """
+        入力されたユーザ名・パスワードをワーカーに渡すデータに反映する
+        """
+
+        entry = self.__resolved[key][index]
+        entry["user"] = user
+        if password != None:
+            entry["password"] = password
+
+
+    def __parallel_execute(self, parallel_queue, runner, rollback, batched=True, limit=None):
+        """
+        ターゲット別のキューを並列実行する
+        batch_size が指定された場合はターゲットを分割し、バッチごとに段階的に実行する
+        batched が False の場合はバッチに分割せずに全ターゲットを実行する
+        engine に asyncio が指定された場合はスレッドの代わりにイベントループで実行する
+        processes が指定された場合はターゲットを複数のプロセスに分割して実行する
+        max_fail が指定された場合、失敗したターゲットの数が上限を超えると残りのターゲットを取り消す
+        limit にはワーカープロセスで親プロセスと共有する FailureLimit を渡す
+        """
+
+        manager = None
+        if limit == None and not rollback and getattr(self.option, "max_fail", None) != None:
+            # プロセスに分割する場合は失敗の数と取り消しをワーカープロセスと共有する
+            if getattr(self.option, "processes", None) != None:
+                import multiprocessing
+                manager = multiprocessing.get_context("spawn").Manager()
+            limit = FailureLimit(self.__max_fail(len(parallel_queue)), manager)
+
+        self.__limit = limit
+        try:
+            self.__parallel_batches(parallel_queue, runner, rollback, batched)
+        finally:
+            self.__limit = None
+            if manager != None:
+                manager.shutdown()
+
+
+    def __max_fail(self, total):
+        """
+        max_fail から失敗を許容するターゲットの数を求める
+        max_fail は台数、または 5% のように全体に対する割合で指定する
+        """
+
+        import math
+
+        size = str(self.option.max_fail)
+        if size.endswith("%"):
+            return math.floor(total * float(size[:-1]) / 100)
+
+        return int(size)
+
+
+    def __parallel_batches(self, parallel_queue, runner, rollback, batched):
+        """
+        ターゲット別のキューをバッチごとに並列実行する
+        """
+
+        import time
+
+        max_workers = getattr(self.option, "max_workers", None)
+        batches = [list(parallel_queue.keys())]
+        if batched:
+            batches = self.__batches(batches[0])
+
+        for number, batch in enumerate(batches):
+            # 失敗したターゲットの数が上限を超えた場合、残りのバッチのターゲットは実行しない
+            if self.__limit != None and self.__limit.cancelled():
+                for rest in batches[number:]:
+                    for host in rest:
+                        parallel_queue[host]["error"] = Cancelled("cancelled by max fail")
+                break
+
+            # 2 つ目以降のバッチは待機・ヘルスチェックを通過してから実行する
+            if number > 0:
+                pause = getattr(self.option, "batch_pause", None)
+                if pause != None and pause > 0:
+                    print("[{}] waiting {} seconds before batch {}/{}".format(
+                        self.name, pause, number + 1, len(batches)))
+                    time.sleep(pause)
+
+                if not self.__batch_check(number, len(batches)):
+                    # 残りのバッチのターゲットは実行しない
+                    for rest in batches[number:]:
+                        for host in rest:
+                            parallel_queue[host]["error"] = Cancelled(
+                                "skipped by failed batch check")
+                    break
+
+            if getattr(self.option, "processes", None) != None:
+                self.__process_execute(parallel_queue, batch, rollback)
+                continue
+
+            if getattr(self.option, "engine", None) == "asyncio":
+                import engine
+                e = engine.Engine(max_workers=max_workers, name=self.name)
+                e.run(parallel_queue, batch, self.__connection, self.__execute_command, rollback,
+                      failback=self.__failback_now(rollback),
+                      limit=self.__limit,
+                      release=self.__release_relay,
+                      fingerprint=self.__fingerprint)
+                continue
+
+            # 同時に実行するターゲットの数は max_workers までに制限する
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                future_runner = {}
+                for host in batch:
+                    exc = executor.submit(
+                            self.__parallel_host_runner,
+                            runner,
+                            host,
+                            parallel_queue[host],
+                            rollback
+                        )
+                    future_runner[host] = exc
+                for k, v in future_runner.items():
+                    parallel_queue[k]["error"] = v.exception()
+
+
+    def __parallel_host_runner(self, runner, host, queue, rollback):
+        """
+        一つのターゲットのキューを実行する
+        failback の場合は失敗したその場で、同じスレッドでそのターゲットの rollback を実行する
+        実行が取り消された後のターゲットは実行せずに Cancelled を送出する
+        前回と同じ内容をデプロイ済みのターゲットは実行せずに Skipped を送出する
+        """
+
+        started = False
+        try:
+            if self.__limit != None:
+                self.__limit.check()
+            if not rollback and self.__deployed(host):
+                raise self.__skip(host)
+            started = True
+            runner(queue["result"], queue["command_pool"])
+            if not rollback:
+                self.__save_fingerprint(host)
+        except Exception as e:
+            self.__release_relay(queue["command_pool"])
+
+            # 実行していないターゲットは失敗として数えず、rollback も行わない
+            if not started:
+                raise e
+
+            if self.__limit != None:
+                self.__limit.fail(host, e)
+
+            if self.__failback_now(rollback):
+                queue["failback"] = []
+                print("[{}] [{}] failback now...".format(self.name, host))
+                try:
+                    self.__parallel_rollback_runner(queue["failback"], queue["command_pool"])
+                except Exception as r:
+                    queue["failback"].append(r)
+            raise e
+
+
+    def __release_relay(self, command_pool):
+        """
+        実行しなかった relay の転送を待っている中継先に完了を通知する
+        中継先は中継元を使わずにローカルから転送する
+        """
+
+        for pool in command_pool:
+            if "relay" in pool:
+                relay, index = pool["relay"]
+                relay["done"][index].set()
+
+
+    def __failback_now(self, rollback):
+        """
+        失敗したターゲットの rollback を失敗したその場で実行するかどうかを返す
+        """
+        return not rollback and getattr(self.option, "failback", False)
+
+
+    def __batches(self, hosts):
+        """
+        batch_size に従ってターゲットをバッチに分割する
+        batch_size は台数、または 25% のように全体に対する割合で指定する
+        """
+
+        import math
+
+        size = getattr(self.option, "batch_size", None)
+        if size == None or len(hosts) <= 0:
+            return [hosts]
+
+        size = str(size)
+        if size.endswith("%"):
+            size = math.ceil(len(hosts) * float(size[:-1]) / 100)
+        size = max(int(size), 1)
+
+        return [hosts[i:i + size] for i in range(0, len(hosts), size)]
+
+
+    def __batch_check(self, number, total):
+        """
+        次のバッチに進む前にヘルスチェックのコマンドをローカルで実行する
+        終了コードが 0 以外の場合は False を返す
+        """
+
+        import subprocess
+        import sys
+
+        check = getattr(self.option, "batch_check", None)
+        if check == None:
+            return True
+
+        print("[{}] checking before batch {}/{}: {}".format(
+            self.name, number + 1, total, check))
+        # --events で標準出力にイベントを書き出している場合は、その出力に混ざらないようにする
+        if subprocess.run(check, shell=True, stdout=sys.stdout).returncode != 0:
+            print("[{}] \033[31mbatch check failed\033[0m".format(self.name))
+            return False
+
+        return True
+
+
+    def hosts(self):
+        """
+        ターゲットのホストの一覧を返す
+        """
+        return [target["target"].host for target in self.__target_list]
+
+
+    def connections(self):
+        """
+        ターゲットへの接続の一覧を返す
+        """
+        return [target["target"] for target in self.__target_list]
+
+
+    def host_run(self, host):
+        """
+        一つのターゲットに対して構築したコマンドを実行する
+        """
+
+        # ターゲットのコマンドを取り出す
+        command_pool = self.__host_pool(host)
+
+        # 前回と同じ内容をデプロイ済みのターゲットは実行しない
+        if self.__deployed(host):
+            self.__release_relay(command_pool)
+            result = [self.__skip(host)]
+            self.__command_result.append({host: result[0]})
+            return result
+
+        result = []
+
+        # 構築したコマンドの実行
+        try:
+            self.__parallel_command_runner(result, command_pool)
+            self.__save_fingerprint(host)
+        except Exception as e:
+            self.__release_relay(command_pool)
+            result.append(e)
+            raise e
+        finally:
+            for r in result:
+                self.__command_result.append({host: r})
+
+        # 実行結果を返す
+        return result
+
+
+    def host_rollback(self, host):
+        """
+        一つのターゲットに対して構築した rollback コマンドを実行する
+        """
+
+        # ターゲットの rollback コマンドを取り出す
+        command_pool = self.__host_pool(host, True)
+
+        result = []
+
+        # 構築した rollback コマンドの実行
+        try:
+            self.__parallel_rollback_runner(result, command_pool)
+        except Exception as e:
+            result.append(e)
+            raise e
+        finally:
+            for r in result:
+                self.__command_result.append({host: r})
+
+        # 実行結果を返す
+        return result
+
+
+    @measured
+    def failback(self):
+        """
+         command の実行に失敗したターゲットマシンに対し rollback を並列に実行する
+         実行されなかった (Cancelled) ターゲットと、parallel_run で rollback 済みのターゲットは除く
+        """
+
+        result = []
+
+        # コマンドの実行結果が空だった場合
+        # 空の配列を返す
+        if len(self.__command_result) <= 0:
+            return result
+
+        failed = set()
+
+        # command の実行に失敗したターゲットマシンの列挙
+        for res in self.__command_result:
+            for k, v in res.items():
+                if isinstance(v, Exception) and not isinstance(v, (Cancelled, fingerprint.Skipped)):
+                    failed.add(k)
+        failed -= self.__failback
+
+        if len(failed) <= 0:
+            return result
+
+        # failed に対し rollback コマンドをターゲット別に並列実行
+        parallel_queue = self.__parallel_queue(True, failed)
+        self.__parallel_execute(parallel_queue, self.__parallel_rollback_runner, True, False)
+
+        for host, queue in parallel_queue.items():
+            self.__failback.add(host)
+            for r in queue["result"]:
+                result.append({host: r})
+            if queue["error"] != None:
+                result.append({host: queue["error"]})
+
+        # 各コマンドの実行結果を返す
+        return result
+
+
+    @measured
+    def rollback(self):
+        """
+        構築した rollback コマンドの実行
+        """
+
+        # コマンドプールが空だった場合
+        # 空の配列を返す
+        if len(self.__command_pool) <= 0:
+            return []
+
+        # 構築したコマンドの実行
+        try:
+            removed = set()
+            for pool in self.__pools():
+                if "target" in pool["type"]:
+                    # rollback するターゲットのフィンガープリントを最初に削除する
+                    if pool["rollback"] != None and not pool["target"] in removed:
+                        self.__remove_fingerprint([pool])
+                        removed.add(pool["target"])
+
+                    # rollback が存在すれば実行する
+                    result = self.__execute_rollback(pool)
+                    if result != None:
+                        self.__command_result.append({pool["target"]: result})
+        finally:
+            self.__close_session()
+
+        # 各コマンドの実行結果を返す
+        return self.__command_result.copy()
+
+
+    def __parallel_rollback_runner(self, command_result, command_pool):
+        """
+         rollback コマンドを逐次実行するためのコマンドランナー
+        """
+
+        try:
+            # rollback するターゲットのフィンガープリントを最初に削除する
+            self.__remove_fingerprint(command_pool)
+
+            for pool in command_pool:
+                if "target" in pool["type"]:
+                    # rollback が存在すれば実行する
+                    result = self.__execute_rollback(pool)
+                    if result != None:
+                        command_result.append(result)
+        finally:
+            self.__close_session([pool["target"] for pool in command_pool])
+
+
+    @measured
+    def parallel_rollback(self):
+        """
+        構築した rollback コマンドの実行
+        """
+
+        # コマンドプールが空だった場合
+        # 空の配列を返す
+        if len(self.__command_pool) <= 0:
+            return []
+
+        # ターゲット別のキューを作成する
+        parallel_queue = self.__parallel_queue(True)
+
+        # コマンドプールのターゲット別並列実行
+        self.__parallel_execute(parallel_queue, self.__parallel_rollback_runner, True)
+
+        # 各スレッドの実行結果を集約
+        for host, queue in parallel_queue.items():
+            if queue["error"] == None:
+                for result in queue["result"]:
+                    self.__command_result.append({host: result})
+            else:
+                self.__command_result.append({host: queue["error"]})
+
+        # コマンドプールの実行結果を返す
+        return self.__command_result.copy()
+
+
+    def generate_command_pool(self):
+        """
+        コマンドプールの構築
+        """
+        # プロキシの設定
+        self.__generate_proxy_command()
+        # ターゲットの一覧化
+        self.__generate_target_list()
+        # ファイルの転送準備
+        self.__generate_file_command()
+        # リポジトリの転送準備
+        self.__generate_repo_command()
+        # ターゲットコマンドの構築
+        self.__generate_target_command()
+
+
+    def __submit(self, name, fn, *args):
+        """
+        転送するファイルの準備をバックグラウンドで開始し Future を返す
+        ワーカーでは準備をやり直さず、親プロセスで準備した結果を同じ順番で返す
+        """
+
+        if self.__prepared == None:
+            future = prepare.executor.submit(name, fn, *args)
+            self.__futures.append(future)
+            return future
+
+        value = self.__prepared["artifacts"][len(self.__futures)]
+        self.__futures.append(value)
+
+        # 親プロセスで準備に失敗した場合は、転送する時に同じ例外を送出する
+        if isinstance(value, Exception):
+            failed = Future()
+            failed.set_exception(value)
+            return failed
+
+        return value
+
+
+    def __generate_file_command(self):
+        """
+        file キーワードの解釈・コマンドのジェネレーター
+        """
+        
+        # file キーワードがなかった場合
+        # またはターゲットリストが空だった場合
+        # 何もせずに終了する
+        if (not "file" in self.data) or len(self.__target_list) <= 0:
+            return
+
+        files = self.data["file"]
+
+        # ファイル転送コマンドを構築する
+        for send_file in files:
+            dir_flag = False
+            self.__fingerprint.add_file(send_file)
+            local_path = send_file["path"]
+            remote_path = send_file["to"]
+
+            # sync が指定された場合、差分のあるファイルのみ転送する
+            if "sync" in send_file and send_file["sync"]:
+                self.__generate_sync_command(local_path, remote_path)
+                continue
+
+            # 圧縮方式の指定
+            compression = self.__compression(send_file)
+
+            # stream が指定された場合、一時ファイルを作らず送信先の tar に直接流し込む
+            if "stream" in send_file and send_file["stream"]:
+                self.__generate_stream_command(local_path, remote_path, compression)
+                continue
+
+            # 圧縮が指定された場合、圧縮した tar を転送する
+            if compression != None:
+                self.__generate_archive_command(local_path, remote_path, compression)
+                continue
+
+            # 転送するファイル
+            local = local_path
+
+            # ディレクトリが指定された場合、プログラムで圧縮しファイルにする
+            # 圧縮はバックグラウンドで行い、転送する時に完了を待つ
+            if Path(local_path).is_dir():
+                dir_flag = True
+                local_path_t = Path(local_path).name
+                output = Path(self.__prepare_dir).joinpath(local_path_t)
+                local = self.__submit("archive " + str(local_path),
+                                      self.__make_archive, local_path, output)
+                local_path = str(output) + ".tar"
+
+            # 送信先のパスがファイルでなかった場合、末尾に送信ファイル名を追加する
+            # fabric のファイル送信の仕様
+            if Path(remote_path).name != Path(local_path).name:
+                remote_path = Path(remote_path) / Path(local_path).name
+                
+            # 送信先のパスを PosixPath に変換する
+            remote_path = Path(remote_path).as_posix()
+
+            # relay が指定された場合、ターゲット間で中継して転送する
+            relay = self.__relay(send_file, dir_flag)
+
+            # ターゲットリストの一覧全てに転送する
+            # ディレクトリが指定された場合、送信先で解凍する
+            bind = functools.partial(self.__bind_transfer, local, remote_path, relay, dir_flag)
+
+            # コマンドプールへの積み込み
+            self.__command_pool.append(Step(bind))
+
+            # 中継元に残した tar は、中継先への転送が終わった後のステップで削除する
+            if relay != None and relay["cleanup"]:
+                cleanup = functools.partial(self.__bind_cleanup, remote_path, relay)
+                self.__command_pool.append(Step(cleanup))
+
+
+    def __bind_transfer(self, local, remote_path, relay, extract, index, target):
+        """
+        file・repo キーワードの転送のコマンドプールの要素を一つのターゲットに対して作成する
+        extract が True の場合は転送した tar を送信先で解凍する
+        """
+
+        connect = Transfer(target["target"])
+
+        # コマンドの構築
+        pool = {
+            "type": "file",
+            "target": target["target"].host,
+            "run": connect.put,
+            "local": local,
+            "remote": remote_path
+        }
+
+        # 中継する場合は中継元からの転送に置き換える
+        if relay != None:
+            pool["type"] = "relay"
+            pool["run"] = functools.partial(self.__relay_put, relay, index)
+            pool["relay"] = (relay, index)
+
+        if extract != True:
+            return [pool]
+
+        connect = target["target"]
+        remote_dir = Path(remote_path).parent.as_posix()
+        remote_file = Path(remote_path).name
+        command = "cd {} && tar -xf {} && rm -rf {}".format(
+            remote_dir, remote_file, remote_file)
+
+        # 中継元は中継先への転送が終わるまで tar を残す
+        if relay != None and len(self.__relay_children(relay, index)) > 0:
+            command = "cd {} && tar -xf {}".format(remote_dir, remote_file)
+
+        # コマンドの構築
+        extract_pool = {
+            "type": "target",
+            "target": target["target"].host,
+            "run": connect.run,
+            "command": command,
+            "rollback": None
+        }
+
+        return [pool, extract_pool]
+
+
+    def __bind_cleanup(self, remote_path, relay, index, target):
+        """
+        中継元のターゲットに残した tar を削除するコマンドプールの要素を一つのターゲットに対して作成する
+        中継先のないターゲットは解凍した時に削除しているため要素を作成しない
+        """
+
+        if len(self.__relay_children(relay, index)) <= 0:
+            return []
+
+        pool = {
+            "type": "cleanup",
+            "target": target["target"].host,
+            "run": functools.partial(self.__relay_cleanup, relay, index),
+            "remote": remote_path
+        }
+
+        return [pool]
+
+
+    def __generate_sync_command(self, local_path, remote_path):
+        """
+        file キーワードの sync 指定の解釈・コマンドのジェネレーター
+        """
+
+        tree = Path(local_path).is_dir()
+
+        name = None
+        if tree:
+            # ディレクトリの場合、送信先にディレクトリ名で配置する
+            remote_dir = Path(remote_path) / Path(local_path).name
+        else:
+            # 送信先のパスがファイルでなかった場合、末尾に送信ファイル名を追加する
+            if Path(remote_path).name != Path(local_path).name:
+                remote_path = Path(remote_path) / Path(local_path).name
+            remote_dir = Path(remote_path).parent
+            name = Path(remote_path).name
+
+        # 転送するファイルの一覧とハッシュ値をバックグラウンドで作成する
+        files = self.__submit("hash " + str(local_path),
+                              self.__sync_files, local_path, name)
+
+        # 送信先のパスを PosixPath に変換する
+        remote_dir = Path(remote_dir).as_posix()
+
+        # ターゲットリストの一覧全てに同期する
+        # ターゲットごとのコマンドは実行する時に作成する
+        def bind(index, target):
+            connect = target["target"]
+
+            # コマンドの構築
+            pool = {
+                "type": "sync",
+                "target": connect.host,
+                "run": functools.partial(self.__sync_file, connect, tree),
+                "local": files,
+                "remote": remote_dir
+            }
+
+            return [pool]
+
+        # コマンドプールへの積み込み
+        self.__command_pool.append(Step(bind))
+
+
+    def __sync_files(self, local_path, name):
+        """
+        転送するファイルの一覧とハッシュ値を作成する
+        name が None の場合は local_path をディレクトリとして扱う
+        """
+
+        files = {}
+        if name == None:
+            for p in sorted(Path(local_path).rglob("*")):
+                if p.is_file():
+                    files[p.relative_to(local_path).as_posix()] = (str(p), self.__hash_file(p))
+        else:
+            files[name] = (local_path, self.__hash_file(local_path))
+
+        return files
+
+
+    def __sync_file(self, connect, tree, files, remote_dir):
+        """
+        送信先のハッシュ値と比較し、新規・変更のあったファイルのみ転送する
+        """
+
+        result = []
+
+        # 送信先のハッシュ値を一度のコマンドで取得する
+        # sha256sum が存在しない場合は全てのファイルを転送する
+        if tree:
+            command = "cd {} 2>/dev/null && find . -type f -exec sha256sum {{}} + 2>/dev/null; true"
+            command = command.format(shlex.quote(remote_dir))
+        else:
+            command = "cd {} 2>/dev/null && sha256sum -- {} 2>/dev/null; true"
+            command = command.format(shlex.quote(remote_dir),
+                                     " ".join(shlex.quote(f) for f in files))
+        checked = connect.run(command, pty=False, hide=True, warn=True)
+        result.append(checked)
+
+        remote_hash = {}
+        for line in checked.stdout.splitlines():
+            digest, _, name = line.partition("  ")
+            if name.startswith("./"):
+                name = name[2:]
+            remote_hash[name] = digest
+
+        # 新規・変更のあったファイルの列挙
+        changed = []
+        for name, (local_file, digest) in files.items():
+            if remote_hash.get(name) != digest:
+                changed.append(name)
+
+        # 差分がなければ転送しない
+        if len(changed) <= 0:
+            return result
+
+        # 転送先のディレクトリを作成する
+        dirs = sorted({(Path(remote_dir) / n).parent.as_posix() for n in changed})
+        command = "mkdir -p -- " + " ".join(shlex.quote(d) for d in dirs)
+        result.append(connect.run(command, pty=False, hide=True))
+
+        # 差分のあるファイルを転送する
+        transfer = Transfer(connect)
+        for name in changed:
+            local_file = files[name][0]
+            remote_file = (Path(remote_dir) / name).as_posix()
+            result.append(transfer.put(local_file, remote_file))
+
+        return result
+
+
+    def __generate_stream_command(self, local_path, remote_path, compression, prepared=None):
+        """
+        file・repo キーワードの stream 指定の解釈・コマンドのジェネレーター
+        prepared には local_path をバックグラウンドで準備している Future を渡す
+        """
+
+        local = local_path if prepared == None else prepared
+
+        # 送信先のパスがファイルだった場合、そのディレクトリに展開する
+        if Path(remote_path).name == Path(local_path).name:
+            remote_path = Path(remote_path).parent
+
+        # 送信先のパスを PosixPath に変換する
+        remote_dir = Path(remote_path).as_posix()
+
+        # ターゲットリストの一覧全てに転送する
+        # ターゲットごとのコマンドは実行する時に作成する
+        def bind(index, target):
+            connect = target["target"]
+
+            # コマンドの構築
+            pool = {
+                "type": "stream",
+                "target": connect.host,
+                "run": functools.partial(self.__stream_archive, connect, compression),
+                "local": local,
+                "remote": remote_dir
+            }
+
+            return [pool]
+
+        # コマンドプールへの積み込み
+        self.__command_pool.append(Step(bind))
+
+
+    def __stream_archive(self, connect, compression, local_path, remote_dir):
+        """
+        tar を生成しながら一つの SSH チャネルで送信先の tar -x の標準入力に流し込む
+        """
+
+        import invoke
+        import tarfile
+
+        # 送信先で展開できる圧縮方式の選択
+        codec, level = self.__select_compression(connect, compression)
+
+        command = "mkdir -p {0} && tar -xf - -C {0}".format(shlex.quote(remote_dir))
+        if codec != None:
+            command = "mkdir -p {0} && {1} | tar -xf - -C {0}".format(
+                shlex.quote(remote_dir), compress.decompress_command(codec))
+
+        # 送信先で tar を起動し、標準入力に tar を書き込んでいく
+        channel = connect.create_session()
+        try:
+            channel.exec_command(command)
+            # 書き込み終わったら閉じて送信先に EOF を送る
+            with channel.makefile_stdin("wb") as stdin:
+                threads = getattr(self.option, "compress_threads", None)
+                with compress.writer(codec, stdin, level, threads) as output:
+                    with tarfile.open(fileobj=output, mode="w|") as archive:
+                        archive.add(local_path, arcname=Path(local_path).name)
+                    # TarInfo と TarFile の循環参照を切り、stdin を終了時の GC まで残さない
+                    archive.members.clear()
+                # チャネルに書き込んだ量 (圧縮後のサイズ) を転送量とする
+                stdin.flush()
+                sent = stdin.tell()
+
+            # 送信先の tar の終了を待つ
+            with channel.makefile("rb") as out:
+                stdout = out.read().decode("utf-8", "replace")
+            with channel.makefile_stderr("rb") as err:
+                stderr = err.read().decode("utf-8", "replace")
+            exited = channel.recv_exit_status()
+        finally:
+            channel.close()
+
+        # connect.run と同じ形式の実行結果を作成する
+        result = fabric.runners.Result(connection=connect,
+                                       command=command,
+                                       stdout=stdout,
+                                       stderr=stderr,
+                                       exited=exited
+                                      )
+        result.transferred = sent
+
+        # 展開に失敗した場合は connect.run と同様に例外を送出する
+        if exited != 0:
+            raise invoke.exceptions.UnexpectedExit(result)
+
+        return result
+
+
+    def __generate_archive_command(self, local_path, remote_path, compression, prepared=None):
+        """
+        file・repo キーワードの compress 指定の解釈・コマンドのジェネレーター
+        prepared には local_path をバックグラウンドで準備している Future を渡す
+        """
+
+        local = local_path if prepared == None else prepared
+
+        # 送信先のパスがファイルだった場合、そのディレクトリに展開する
+        if Path(remote_path).name == Path(local_path).name:
+            remote_path = Path(remote_path).parent
+
+        # 送信先のパスを PosixPath に変換する
+        remote_dir = Path(remote_path).as_posix()
+
+        # ターゲットリストの一覧全てに転送する
+        # ターゲットごとのコマンドは実行する時に作成する
+        def bind(index, target):
+            connect = target["target"]
+
+            # コマンドの構築
+            pool = {
+                "type": "archive",
+                "target": connect.host,
+                "run": functools.partial(self.__put_archive, connect, compression),
+                "local": local,
+                "remote": remote_dir
+            }
+
+            return [pool]
+
+        # コマンドプールへの積み込み
+        self.__command_pool.append(Step(bind))
+
+        # 圧縮レベルが回線速度に依存しない場合は、送信先の確認を待たずに圧縮を始めておく
+        # 送信先で展開できない場合は転送する時に別の方式で作り直す
+        if compression["level"] != "auto":
+            codec = compress.candidates(compression["codec"])[0]
+            level = compress.level(codec, compression["level"])
+            self.__submit(None, self.__prebuild_archive, local, codec, level)
+
+
+    def __prebuild_archive(self, local, codec, level):
+        """
+        転送する前に tar を作成しておく
+        失敗した場合は転送する時に作り直すため、ここでは例外を送出しない
+        """
+
+        try:
+            self.__build_archive(prepare.resolve(local), codec, level)
+        except Exception:
+            pass
+
+
+    def __put_archive(self, connect, compression, local_path, remote_dir):
+        """
+        圧縮した tar を転送し、送信先で展開する
+        """
+
+        result = []
+
+        # 送信先で展開できる圧縮方式の選択
+        codec, level = self.__select_compression(connect, compression)
+
+        # 圧縮方式・レベルごとに一度だけ圧縮する
+        archive = self.__build_archive(local_path, codec, level)
+
+        # 転送
+        remote_file = (Path(remote_dir) / Path(archive).name).as_posix()
+        with metrics.recorder.measure("upload", connect.host, self.name):
+            result.append(Transfer(connect).put(archive, remote_file))
+
+        # 送信先で解凍する
+        remote_file = shlex.quote(Path(archive).name)
+        extract = "tar -xf {}".format(remote_file)
+        if codec != None:
+            extract = "{} < {} | tar -xf -".format(
+                compress.decompress_command(codec), remote_file)
+        command = "cd {} && {} && rm -rf {}".format(
+            shlex.quote(remote_dir), extract, remote_file)
+        with metrics.recorder.measure("extract", connect.host, self.name):
+            result.append(connect.run(command, pty=True))
+
+        return result
+
+
+    def __make_archive(self, local_path, output):
+        """
+        local_path の tar を output.tar に作成し、そのパスを返す
+        成果物のキャッシュが有効な場合は、中身が変わっていなければキャッシュにある tar を返す
+        """
+
+        root_dir = Path(local_path).joinpath("..")
+        base_dir = Path(local_path).name
+
+        def build(path):
+            return shutil.make_archive(path[:-len(".tar")],
+                                       "tar",
+                                       root_dir=root_dir,
+                                       base_dir=base_dir
+                                      )
+
+        return self.__cached_artifact(local_path, "tar", Path(output).name + ".tar",
+                                      str(output) + ".tar", build)
+
+
+    def __build_archive(self, local_path, codec, level):
+        """
+        local_path を圧縮した tar を作業用一時ディレクトリに作成し、そのパスを返す
+        成果物のキャッシュが有効な場合は、中身が変わっていなければキャッシュにある tar を返す
+        """
+
+        import tarfile
+
+        # 同じ tar の作成は一度だけ行い、異なる tar は並列に作成する
+        key = (local_path, codec, level)
+        with self.__archive_lock:
+            lock = self.__archive_key_lock.setdefault(key, threading.Lock())
+
+        with lock:
+            if key in self.__archive:
+                return self.__archive[key]
+
+            # 圧縮方式・レベルごとにディレクトリを分ける
+            output = Path(self.__worker_dir.name).joinpath("{}-{}".format(codec, level))
+            output.mkdir(parents=True, exist_ok=True)
+            name = Path(local_path).name + ".tar" + compress.suffix(codec)
+            output = output.joinpath(name)
+
+            threads = getattr(self.option, "compress_threads", None)
+
+            def build(path):
+                with open(path, "wb") as f:
+                    with compress.writer(codec, f, level, threads) as w:
+                        with tarfile.open(fileobj=w, mode="w|") as archive:
+                            archive.add(local_path, arcname=Path(local_path).name)
+                return path
+
+            self.__archive[key] = prepare.report(
+                "compress {} ({}-{})".format(local_path, codec, level),
+                self.__cached_artifact,
+                local_path, "{}-{}".format(codec, level), name, str(output), build)
+
+        return self.__archive[key]
+
+
+    def __cached_artifact(self, local_path, kind, name, output, build):
+        """
+        成果物のキャッシュから local_path の成果物を取得し、なければ build で作成する
+        clone したリポジトリなど作業用一時ディレクトリにあるものはキャッシュせず output に作成する
+        """
+
+        cache_dir = None
+        if not getattr(self.option, "no_artifact_cache", False):
+            cache_dir = getattr(self.option, "artifact_cache", None)
+            if cache_dir == None:
+                cache_dir = artifact.CACHE_DIR
+
+        worker_dirs = [Path(self.__worker_dir.name).resolve(), Path(self.__prepare_dir).resolve()]
+        if cache_dir == None or any(Path(local_path).resolve().is_relative_to(d) for d in worker_dirs):
+            return build(output)
+
+        max_size = getattr(self.option, "artifact_cache_size", None)
+        if max_size == None:
+            max_size = artifact.CACHE_SIZE
+
+        content = getattr(self.option, "artifact_hash", False)
+        key = artifact.fingerprint(local_path, kind, content)
+
+        return artifact.get(cache_dir, key, name, build, max_size)
+
+
+    def __compression(self, entry):
         """
-        コマンドを逐次実行するためのコマンドランナー
+        file・repo キーワードの圧縮方式の指定を解釈する
+        指定がなければコマンドライン引数の指定を使用する
         """
 
-        for pool in command_pool:
-            if "target" in pool["type"]:
-                command = pool["run"]
-                arg = pool["command"]
-                # command が存在すれば実行する
-                if arg != None:
-                    command_result.append(command(arg, pty=True))
+        codec = getattr(self.option, "compress", None)
+        level = getattr(self.option, "compress_level", None)
 
-            elif "file" in pool["type"]:
-                command = pool["run"]
-                local_file = pool["local"]
-                remote_file = pool["remote"]
-                command_result.append(command(local_file, remote_file))
+        if "compress" in entry:
+            codec = entry["compress"]
+        if "compress_level" in entry:
+            level = entry["compress_level"]
 
+        # 圧縮しない場合
+        if codec == None or codec == "none":
+            return None
 
-    def parallel_run(self):
+        # 不明な圧縮方式はここで弾く
+        compress.candidates(codec)
+
+        return {
+            "codec": codec,
+            "level": level
+        }
+
+
+    def __select_compression(self, connect, compression):
         """
-        構築したコマンドの並列実行
+        送信先で展開できる圧縮方式と圧縮レベルを選択する
         """
 
-        # コマンドプールが空だった場合
-        # 空の配列を返す
-        if len(self.__command_pool) <= 0:
-            return []
+        if compression == None:
+            return None, None
 
-        # ターゲットリストの数だけキューを作成する
-        parallel_queue = {}
-        for target in self.__target_list:
-            host = target["target"].host
-            parallel_queue[host] = {
-                "command_pool": [],
-                "result": [],
-                "error": None
-            }
+        host = connect.host
 
-        # 構築したコマンドをキューに入れていく
-        for pool in self.__command_pool:
-            if "target" in pool["type"] or "file" in pool["type"]:
-                t = pool["target"]
-                parallel_queue[t]["command_pool"].append(pool)
+        # 送信先で使用できる展開コマンドを一度だけ調べる
+        if not host in self.__remote_codec:
+            probe = connect.run(compress.probe_command(), pty=False, hide=True, warn=True)
+            self.__remote_codec[host] = probe.stdout.split()
 
-        # コマンドプールのターゲット別並列実行
-        with ThreadPoolExecutor(max_workers=None) as executor:
-            future_runner = {}
-            for host, queue in parallel_queue.items():
-                exc = executor.submit(
-                        self.__parallel_command_runner,
-                        queue["result"],
-                        queue["command_pool"]
-                    )
-                future_runner[host] = exc
-            for k, v in future_runner.items():
-                parallel_queue[k]["error"] = v.exception()
+        codec = compress.select(compression["codec"], self.__remote_codec[host])
 
-        # 各スレッドの実行結果を集約
-        for host, queue in parallel_queue.items():
-            for result in queue["result"]:
-                self.__command_result.append({host: result})
-            self.__command_result.append({host: queue["error"]})
+        # auto の場合は回線速度を計測して圧縮レベルを決める
+        throughput = None
+        if compression["level"] == "auto" and codec != None:
+            throughput = self.__measure_throughput(connect)
 
-        # 各コマンドの実行結果を返す
-        return self.__command_result.copy()
+        return codec, compress.level(codec, compression["level"], throughput)
 
-    
-    def failback(self):
+
+    def __measure_throughput(self, connect):
         """
-         command の実行に失敗したターゲットマシンに対し rollback を実行する
+        送信先までの回線速度 (bytes/sec) を計測する
+        同じ踏み台の経路を通るターゲットでは最初のターゲットで一度だけ計測し、同じ圧縮レベルを使用する
+        踏み台を経由しないターゲットはローカルの回線を共有するものとして一度だけ計測する
         """
 
-        result = []
+        import os
+        import time
 
-        # コマンドの実行結果が空だった場合
-        # 空の配列を返す
-        if len(self.__command_result) <= 0:
-            return result
+        route = self.__route(connect)
 
-        failed = []
+        # 同じ経路の計測は一度だけ行い、他のターゲットは計測が終わるのを待つ
+        with self.__throughput_lock:
+            lock = self.__throughput_key_lock.setdefault(route, threading.Lock())
 
-        # command の実行に失敗したターゲットマシンの列挙
-        for res in self.__command_result:
-            for k, v in res.items():
-                if type(v) != fabric.runners.Result:
-                    failed.append(k)
-        
-        # failed に対し rollback コマンドの実行
-        for pool in self.__command_pool:
-            if "target" in pool["type"]:
-                if pool["target"] in failed:
-                    command = pool["run"]
-                    arg = pool["rollback"]
-                    # rollback が存在すれば実行する
-                    if arg != None:
-                        host = pool["target"]
-                        r = command(arg, pty=True)
-                        result.append({host: r})
+        with lock:
+            if route in self.__throughput:
+                return self.__throughput[route]
 
-        # 各コマンドの実行結果を返す
-        return result
+            # 圧縮の効かないデータを送信し、送信先で読み捨てるまでの時間を計る
+            data = os.urandom(1024 * 1024)
+            channel = connect.create_session()
+            try:
+                start = time.monotonic()
+                channel.exec_command("cat > /dev/null")
+                channel.sendall(data)
+                channel.shutdown_write()
+                channel.recv_exit_status()
+                elapsed = time.monotonic() - start
+            finally:
+                channel.close()
 
+            self.__throughput[route] = len(data) / max(elapsed, 1e-6)
 
-    def rollback(self):
+        return self.__throughput[route]
+
+
+    def __route(self, connect):
         """
-        構築した rollback コマンドの実行
+        ターゲットまでの踏み台の経路を表すキーを返す
+        踏み台を経由しない場合は None を返す
         """
 
-        # コマンドプールが空だった場合
-        # 空の配列を返す
-        if len(self.__command_pool) <= 0:
-            return []
+        gateway = connect.gateway
+        if gateway == None:
+            return None
 
-        # 構築したコマンドの実行
-        for pool in self.__command_pool:
-            if "target" in pool["type"]:
-                command = pool["run"]
-                arg = pool["rollback"]
-                # rollback が存在すれば実行する
-                if arg != None:
-                    host = pool["target"]
-                    result = command(arg, pty=True)
-                    self.__command_result.append({host: result})
+        return connection.pool.key(gateway.host, gateway.port, gateway.user, gateway.gateway)
 
-        # 各コマンドの実行結果を返す
-        return self.__command_result.copy()
 
+    def __relay(self, entry, cleanup):
+        """
+        file・repo キーワードの relay 指定の解釈
+        中継しない場合は None を返す
+        cleanup が True の場合、中継が終わったファイルを中継元から削除する
+        """
+
+        relay = getattr(self.option, "relay", False)
+        fanout = getattr(self.option, "relay_fanout", None)
+
+        if "relay" in entry:
+            relay = entry["relay"]
+        if "relay_fanout" in entry:
+            fanout = entry["relay_fanout"]
+        if fanout == None:
+            fanout = 2
+
+        # ターゲットが一つしかなければ中継する必要はない
+        if not relay or len(self.__target_list) <= 1:
+            return None
+
+        targets = [target["target"] for target in self.__target_list]
+
+        # ターゲットの一覧を fanout 分木とみなし、親から子へ転送していく
+        # index 番目のターゲットの親は (index - 1) // fanout 番目のターゲット
+        relay = {
+            "targets": targets,
+            "fanout": int(fanout),
+            "cleanup": cleanup,
+            "done": [threading.Event() for t in targets],
+            "success": [False for t in targets],
+            "users": [set() for t in targets],
+            "removed": [False for t in targets],
+            "lock": threading.Lock()
+        }
 
-    def __parallel_rollback_runner(self, command_result, command_pool):
+        return relay
+
+
+    def __relay_source(self, connect):
         """
-         rollback コマンドを逐次実行するためのコマンドランナー
+        中継元のターゲットで scp を実行する接続を返す
+        --relay-forward-agent が指定された場合は SSH エージェントを転送する専用の接続を使用し、
+        中継先へはローカルの SSH エージェントの鍵で認証する
         """
 
-        for pool in command_pool:
-            if "target" in pool["type"]:
-                command = pool["run"]
-                arg = pool["rollback"]
-                # rollback が存在すれば実行する
-                if arg != None:
-                    command_result.append(command(arg, pty=True))
+        if getattr(self.option, "relay_forward_agent", False):
+            return connection.pool.agent(connect)
+        return connect
 
 
-    def parallel_rollback(self):
+    def __relay_ssh_options(self):
         """
-        構築した rollback コマンドの実行
+        中継元から中継先へ接続する ssh・scp のオプションを返す
         """
 
-        # コマンドプールが空だった場合
-        # 空の配列を返す
-        if len(self.__command_pool) <= 0:
-            return []
+        options = "-o BatchMode=yes"
+        # 中継先のホスト鍵を知らない場合に登録するのは明示的に指定された場合のみ
+        if getattr(self.option, "relay_accept_new_host_key", False):
+            options += " -o StrictHostKeyChecking=accept-new"
+        return options
 
-        # ターゲットリストの数だけキューを作成する
-        parallel_queue = {}
-        for target in self.__target_list:
-            host = target["target"].host
-            parallel_queue[host] = {
-                "command_pool": [],
-                "result": [],
-                "error": None
-            }
 
-        # 構築したコマンドをキューに入れていく
-        for pool in self.__command_pool:
-            if "target" in pool["type"]:
-                t = pool["target"]
-                parallel_queue[t]["command_pool"].append(pool)
+    def __relay_available(self, relay):
+        """
+        ターゲット間で中継できるか確認する
+        確認は実行中に一度だけ、先頭のターゲットから二番目のターゲットへ ssh で接続して行う
+        中継できない場合は以降の中継を行わずローカルから転送する
+        """
 
-        # コマンドプールのターゲット別並列実行
-        with ThreadPoolExecutor(max_workers=None) as executor:
-            future_runner = {}
-            for host, queue in parallel_queue.items():
-                exc = executor.submit(
-                        self.__parallel_rollback_runner,
-                        queue["result"],
-                        queue["command_pool"]
-                    )
-                future_runner[host] = exc
-            for k, v in future_runner.items():
-                parallel_queue[k]["error"] = v.exception()
+        with self.__relay_probe_lock:
+            if self.__relay_probe != None:
+                return self.__relay_probe
 
-        # 各スレッドの実行結果を集約
-        for host, queue in parallel_queue.items():
-            if queue["error"] == None:
-                for result in queue["result"]:
-                    self.__command_result.append({host: result})
-            else:
-                self.__command_result.append({host: queue["error"]})
+            source = relay["targets"][0]
+            destination = relay["targets"][1]
+            command = "ssh {} -p {} {} true".format(self.__relay_ssh_options(),
+                                                    destination.port,
+                                                    shlex.quote("{}@{}".format(destination.user,
+                                                                               destination.host)))
+            try:
+                result = self.__relay_source(source).run(command, pty=False, hide=True, warn=True)
+                self.__relay_probe = result.ok
+                reason = result.stderr.strip()
+            except Exception as e:
+                self.__relay_probe = False
+                reason = str(e)
 
-        # コマンドプールの実行結果を返す
-        return self.__command_result.copy()
+            if not self.__relay_probe:
+                print("relay is disabled: {} cannot connect to {}: {}".format(
+                    source.host, destination.host, reason))
 
+            return self.__relay_probe
 
-    def generate_command_pool(self):
+
+    def __relay_children(self, relay, index):
         """
-        コマンドプールの構築
+        index 番目のターゲットが中継する先のターゲットの番号を返す
         """
-        # プロキシの設定
-        self.__generate_proxy_command()
-        # ターゲットの一覧化
-        self.__generate_target_list()
-        # ファイルの転送準備
-        self.__generate_file_command()
-        # リポジトリの転送準備
-        self.__generate_repo_command()
-        # ターゲットコマンドの構築
-        self.__generate_target_command()
 
+        first = index * relay["fanout"] + 1
+        last = min(first + relay["fanout"], len(relay["targets"]))
 
-    def __generate_file_command(self):
+        return range(first, last)
+
+
+    def __relay_put(self, relay, index, local_path, remote_path):
         """
-        file キーワードの解釈・コマンドのジェネレーター
+        中継元のターゲットからファイルを転送する
+        先頭のターゲットにはローカルから転送する
         """
-        
-        # file キーワードがなかった場合
-        # またはターゲットリストが空だった場合
-        # 何もせずに終了する
-        if (not "file" in self.data) or len(self.__target_list) <= 0:
-            return
 
-        files = self.data["file"]
+        import invoke
+        import os
 
-        # ファイル転送コマンドを構築する
-        for send_file in files:
-            dir_flag = False
-            local_path = send_file["path"]
-            remote_path = send_file["to"]
+        connect = relay["targets"][index]
+        parent = (index - 1) // relay["fanout"]
 
-            # ディレクトリが指定された場合、プログラムで圧縮しファイルにする
-            if Path(local_path).is_dir():
-                dir_flag = True
-                local_path_t = Path(local_path).name
-                output = Path(self.__worker_dir.name).joinpath(local_path_t)
-                root_dir = Path(local_path).joinpath("..")
-                base_dir = local_path_t
-                local_path = shutil.make_archive(output,
-                                                "tar",
-                                                root_dir=root_dir,
-                                                base_dir=base_dir
-                                                )
+        try:
+            result = None
+
+            if index > 0 and self.__relay_available(relay):
+                # 中継元のファイルが削除されていなければ、削除を待ってもらうよう登録する
+                with relay["lock"]:
+                    kept = not relay["removed"][parent]
+                    if kept:
+                        relay["users"][parent].add(index)
+
+                # 中継元への転送が終わるのを待つ
+                if kept:
+                    relay["done"][parent].wait()
+
+                # 中継元から scp で転送する
+                if kept and relay["success"][parent]:
+                    source = relay["targets"][parent]
+                    destination = "{}@{}:{}".format(connect.user, connect.host, remote_path)
+                    command = "scp -q {} -P {} {} {}"
+                    command = command.format(self.__relay_ssh_options(),
+                                             connect.port,
+                                             shlex.quote(remote_path),
+                                             shlex.quote(destination))
+                    try:
+                        result = self.__relay_source(source).run(command, pty=False, hide=True)
+                        # 中継元から送ったファイルのサイズを転送量とする
+                        result.transferred = os.path.getsize(local_path)
+                    except invoke.exceptions.UnexpectedExit as e:
+                        # 中継に失敗した場合はローカルから転送する
+                        print("[{}] relay from {} failed: {}".format(
+                            connect.host, source.host, e.result.stderr.strip()))
+                        result = None
+
+            # 先頭のターゲット、または中継できなかった場合はローカルから転送する
+            if result == None:
+                result = Transfer(connect).put(local_path, remote_path)
+
+            relay["success"][index] = True
+        finally:
+            # 中継先に転送の完了を通知する
+            relay["done"][index].set()
 
-            # 送信先のパスがファイルでなかった場合、末尾に送信ファイル名を追加する
-            # fabric のファイル送信の仕様
-            if Path(remote_path).name != Path(local_path).name:
-                remote_path = Path(remote_path) / Path(local_path).name
-                
-            # 送信先のパスを PosixPath に変換する
-            remote_path = Path(remote_path).as_posix()
+        return result
 
-            # ターゲットリストの一覧全てに転送する
-            for target in self.__target_list:
-                connect = Transfer(target["target"])
 
-                # コマンドの構築
-                pool = {
-                    "type": "file",
-                    "target": target["target"].host,
-                    "run": connect.put,
-                    "local": local_path,
-                    "remote": remote_path
-                }
+    def __relay_cleanup(self, relay, index, remote_path):
+        """
+        中継元のターゲットで、中継先への転送が終わったファイルを削除する
+        削除を始める前に中継を始めていた中継先の転送の完了を待ち、
+        それ以降の中継先はローカルから転送する
+        """
+
+        with relay["lock"]:
+            relay["removed"][index] = True
+            users = list(relay["users"][index])
+
+        for child in users:
+            relay["done"][child].wait()
 
-                # コマンドプールへの積み込み
-                self.__command_pool.append(pool)
+        connect = relay["targets"][index]
+        return connect.run("rm -f {}".format(shlex.quote(remote_path)),
+                           pty=False, hide=True, warn=True)
 
-                # ディレクトリが指定された場合、送信先で解凍する
-                if dir_flag == True:
-                    connect = target["target"]
-                    remote_dir = Path(remote_path).parent.as_posix()
-                    remote_file = Path(remote_path).name
-                    command = "cd {} && tar -xf {} && rm -rf {}".format(
-                        remote_dir, remote_file, remote_file)
 
-                    # コマンドの構築
-                    pool = {
-                        "type": "target",
-                        "target": target["target"].host,
-                        "run": connect.run,
-                        "command": command,
-                        "rollback": None
-                    }
+    def __hash_file(self, path):
+        """
+        ファイルの SHA-256 ハッシュ値を返す
+        """
 
-                    # コマンドプールへの積み込み
-                    self.__command_pool.append(pool)
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+
+        return digest.hexdigest()
 
 
     def __generate_repo_command(self):
@@ -377,8 +2087,11 @@ class Command():
         if (not "repo" in self.data) or len(self.__target_list) <= 0:
             return
 
+        # GitPython と git コマンドが使用できるか確認する
+        # clone は mirror モジュールで行うため名前は束縛しない
         try:
-            from git import Repo
+            import importlib
+            importlib.import_module("git")
         except ImportError as e:
             import sys
             print("Please install Git command.", file=sys.stderr)
@@ -387,7 +2100,7 @@ class Command():
         repos = self.data["repo"]
 
         # リポジトリ転送コマンドを構築する
-        for repo in repos:
+        for number, repo in enumerate(repos):
             # リポジトリのパス
             repo_path = repo["path"]
 
@@ -408,28 +2121,63 @@ class Command():
             # リポジトリのブランチ
             branch = "master"
             if "branch" in repo:
-                repo_branch = repo["branch"]
+                branch = repo["branch"]
+
+            # リポジトリのコミット
+            # 指定された場合はブランチの代わりにこのコミットを取り出す
+            commit = None
+            if "commit" in repo:
+                commit = repo["commit"]
 
-            # リポジトリのクローン
             # リポジトリ名のディレクトリを一時ディレクトリに作成しそこに clone する
-            cloned = Repo.clone_from(repo_path,
-                Path(self.__worker_dir.name).joinpath(
-                        Path(repo_path).name[:-len(Path(repo_path).suffix)]
-                    ),
-                branch=branch)
-            
-            # リポジトリのパスの取得
-            local_path = cloned.working_dir
+            # 同じリポジトリを複数指定できるよう repo ごとにディレクトリを分ける
+            local_path = str(Path(self.__prepare_dir).joinpath(
+                    "repo-{}".format(number),
+                    Path(repo_path).name[:-len(Path(repo_path).suffix)]
+                ))
+
+            # incremental が指定された場合、前回転送したコミットからの差分のみ転送する
+            # clone はバックグラウンドで行い、転送する時に完了を待つ
+            incremental = getattr(self.option, "incremental", False)
+            if "incremental" in repo:
+                incremental = repo["incremental"]
+            if incremental:
+                cloned = self.__submit("clone " + repo_path,
+                                       self.__prepare_repo,
+                                       repo_path, local_path, branch, commit, False)
+                self.__fingerprint.add_repo(repo, cloned, local_path)
+                self.__generate_incremental_command(repo_path, local_path, remote_path, cloned)
+                continue
+
+            # 圧縮方式の指定
+            compression = self.__compression(repo)
+
+            # stream が指定された場合、一時ファイルを作らず送信先の tar に直接流し込む
+            # clone はバックグラウンドで行い、転送する時に完了を待つ
+            if "stream" in repo and repo["stream"]:
+                cloned = self.__submit("clone " + repo_path,
+                                       self.__prepare_repo,
+                                       repo_path, local_path, branch, commit, False)
+                self.__fingerprint.add_repo(repo, cloned, local_path)
+                self.__generate_stream_command(local_path, remote_path, compression, cloned)
+                continue
+
+            # 圧縮が指定された場合、圧縮した tar を転送する
+            if compression != None:
+                cloned = self.__submit("clone " + repo_path,
+                                       self.__prepare_repo,
+                                       repo_path, local_path, branch, commit, False)
+                self.__fingerprint.add_repo(repo, cloned, local_path)
+                self.__generate_archive_command(local_path, remote_path, compression, cloned)
+                continue
 
             # プログラムで圧縮しファイルにする
-            output = Path(self.__worker_dir.name).joinpath(Path(local_path).name)
-            root_dir = Path(local_path).joinpath("..")
-            base_dir = Path(local_path).name
-            local_path = shutil.make_archive(output,
-                                            "tar",
-                                            root_dir=root_dir,
-                                            base_dir=base_dir
-                                            )
+            # clone・圧縮はバックグラウンドで行い、転送する時に完了を待つ
+            local = self.__submit("clone " + repo_path,
+                                  self.__prepare_repo,
+                                  repo_path, local_path, branch, commit, True)
+            self.__fingerprint.add_repo(repo, local, local_path)
+            local_path = local_path + ".tar"
 
             # 送信先のパスがファイルでなかった場合、末尾に送信ファイル名を追加する
             # fabric のファイル送信の仕様
@@ -439,40 +2187,257 @@ class Command():
             # 送信先のパスを PosixPath に変換する
             remote_path = Path(remote_path).as_posix()
 
-            # ターゲットリストの一覧全てに転送する
-            for target in self.__target_list:
-                connect = Transfer(target["target"])
+            # relay が指定された場合、ターゲット間で中継して転送する
+            relay = self.__relay(repo, True)
 
-                # コマンドの構築
-                pool = {
-                    "type": "file",
-                    "target": target["target"].host,
-                    "run": connect.put,
-                    "local": local_path,
-                    "remote": remote_path
-                }
+            # ターゲットリストの一覧全てに転送し、送信先で解凍する
+            bind = functools.partial(self.__bind_transfer, local, remote_path, relay, True)
 
-                # コマンドプールへの積み込み
-                self.__command_pool.append(pool)
+            # コマンドプールへの積み込み
+            self.__command_pool.append(Step(bind))
 
-                # 送信先で解凍する
-                connect = target["target"]
-                remote_dir = Path(remote_path).parent.as_posix()
-                remote_file = Path(remote_path).name
-                command = "cd {} && tar -xf {} && rm -rf {}".format(
-                    remote_dir, remote_file, remote_file)
+            # 中継元に残した tar は、中継先への転送が終わった後のステップで削除する
+            if relay != None and relay["cleanup"]:
+                cleanup = functools.partial(self.__bind_cleanup, remote_path, relay)
+                self.__command_pool.append(Step(cleanup))
 
-                # コマンドの構築
-                pool = {
-                    "type": "target",
-                    "target": target["target"].host,
-                    "run": connect.run,
-                    "command": command,
-                    "rollback": None
-                }
 
-                # コマンドプールへの積み込み
-                self.__command_pool.append(pool)
+    def __prepare_repo(self, repo_path, local_path, branch, commit, archive):
+        """
+        リポジトリを local_path に clone する
+        ミラーのキャッシュが有効な場合はミラーを更新し、そこから浅く取り出す
+        archive が True の場合は tar にしてそのパスを返し、それ以外の場合は clone したパスを返す
+        """
+
+        from git import Repo
+
+        cache_dir = self.__repo_cache()
+        if cache_dir == None:
+            # リポジトリのクローン
+            cloned = Repo.clone_from(repo_path, local_path, branch=branch)
+            if commit != None:
+                cloned.git.checkout("--detach", commit)
+        else:
+            # ミラーを差分のみ更新し、そこから作業ツリーを取り出す
+            cloned = mirror.checkout(mirror.update(cache_dir, repo_path),
+                                     repo_path, local_path, branch, commit)
+
+        # リポジトリのパスの取得
+        local_path = cloned.working_dir
+        if not archive:
+            return local_path
+
+        # プログラムで圧縮しファイルにする
+        output = Path(local_path).parent.joinpath(Path(local_path).name)
+        root_dir = Path(local_path).joinpath("..")
+        base_dir = Path(local_path).name
+        return shutil.make_archive(output,
+                                   "tar",
+                                   root_dir=root_dir,
+                                   base_dir=base_dir
+                                  )
+
+
+    def __repo_cache(self):
+        """
+        repo のミラーを保存するディレクトリを返す
+        ミラーを使用しない場合は None を返す
+        """
+
+        if getattr(self.option, "no_repo_cache", False):
+            return None
+
+        cache_dir = getattr(self.option, "repo_cache", None)
+        if cache_dir == None:
+            cache_dir = mirror.CACHE_DIR
+
+        return cache_dir
+
+
+    def __generate_incremental_command(self, repo_path, local_path, remote_path, prepared):
+        """
+        repo キーワードの incremental 指定の解釈・コマンドのジェネレーター
+        prepared には local_path に clone している Future を渡す
+        """
+
+        # 送信先のパスがリポジトリ名だった場合、そのディレクトリに展開する
+        if Path(remote_path).name == Path(local_path).name:
+            remote_path = Path(remote_path).parent
+
+        # 送信先のパスを PosixPath に変換する
+        remote_dir = Path(remote_path).as_posix()
+
+        # ターゲットリストの一覧全てに転送する
+        # ターゲットごとのコマンドは実行する時に作成する
+        def bind(index, target):
+            connect = target["target"]
+
+            # コマンドの構築
+            pool = {
+                "type": "incremental",
+                "target": connect.host,
+                "run": functools.partial(self.__put_incremental, connect, repo_path),
+                "local": prepared,
+                "remote": remote_dir
+            }
+
+            return [pool]
+
+        # コマンドプールへの積み込み
+        self.__command_pool.append(Step(bind))
+
+
+    def __put_incremental(self, connect, repo_path, local_path, remote_dir):
+        """
+        送信先に記録したコミットを読み込み、そのコミットからの差分のみを転送して展開する
+        コミットが記録されていない・手元の履歴にない場合は .git を除いた全体を転送する
+        """
+
+        result = []
+
+        deploy_dir = (Path(remote_dir) / Path(local_path).name).as_posix()
+        marker = (Path(deploy_dir) / COMMIT_MARKER).as_posix()
+
+        # 送信先に記録されたコミットの確認
+        command = "cat {} 2>/dev/null; true".format(shlex.quote(marker))
+        checked = connect.run(command, pty=False, hide=True, warn=True)
+        result.append(checked)
+        deployed = checked.stdout.strip()
+
+        archive, revision = self.__build_incremental(repo_path, local_path, deployed)
+
+        # 同じコミットが転送済みであれば何もしない
+        if archive == None:
+            return result
+
+        # 展開した後に削除されたファイルを消し、転送したコミットを記録する
+        command = ("mkdir -p {0} && cd {0} && tar -xf - && "
+                   "xargs -0 rm -f -- < {1} && rm -f {1} && "
+                   "printf '%s\\n' {2} > {3}").format(
+                       shlex.quote(deploy_dir),
+                       DELETED_LIST,
+                       revision,
+                       COMMIT_MARKER)
+        result.append(self.__pipe_file(connect, command, archive))
+
+        return result
+
+
+    def __build_incremental(self, repo_path, local_path, deployed):
+        """
+        送信先のコミットから手元のコミットまでの差分の tar を作成し、tar のパスとコミットを返す
+        送信先が同じコミットの場合は tar のパスに None を返す
+        送信先のコミットごとに一度だけ作成する
+        """
+
+        import io
+        import tarfile
+        from git import Repo
+        from git.exc import GitCommandError
+
+        revision = Repo(local_path).head.commit.hexsha
+        if deployed == revision:
+            return None, revision
+
+        with self.__incremental_lock:
+            key = (local_path, deployed)
+            if key in self.__incremental:
+                return self.__incremental[key], revision
+
+            # 差分は履歴を全て持っているミラー、またはクローンしたリポジトリで計算する
+            history = local_path
+            cache_dir = self.__repo_cache()
+            if cache_dir != None:
+                history = str(mirror.path(cache_dir, repo_path))
+
+            changed = None
+            deleted = []
+            if deployed != "":
+                try:
+                    git = Repo(history).git
+                    git.cat_file("-e", deployed + "^{commit}")
+                    diff = git.diff("--name-status", "-z", "--no-renames", deployed, revision)
+                    changed = []
+                    fields = diff.split("\0")
+                    for status, name in zip(fields[0::2], fields[1::2]):
+                        if status == "D":
+                            deleted.append(name)
+                        else:
+                            changed.append(name)
+                except GitCommandError:
+                    # 送信先のコミットが履歴にない場合は全体を転送する
+                    changed = None
+
+            output = Path(self.__worker_dir.name).joinpath("incremental")
+            output.mkdir(parents=True, exist_ok=True)
+            output = output.joinpath("{}-{}.tar".format(len(self.__incremental),
+                                                        deployed[:12] or "full"))
+
+            with tarfile.open(output, "w") as archive:
+                if changed == None:
+                    # .git を除いた全体
+                    for p in sorted(Path(local_path).iterdir()):
+                        if p.name != ".git":
+                            archive.add(p, arcname=p.name)
+                else:
+                    # 追加・変更されたファイルのみ
+                    for name in changed:
+                        p = Path(local_path) / name
+                        if p.exists() or p.is_symlink():
+                            archive.add(p, arcname=name, recursive=False)
+
+                # 削除されたファイルの一覧
+                data = "".join(name + "\0" for name in deleted).encode()
+                info = tarfile.TarInfo(DELETED_LIST)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+
+            self.__incremental[key] = str(output)
+
+        return self.__incremental[key], revision
+
+
+    def __pipe_file(self, connect, command, local_path):
+        """
+        送信先でコマンドを実行し、その標準入力にファイルを流し込む
+        """
+
+        import invoke
+
+        channel = connect.create_session()
+        try:
+            channel.exec_command(command)
+            # 書き込み終わったら閉じて送信先に EOF を送る
+            with channel.makefile_stdin("wb") as stdin:
+                with open(local_path, "rb") as f:
+                    shutil.copyfileobj(f, stdin, 1024 * 1024)
+                # チャネルに書き込んだ量を転送量とする
+                stdin.flush()
+                sent = stdin.tell()
+
+            # 送信先のコマンドの終了を待つ
+            with channel.makefile("rb") as out:
+                stdout = out.read().decode("utf-8", "replace")
+            with channel.makefile_stderr("rb") as err:
+                stderr = err.read().decode("utf-8", "replace")
+            exited = channel.recv_exit_status()
+        finally:
+            channel.close()
+
+        # connect.run と同じ形式の実行結果を作成する
+        result = fabric.runners.Result(connection=connect,
+                                       command=command,
+                                       stdout=stdout,
+                                       stderr=stderr,
+                                       exited=exited
+                                      )
+        result.transferred = sent
+
+        # 失敗した場合は connect.run と同様に例外を送出する
+        if exited != 0:
+            raise invoke.exceptions.UnexpectedExit(result)
+
+        return result
 
 
     def __generate_proxy_command(self):
@@ -489,7 +2454,7 @@ class Command():
         proxies = self.data["proxy"]
 
         # プロキシのチェーンを作成する
-        for proxy in proxies:
+        for index, proxy in enumerate(proxies):
             # ホストアドレス
             host = proxy["host"]
 
@@ -505,12 +2470,16 @@ class Command():
             else:
                 user = input("LOGIN USER {}: ".format(host))
 
+            # 同じ接続先への接続が既にあれば再利用する
+            conn = connection.pool.find(host, port, user, gateway)
+
             # ログインパスワード
             # key が指定されている場合は鍵のパスワード
+            # 接続を再利用する場合は入力を求めない
             password = None
             if "password" in proxy:
                 password = proxy["password"]
-            else:
+            elif conn == None:
                 msg = "LOGIN PASSWORD {}@{}: "
                 if "key" in proxy:
                     msg = "KEY PASSWORD {}@{}: "
@@ -523,23 +2492,12 @@ class Command():
 
             # 接続の認証方式
             connect_kwargs = None
-            if "key" in proxy:
-                # DSS・RSA・ECDSA・Ed25519 鍵の調査
-                key_list = [
-                    paramiko.DSSKey.from_private_key_file,
-                    paramiko.RSAKey.from_private_key_file,
-                    paramiko.ECDSAKey.from_private_key_file,
-                    paramiko.Ed25519Key.from_private_key_file
-                ]
-
-                pkey = None
-                # 上記鍵にマッチするものを使用する
-                for k in key_list:
-                    try:
-                        pkey = k(key, password)
-                        break
-                    except (paramiko.ssh_exception.SSHException):
-                        continue
+            if conn != None:
+                # 接続を再利用する場合は鍵を読み込まない
+                connect_kwargs = conn.connect_kwargs
+            elif "key" in proxy:
+                # 同じ鍵ファイルは一度だけ読み込む
+                pkey = connection.pool.load_key(key, password)
                 
                 connect_kwargs = {
                     "pkey": pkey
@@ -549,13 +2507,15 @@ class Command():
                     "password": password
                 }
 
+            # SSH の通信路を圧縮する
+            if getattr(self.option, "ssh_compress", False):
+                connect_kwargs["compress"] = True
+
             # 接続情報の作成
-            gateway = Connection(host=host,
-                                 port=port,
-                                 user=user,
-                                 connect_kwargs=connect_kwargs,
-                                 gateway=gateway
-                                )
+            # 同じ接続先の接続はプロセス全体で共有する
+            auth = {"key": key, "password": password}
+            gateway = connection.pool.get(host, port, user, connect_kwargs, gateway, auth)
+            self.__resolve("proxy", index, user, connection.pool.auth(gateway)["password"])
 
         # コマンドの構築
         pool = {
@@ -570,15 +2530,15 @@ class Command():
     def __generate_target_list(self):
         """
         target キーワードの解釈・ターゲットの一覧化
+        host の範囲指定を展開し、defaults・group・inventory の設定を反映する
+        同じ target から展開したホストは設定・コマンドの一覧を共有する
         """
         
-        # target キーワードがなかった場合
+        # target キーワード・inventory キーワードがなかった場合
         # 何もせずに終了する
-        if not "target" in self.data:
+        if not "target" in self.data and not "inventory" in self.data:
             return
 
-        targets = self.data["target"]
-
         gateway = None
         # プロキシの設定
         for pool in self.__command_pool:
@@ -586,10 +2546,13 @@ class Command():
                 gateway = pool["gateway"]
                 break
 
+        # target ごとに入力されたユーザ名・パスワード
+        # 範囲指定されたホストごとに入力を求めないよう target ごとに一度だけ入力する
+        prompted = {}
+
         # ターゲットの接続情報・コマンド情報を一覧化する
-        for target in targets:
-            # ホストアドレス
-            host = target["host"]
+        for host, target in inventory.targets(self.data, Path(self.name).parent):
+            entered = prompted.setdefault(id(target), {})
 
             # ポート番号
             port = "22"
@@ -600,19 +2563,29 @@ class Command():
             user = None
             if "user" in target:
                 user = target["user"]
+            elif "user" in entered:
+                user = entered["user"]
             else:
                 user = input("LOGIN USER {}: ".format(host))
+                entered["user"] = user
+
+            # 同じ接続先への接続が既にあれば再利用する
+            conn = connection.pool.find(host, port, user, gateway)
 
             # ログインパスワード
             # key が指定されている場合は鍵のパスワード
+            # 接続を再利用する場合は入力を求めない
             password = None
             if "password" in target:
                 password = target["password"]
-            else:
+            elif "password" in entered:
+                password = entered["password"]
+            elif conn == None:
                 msg = "LOGIN PASSWORD {}@{}: "
                 if "key" in target:
                     msg = "KEY PASSWORD {}@{}: "
                 password = getpass(msg.format(user, host))
+                entered["password"] = password
 
             # 鍵認証の鍵
             key = None
@@ -631,23 +2604,12 @@ class Command():
 
             # 接続に使用する認証方式
             connect_kwargs = None
-            if "key" in target:
-                # DSS・RSA・ECDSA・Ed25519 鍵の調査
-                key_list = [
-                    paramiko.DSSKey.from_private_key_file,
-                    paramiko.RSAKey.from_private_key_file,
-                    paramiko.ECDSAKey.from_private_key_file,
-                    paramiko.Ed25519Key.from_private_key_file
-                ]
-
-                pkey = None
-                # 上記鍵にマッチするものを使用する
-                for k in key_list:
-                    try:
-                        pkey = k(key, password)
-                        break
-                    except (paramiko.ssh_exception.SSHException):
-                        continue
+            if conn != None:
+                # 接続を再利用する場合は鍵を読み込まない
+                connect_kwargs = conn.connect_kwargs
+            elif "key" in target:
+                # 同じ鍵ファイルは一度だけ読み込む
+                pkey = connection.pool.load_key(key, password)
 
                 connect_kwargs = {
                     "pkey": pkey
@@ -658,13 +2620,16 @@ class Command():
                     "password": password
                 }
 
+            # SSH の通信路を圧縮する
+            if getattr(self.option, "ssh_compress", False):
+                connect_kwargs["compress"] = True
+
             # 接続情報の作成
-            conn = Connection(host=host,
-                              port=port,
-                              user=user,
-                              connect_kwargs=connect_kwargs,
-                              gateway=gateway
-                            )
+            # 同じ接続先の接続はプロセス全体で共有する
+            auth = {"key": key, "password": password}
+            conn = connection.pool.get(host, port, user, connect_kwargs, gateway, auth)
+            self.__entry[conn.host] = self.__resolve_target(
+                    target, entered, user, connection.pool.auth(conn)["password"])
 
             # ターゲット情報の構築
             data = {
@@ -674,7 +2639,27 @@ class Command():
             }
 
             # ターゲットリストに追加
+            self.__target[conn.host] = (len(self.__target_list), data)
             self.__target_list.append(data)
+            self.__connection[conn.host] = conn
+            self.__fingerprint.add_target(conn.host, command, rollback)
+
+
+    def __resolve_target(self, target, entered, user, password):
+        """
+        入力されたユーザ名・パスワードを反映した、ワーカーに渡すターゲットの設定を返す
+        同じユーザ名・パスワードのホストでは同じ dict を共有する
+        """
+
+        resolved = entered.setdefault("resolved", {})
+        if not (user, password) in resolved:
+            entry = dict(target)
+            entry["user"] = user
+            if password != None:
+                entry["password"] = password
+            resolved[(user, password)] = entry
+
+        return resolved[(user, password)]
 
 
     def __generate_target_command(self):
@@ -682,42 +2667,76 @@ class Command():
         target キーワードの解釈・コマンドのジェネレーター
         """
         
-        # ターゲットリストが空だった場合
+        # コマンド・ロールバックコマンドのあるターゲットがない場合
         # 何もせずに終了する
-        if len(self.__target_list) <= 0:
+        if all(t["command"] == None and t["rollback"] == None for t in self.__target_list):
             return
 
-        # ターゲットことにコマンド・ロールバックコマンドを構築
-        for target in self.__target_list:
-            connect = target["target"]
-            command = target["command"]
-            rollback = target["rollback"]
-
-            if command != None:
-                # コマンドの構築
-                for c in command:
-                    pool = {
-                        "type": "target",
-                        "target": connect.host,
-                        "run": connect.run,
-                        "command": c,
-                        "rollback": None,
-                    }
-
-                    # コマンドプールに積み込み
-                    self.__command_pool.append(pool)
-
-            if rollback != None:
-                # コマンドの構築
-                for r in rollback:
-                    pool = {
-                        "type": "target",
-                        "target": connect.host,
-                        "run": connect.run,
-                        "command": None,
-                        "rollback": r,
-                    }
-
-                    # コマンドプールに積み込み
-                    self.__command_pool.append(pool)
+        # ターゲットごとのコマンド・ロールバックコマンドは実行する時に作成する
+        self.__command_pool.append(Step(self.__bind_target))
+
+
+    def __bind_target(self, index, target):
+        """
+        一つのターゲットのコマンド・ロールバックコマンドのコマンドプールの要素を作成する
+        """
+
+        connect = target["target"]
+        command = target["command"]
+        rollback = target["rollback"]
+
+        # コマンドを実行する関数
+        command_run = connect.run
+        rollback_run = connect.run
+
+        # session が指定された場合、コマンドを一つのリモートシェルで順番に実行する
+        # rollback は command の状態を引き継がないよう別のシェルで実行する
+        # セッションはターゲットごとに一度だけ作成する
+        if getattr(self.option, "session", False):
+            if not connect.host in self.__session:
+                command_session = session.Session(connect)
+                rollback_session = session.Session(connect)
+                self.__session[connect.host] = [command_session, rollback_session]
+            command_run = self.__session[connect.host][0].run
+            rollback_run = self.__session[connect.host][1].run
+
+        # capture_dir が指定された場合、出力をホストごとのログファイルに書き出し
+        # 実行結果には出力の末尾のみを残す
+        capture_dir = getattr(self.option, "capture_dir", None)
+        if capture_dir != None:
+            path = Path(capture_dir).expanduser() / connect.host / (Path(self.name).stem + ".log")
+            tail = getattr(self.option, "capture_tail", None)
+            if tail == None:
+                tail = capture.TAIL_SIZE
+            command_run = capture.Capture(command_run, path, tail)
+            rollback_run = capture.Capture(rollback_run, path, tail)
+
+        result = []
+
+        if command != None:
+            # コマンドの構築
+            for c in command:
+                pool = {
+                    "type": "target",
+                    "target": connect.host,
+                    "run": command_run,
+                    "command": c,
+                    "rollback": None,
+                }
+
+                result.append(pool)
+
+        if rollback != None:
+            # コマンドの構築
+            for r in rollback:
+                pool = {
+                    "type": "target",
+                    "target": connect.host,
+                    "run": rollback_run,
+                    "command": None,
+                    "rollback": r,
+                }
 
+                result.append(pool)
+
+        return result
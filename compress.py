@@ -0,0 +1,225 @@
+import contextlib
+import gzip
+import io
+import lzma
+import shutil
+import subprocess
+
+
+# 圧縮方式ごとの設定
+# suffix: 圧縮ファイルの拡張子
+# command: 送信先で展開に使用するコマンド
+# level: 回線速度が遅い・普通・速い場合に使用する圧縮レベル
+# parallel: ローカルで複数スレッドで圧縮する場合に使用するコマンド
+CODEC = {
+    "zstd": {
+        "suffix": ".zst",
+        "command": "zstd",
+        "level": (19, 9, 3),
+        "parallel": None
+    },
+    "xz": {
+        "suffix": ".xz",
+        "command": "xz",
+        "level": (9, 6, 1),
+        "parallel": ["xz", "-T{threads}", "-{level}", "-c"]
+    },
+    "gzip": {
+        "suffix": ".gz",
+        "command": "gzip",
+        "level": (9, 6, 1),
+        "parallel": ["pigz", "-p", "{threads}", "-{level}", "-c"]
+    }
+}
+
+# 圧縮方式の優先順位
+# 指定された圧縮方式が使えない場合、これより後ろの方式にフォールバックする
+PRIORITY = ["zstd", "xz", "gzip"]
+
+# 圧縮レベルを切り替える回線速度 (bytes/sec)
+SLOW_LINK = 1 * 1024 * 1024
+FAST_LINK = 20 * 1024 * 1024
+
+
+def available():
+    """
+    ローカルで使用できる圧縮方式の一覧を返す
+    """
+
+    result = ["xz", "gzip"]
+
+    # zstd はオプションの zstandard モジュールがある場合のみ使用できる
+    try:
+        import zstandard
+        result.insert(0, "zstd")
+    except ImportError:
+        pass
+
+    return result
+
+
+def candidates(codec):
+    """
+    指定された圧縮方式とフォールバック先を優先順に返す
+    auto の場合は使用できる全ての圧縮方式を返す
+    """
+
+    if codec == "auto":
+        codec = PRIORITY[0]
+
+    if not codec in CODEC:
+        raise ValueError("unknown compression: {}".format(codec))
+
+    local = available()
+    result = []
+    for c in PRIORITY[PRIORITY.index(codec):]:
+        if c in local:
+            result.append(c)
+
+    return result
+
+
+def probe_command():
+    """
+    送信先で使用できる展開コマンドを列挙するコマンドを返す
+    """
+
+    names = " ".join(CODEC[c]["command"] for c in PRIORITY)
+    command = "for c in {}; do command -v $c >/dev/null 2>&1 && echo $c; done; true"
+
+    return command.format(names)
+
+
+def select(codec, remote):
+    """
+    送信先で展開できる圧縮方式を選択する
+    どれも使用できない場合は None を返す
+    """
+
+    for c in candidates(codec):
+        if CODEC[c]["command"] in remote:
+            return c
+
+    return None
+
+
+def level(codec, level, throughput=None):
+    """
+    圧縮レベルを決定する
+    auto の場合は計測した回線速度から選択する
+    """
+
+    if codec == None:
+        return None
+
+    slow, normal, fast = CODEC[codec]["level"]
+
+    if level == None:
+        return normal
+
+    if level == "auto":
+        if throughput == None:
+            return normal
+        if throughput < SLOW_LINK:
+            return slow
+        if throughput < FAST_LINK:
+            return normal
+        return fast
+
+    return int(level)
+
+
+def suffix(codec):
+    """
+    圧縮方式に対応する拡張子を返す
+    """
+
+    if codec == None:
+        return ""
+
+    return CODEC[codec]["suffix"]
+
+
+def decompress_command(codec):
+    """
+    標準入力を展開し標準出力に書き出す送信先のコマンドを返す
+    """
+
+    return "{} -dc".format(CODEC[codec]["command"])
+
+
+def writer(codec, fileobj, level, threads=None):
+    """
+    fileobj に圧縮して書き込むファイルオブジェクトを返す
+    close しても fileobj は close されない
+    threads を指定した場合、使用できれば複数スレッドで圧縮する (0 の場合は CPU の数)
+    """
+
+    if codec == None:
+        return contextlib.nullcontext(fileobj)
+
+    if threads != None:
+        parallel = parallel_writer(codec, fileobj, level, threads)
+        if parallel != None:
+            return parallel
+
+    if codec == "gzip":
+        return gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=level)
+
+    if codec == "xz":
+        return lzma.LZMAFile(fileobj, mode="wb", preset=level)
+
+    if codec == "zstd":
+        import zstandard
+        compressor = zstandard.ZstdCompressor(level=level)
+        return compressor.stream_writer(fileobj, closefd=False)
+
+    raise ValueError("unknown compression: {}".format(codec))
+
+
+def parallel_writer(codec, fileobj, level, threads):
+    """
+    複数スレッドで圧縮して fileobj に書き込むファイルオブジェクトを返す
+    zstd は zstandard モジュールのスレッドを、それ以外は pigz・xz -T を使用する
+    使用できない場合は None を返す
+    """
+
+    import os
+
+    if threads <= 0:
+        threads = os.cpu_count() or 1
+
+    if codec == "zstd":
+        import zstandard
+        compressor = zstandard.ZstdCompressor(level=level, threads=threads)
+        return compressor.stream_writer(fileobj, closefd=False)
+
+    # 外部コマンドは実ファイルに直接書き込ませる
+    command = CODEC[codec]["parallel"]
+    if command == None or shutil.which(command[0]) == None:
+        return None
+    if not isinstance(fileobj, io.IOBase):
+        return None
+    try:
+        fileobj.fileno()
+    except (OSError, ValueError):
+        return None
+
+    command = [c.format(threads=threads, level=level) for c in command]
+    return process_writer(command, fileobj)
+
+
+@contextlib.contextmanager
+def process_writer(command, fileobj):
+    """
+    外部の圧縮コマンドの標準入力を返し、圧縮結果を fileobj に書き込ませる
+    """
+
+    fileobj.flush()
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=fileobj)
+    try:
+        yield process.stdin
+    finally:
+        process.stdin.close()
+        if process.wait() != 0:
+            raise OSError("{} exited with {}".format(command[0], process.returncode))
@@ -0,0 +1,356 @@
+import os
+import threading
+import metrics
+
+
+# 鍵ファイルの読み込みに使用する鍵の種類
+# 使用している paramiko に存在しない種類は無視する
+KEY_TYPES = ["DSSKey", "RSAKey", "ECDSAKey", "Ed25519Key"]
+
+
+class LazyConnection():
+    """
+    最初に使用する時に fabric の Connection を作成する接続情報
+    大量のターゲットを扱う場合に Connection の作成にかかる時間とメモリを抑える
+    host・port・user・gateway・connect_kwargs は Connection を作成せずに参照できる
+    """
+
+    def __init__(self, host, port, user, connect_kwargs, gateway):
+        """
+        LazyConnection クラス コンストラクタ
+        """
+        self.host = host
+        self.port = port
+        self.user = user
+        self.connect_kwargs = connect_kwargs
+        self.gateway = gateway
+        self.__forward_agent = None
+        self.__connection = None
+        self.__lock = threading.Lock()
+
+
+    def connection(self):
+        """
+        fabric の Connection を返す
+        まだ作成されていない場合は作成する
+        """
+
+        with self.__lock:
+            if self.__connection == None:
+                from fabric import Connection
+
+                self.__connection = Connection(host=self.host,
+                                               port=self.port,
+                                               user=self.user,
+                                               connect_kwargs=self.connect_kwargs,
+                                               gateway=self.gateway,
+                                               forward_agent=self.__forward_agent
+                                              )
+                # known_hosts に登録されたホストは鍵を検証する (未知のホスト鍵は受け入れる)
+                self.__connection.client.load_system_host_keys()
+
+        return self.__connection
+
+
+    @property
+    def forward_agent(self):
+        """
+        SSH エージェントを転送するかどうか
+        """
+        if self.__connection == None:
+            return self.__forward_agent
+        return self.__connection.forward_agent
+
+
+    @forward_agent.setter
+    def forward_agent(self, value):
+        self.__forward_agent = value
+        if self.__connection != None:
+            self.__connection.forward_agent = value
+
+
+    @property
+    def is_connected(self):
+        """
+        接続済みかどうかを返す
+        Connection を作成していない場合は接続していない
+        """
+        if self.__connection == None:
+            return False
+        return self.__connection.is_connected
+
+
+    def close(self):
+        """
+        接続を閉じる
+        Connection を作成していない場合は何もしない
+        """
+        if self.__connection != None:
+            self.__connection.close()
+
+
+    def __getattr__(self, name):
+        # 作成前に参照できない属性は Connection を作成して参照する
+        if name.startswith("_LazyConnection__"):
+            raise AttributeError(name)
+        return getattr(self.connection(), name)
+
+
+class ConnectionPool():
+    """
+    プロセス全体で SSH 接続を共有するコネクションプール
+    (ユーザ名・ホスト・ポート・踏み台の経路) が同じ接続は一つの Connection を共有する
+    """
+
+    def __init__(self):
+        """
+        ConnectionPool クラス コンストラクタ
+        """
+        self.__pool = {}   # 接続先ごとの Connection
+        self.__lock = {}   # 接続先ごとの接続・再接続用のロック
+        self.__auth = {}   # 接続先ごとの認証情報 (鍵のパス・パスワード)
+        self.__key = {}    # 読み込んだ鍵ファイルのキャッシュ
+        self.__key_lock = threading.Lock()
+        self.__pool_lock = threading.Lock()
+        self.__failed = {} # 事前の接続に失敗した接続先と例外
+        self.__agent = {}  # 接続先ごとの SSH エージェントを転送する専用の接続
+        self.__agent_lock = {}
+
+
+    def key(self, host, port, user, gateway):
+        """
+        接続先を一意に表すキーを返す
+        踏み台を経由する場合は踏み台の経路もキーに含める
+        """
+
+        chain = None
+        if gateway != None:
+            chain = self.key(gateway.host, gateway.port, gateway.user, gateway.gateway)
+
+        return (user, host, str(port), chain)
+
+
+    def find(self, host, port, user, gateway):
+        """
+        プールにある接続を返す
+        まだ接続が作られていない場合は None を返す
+        """
+
+        key = self.key(host, port, user, gateway)
+
+        with self.__pool_lock:
+            if key in self.__pool:
+                return self.__pool[key]
+
+        return None
+
+
+    def get(self, host, port, user, connect_kwargs, gateway, auth=None):
+        """
+        プールから接続を取得する
+        プールになければ接続を作成しプールに追加する
+        auth には fabric 以外のクライアントから接続する際に使用する認証情報を渡す
+        """
+
+        key = self.key(host, port, user, gateway)
+
+        with self.__pool_lock:
+            if not key in self.__pool:
+                # 接続情報の作成
+                # fabric の Connection は最初に使用する時に、実際の接続は最初にコマンドを実行した時に作成される
+                self.__pool[key] = LazyConnection(host, port, user, connect_kwargs, gateway)
+                self.__lock[key] = threading.Lock()
+                self.__auth[key] = auth
+
+        return self.__pool[key]
+
+
+    def auth(self, connect):
+        """
+        接続の作成時に登録した認証情報を返す
+        """
+
+        key = self.key(connect.host, connect.port, connect.user, connect.gateway)
+
+        with self.__pool_lock:
+            if key in self.__auth and self.__auth[key] != None:
+                return self.__auth[key]
+
+        return {"key": None, "password": None}
+
+
+    def agent(self, connect):
+        """
+        connect と同じ接続先に SSH エージェントを転送する専用の接続を返す
+        プールの接続とは別に作成するため、他の処理の接続にはエージェントが転送されない
+        """
+
+        key = self.key(connect.host, connect.port, connect.user, connect.gateway)
+
+        with self.__pool_lock:
+            if not key in self.__agent:
+                agent = LazyConnection(connect.host, connect.port, connect.user,
+                                       connect.connect_kwargs, connect.gateway)
+                agent.forward_agent = True
+                self.__agent[key] = agent
+                self.__agent_lock[key] = threading.Lock()
+            agent = self.__agent[key]
+            lock = self.__agent_lock[key]
+
+        with lock:
+            if not agent.is_connected:
+                with metrics.recorder.measure("connect", connect.host):
+                    agent.open()
+
+        return agent
+
+
+    def load_key(self, path, password, client="paramiko"):
+        """
+        鍵ファイルを読み込む
+        同じ鍵ファイルは一度だけ読み込み、以降はキャッシュを返す
+        client に "asyncssh" を指定した場合は asyncssh の鍵として読み込む
+        どの種類の鍵としても読み込めない場合は None を返す
+        """
+
+        key = (os.path.realpath(os.path.expanduser(path)), password, client)
+
+        with self.__key_lock:
+            if key in self.__key:
+                return self.__key[key]
+
+            pkey = None
+            with metrics.recorder.measure("key", None):
+                if client == "asyncssh":
+                    import asyncssh
+
+                    try:
+                        pkey = asyncssh.read_private_key(key[0], password)
+                    except (asyncssh.KeyImportError, asyncssh.KeyEncryptionError):
+                        pass
+                else:
+                    import paramiko
+
+                    # DSS・RSA・ECDSA・Ed25519 鍵の調査
+                    # 上記鍵にマッチするものを使用する
+                    for name in KEY_TYPES:
+                        k = getattr(paramiko, name, None)
+                        if k == None:
+                            continue
+                        try:
+                            pkey = k.from_private_key_file(key[0], password)
+                            break
+                        except (paramiko.ssh_exception.SSHException):
+                            continue
+
+            self.__key[key] = pkey
+
+        return pkey
+
+
+    def warm(self, connects, max_workers=None):
+        """
+        接続を並列に開いて認証まで済ませておく
+        踏み台は check で先に接続される
+        接続に失敗したホストと例外の辞書を返す
+        接続に失敗した接続先は、以降の check で接続し直さずに同じ例外を送出する
+        """
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        # 同じ接続は一度だけ開く
+        unique = {}
+        for connect in connects:
+            unique[id(connect)] = connect
+
+        failed = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            future_connect = {}
+            for connect in unique.values():
+                future_connect[connect] = executor.submit(self.check, connect)
+            for connect, future in future_connect.items():
+                if future.exception() != None:
+                    failed[connect.host] = future.exception()
+                    key = self.key(connect.host, connect.port, connect.user, connect.gateway)
+                    with self.__pool_lock:
+                        self.__failed[key] = future.exception()
+
+        return failed
+
+
+    def failed(self, connect):
+        """
+        事前の接続に失敗した接続先であればその例外を返す
+        失敗していない場合は None を返す
+        """
+
+        key = self.key(connect.host, connect.port, connect.user, connect.gateway)
+
+        with self.__pool_lock:
+            return self.__failed.get(key)
+
+
+    def check(self, connect, phase="connect"):
+        """
+        接続のヘルスチェックを行い、切断されていれば再接続する
+        複数のスレッドから同時に接続が開かれないよう、接続先ごとにロックを取る
+        phase には接続にかかった時間を記録する処理の名前を渡す
+        """
+
+        key = self.key(connect.host, connect.port, connect.user, connect.gateway)
+
+        with self.__pool_lock:
+            lock = self.__lock.setdefault(key, threading.Lock())
+
+        # 事前の接続に失敗した接続先には再び接続を試みない
+        failed = self.failed(connect)
+        if failed != None:
+            raise failed
+
+        with lock:
+            # 踏み台から順番に確認する
+            if connect.gateway != None:
+                self.check(connect.gateway, "proxy")
+
+            if connect.is_connected:
+                try:
+                    # 応答を必要としないパケットを送り、通信路が生きているか確認する
+                    connect.transport.send_ignore()
+                    return connect
+                except Exception:
+                    pass
+
+            # 切断されていた場合は一度閉じてから接続し直す
+            try:
+                connect.close()
+            except Exception:
+                pass
+            with metrics.recorder.measure(phase, connect.host):
+                connect.open()
+
+        return connect
+
+
+    def close(self):
+        """
+        プールにある全ての接続を閉じる
+        """
+
+        with self.__pool_lock:
+            pool = list(self.__pool.values()) + list(self.__agent.values())
+            self.__pool.clear()
+            self.__lock.clear()
+            self.__auth.clear()
+            self.__failed.clear()
+            self.__agent.clear()
+            self.__agent_lock.clear()
+
+        for connect in pool:
+            try:
+                connect.close()
+            except Exception:
+                pass
+
+
+# プロセス全体で共有するコネクションプール
+pool = ConnectionPool()
@@ -1,7 +1,11 @@
 #! python3
 
 
-from command import Command
+import artifact
+import connection
+import event
+import metrics
+import prepare
 
 
 def arg():
@@ -15,11 +19,98 @@ def arg():
     parser.add_argument("-p", "--parallel",
                         help="parallel run (default is sequential)",
                         action="store_true")
+    parser.add_argument("--max-workers",
+                        help="maximum number of targets to run at the same time",
+                        type=int)
+    parser.add_argument("--engine",
+                        help="parallel execution engine (default is thread)",
+                        choices=["thread", "asyncio"], default="thread")
+    parser.add_argument("--processes",
+                        help="split targets across N worker processes with --parallel",
+                        type=int)
+    parser.add_argument("--batch-size",
+                        help="run targets in batches of N hosts or N%% of hosts with --parallel")
+    parser.add_argument("--batch-pause",
+                        help="seconds to wait between batches", type=float)
+    parser.add_argument("--batch-check",
+                        help="local command that must succeed before the next batch")
+    parser.add_argument("--max-fail",
+                        help="stop starting targets once more than N or N%% of targets fail with --parallel")
+    parser.add_argument("--force",
+                        help="run targets even if they already have this deployment",
+                        action="store_true")
+    parser.add_argument("--concurrent",
+                        help="run playbooks concurrently per target, honoring depends_on",
+                        action="store_true")
+    parser.add_argument("--session",
+                        help="run each target's commands in one long-lived remote shell",
+                        action="store_true")
     parser.add_argument("--display",
                         help="display result to run command",
                         action="store_true")
+    parser.add_argument("--events",
+                        help="write an event per target and step as it happens",
+                        choices=["jsonl"])
+    parser.add_argument("--events-file",
+                        help="append events to this file instead of stdout (without it, other output goes to stderr)")
+    parser.add_argument("--capture-dir",
+                        help="write each target's command output to DIR/<host>/<playbook>.log")
+    parser.add_argument("--capture-tail",
+                        help="characters of output kept in memory per command with --capture-dir (default is 65536)",
+                        type=int)
+    parser.add_argument("--metrics-json",
+                        help="write per-phase and per-host durations and bytes to this JSON file")
+    parser.add_argument("--metrics-prom",
+                        help="write the same metrics to this Prometheus textfile")
     parser.add_argument("--no-enter",
                         help="exit without input Enter key", action="store_true")
+    parser.add_argument("--no-prewarm",
+                        help="open connections lazily instead of before running",
+                        action="store_true")
+    parser.add_argument("--compress",
+                        help="compress file and repo transfers (default is none)",
+                        choices=["none", "gzip", "xz", "zstd", "auto"])
+    parser.add_argument("--compress-level",
+                        help="compression level, or auto to choose it from link throughput")
+    parser.add_argument("--compress-threads",
+                        help="compress archives with N threads, 0 for all cores (zstd, pigz, xz -T)",
+                        type=int)
+    parser.add_argument("--prepare-workers",
+                        help="number of clones and archives prepared at the same time",
+                        type=int)
+    parser.add_argument("--ssh-compress",
+                        help="compress the SSH connection itself", action="store_true")
+    parser.add_argument("--relay",
+                        help="relay file and repo transfers from target to target",
+                        action="store_true")
+    parser.add_argument("--relay-fanout",
+                        help="number of targets each target relays to (default is 2)",
+                        type=int)
+    parser.add_argument("--relay-forward-agent",
+                        help="forward the local ssh-agent to targets that relay transfers",
+                        action="store_true")
+    parser.add_argument("--relay-accept-new-host-key",
+                        help="accept unknown host keys of targets when relaying transfers",
+                        action="store_true")
+    parser.add_argument("--artifact-cache",
+                        help="directory of the archive cache (default is ~/.cache/dolphin/artifacts)")
+    parser.add_argument("--artifact-cache-size",
+                        help="maximum size of the archive cache in MiB (default is 10240)",
+                        type=int)
+    parser.add_argument("--artifact-hash",
+                        help="include file contents in the archive cache key",
+                        action="store_true")
+    parser.add_argument("--no-artifact-cache",
+                        help="build archives every time without the cache",
+                        action="store_true")
+    parser.add_argument("--incremental",
+                        help="ship only the diff since the commit last deployed by repo",
+                        action="store_true")
+    parser.add_argument("--repo-cache",
+                        help="directory of the repo mirror cache (default is ~/.cache/dolphin/repos)")
+    parser.add_argument("--no-repo-cache",
+                        help="clone repos directly without the mirror cache",
+                        action="store_true")
     group = parser.add_mutually_exclusive_group()
     group.add_argument("--rollback",
                         help="do rollback instead of command", action="store_true")
@@ -27,6 +118,19 @@ def arg():
                         help="do rollback if missing command", action="store_true")
     args = parser.parse_args()
 
+    # --concurrent は TOML ファイル・ターゲットごとにスレッドで実行するため、
+    # バッチ・失敗数の上限・実行エンジン・ワーカープロセスの指定とは同時に使用できない
+    if args.concurrent:
+        unsupported = [
+            ("--batch-size", args.batch_size != None),
+            ("--max-fail", args.max_fail != None),
+            ("--engine asyncio", args.engine != "thread"),
+            ("--processes", args.processes != None)
+        ]
+        for name, given in unsupported:
+            if given:
+                parser.error("{} cannot be used with --concurrent".format(name))
+
     return args
 
 
@@ -46,19 +150,113 @@ def load_toml(files):
     return result
 
 
-def command_generate(data):
+def command_generate(data, args):
     """
     コマンドを解析し Command　クラスのオブジェクトを生成する
+    SSH・git のモジュールの読み込みに時間がかかるため、コマンドを生成する時に読み込む
     """
 
+    from command import Command
+
     result = []
 
     for name, value in data.items():
-        result.append(Command(name, value))
+        result.append(Command(name, value, args))
 
     return result
 
 
+def command_dependency(command, strict=True):
+    """
+    depends_on を解析し、各 TOML ファイルが依存する TOML ファイルの一覧を返す
+    depends_on のパスは TOML ファイルからの相対パスで記述する
+    strict が False の場合、実行時に指定されていない TOML ファイルへの依存は無視する
+    """
+
+    import os
+
+    # TOML ファイルのパスから Command の名前を引けるようにする
+    names = {}
+    for c in command:
+        names[os.path.realpath(c.name)] = c.name
+
+    result = {}
+
+    for c in command:
+        result[c.name] = []
+
+        depends = []
+        if "depends_on" in c.data:
+            depends = c.data["depends_on"]
+            if isinstance(depends, str):
+                depends = [depends]
+
+        for d in depends:
+            path = os.path.realpath(os.path.join(os.path.dirname(c.name), d))
+            if not path in names:
+                if not strict:
+                    continue
+                raise Exception("[{}] depends_on {} is not given".format(c.name, d))
+            result[c.name].append(names[path])
+
+    return result
+
+
+def command_sort(command, dependency):
+    """
+    依存する TOML ファイルが先になるように Command を並び替える
+    依存関係のない TOML ファイルは指定された順番のままにする
+    """
+
+    result = []
+    done = set()
+
+    while len(result) < len(command):
+        ready = None
+        for c in command:
+            if c.name in done:
+                continue
+            if all(d in done for d in dependency[c.name]):
+                ready = c
+                break
+
+        # 循環した依存関係は実行できない
+        if ready == None:
+            names = [c.name for c in command if not c.name in done]
+            raise Exception("depends_on has a cycle: {}".format(", ".join(names)))
+
+        result.append(ready)
+        done.add(ready.name)
+
+    return result
+
+
+def command_connect(command, args):
+    """
+    コマンドの実行前に全ターゲットへの接続を並列に開く
+    接続できないターゲットは表示し、実行時にそのターゲットを失敗として扱う
+    """
+
+    connects = []
+    for c in command:
+        connects.extend(c.connections())
+
+    if len(connects) <= 0:
+        return
+
+    # 複数の TOML ファイルで共有する接続は一つとして数える
+    keys = set(connection.pool.key(c.host, c.port, c.user, c.gateway) for c in connects)
+    print("connecting to {} targets".format(len(keys)))
+    failed = connection.pool.warm(connects, args.max_workers)
+
+    # 接続に失敗したターゲットを赤文字で表示する
+    for host, e in failed.items():
+        print("\033[31m[{}] connection failed: {}\033[0m".format(host, e))
+
+    if len(failed) > 0:
+        print("\033[31mfailed to connect to {} target(s), continuing with the others\033[0m".format(len(failed)))
+
+
 def command_run(command, args):
     """
     構築したコマンドを実行する
@@ -91,15 +289,94 @@ def command_run_parallel(command, args):
 
     for c in command:
         if not args.rollback:
+            # failback の場合、失敗したターゲットの rollback は parallel_run の中で実行される
             result[c.name] = c.parallel_run()
-            if args.failback:
-                c.failback()
         else:
             result[c.name] = c.parallel_rollback()
 
     return result
 
 
+def command_run_host(c, host, wait, args):
+    """
+    一つの TOML ファイルの一つのターゲットに対してコマンドを実行する
+    """
+
+    # 依存する TOML ファイルの同じターゲットでの実行が終わるのを待つ
+    # rollback の場合は依存される側の実行が終わるのを待つ
+    success = True
+    for w in wait:
+        if not w.result():
+            success = False
+
+    if args.rollback:
+        try:
+            c.host_rollback(host)
+            return True
+        except Exception as e:
+            print("[{}] [{}] \033[31m".format(c.name, host) + str(e) + "\033[0m")
+            return False
+
+    # 依存する TOML ファイルが失敗したターゲットでは実行しない
+    if not success:
+        print("[{}] [{}] skipped by failed dependency".format(c.name, host))
+        return False
+
+    try:
+        c.host_run(host)
+        return True
+    except Exception as e:
+        print("[{}] [{}] \033[31m".format(c.name, host) + str(e) + "\033[0m")
+        if args.failback:
+            print("[{}] [{}] failback now...".format(c.name, host))
+            try:
+                c.host_rollback(host)
+            except Exception as e:
+                print("[{}] [{}] \033[31m".format(c.name, host) + str(e) + "\033[0m")
+        return False
+
+
+def command_run_concurrent(command, args):
+    """
+    構築したコマンドを TOML ファイル・ターゲットごとに並行実行する
+    各ターゲットは依存する TOML ファイルの実行が終わり次第、次の TOML ファイルの実行に進む
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    dependency = command_dependency(command)
+
+    # rollback は依存関係の逆順に実行する
+    order = command
+    wait_for = dependency
+    if args.rollback:
+        order = list(reversed(command))
+        wait_for = {c.name: [] for c in command}
+        for name, depends in dependency.items():
+            for d in depends:
+                wait_for[d].append(name)
+
+    # 待ち合わせる実行は必ず先に投入されるため、スレッドが待ち続けることはない
+    future = {}
+    with ThreadPoolExecutor(max_workers=args.max_workers) as executor:
+        for c in order:
+            for host in c.hosts():
+                wait = []
+                for d in wait_for[c.name]:
+                    if (d, host) in future:
+                        wait.append(future[(d, host)])
+                future[(c.name, host)] = executor.submit(
+                        command_run_host, c, host, wait, args
+                    )
+
+    # TOML ファイルごとの実行結果
+    result = {}
+    for c in command:
+        result[c.name] = c.get_result()
+
+    return result
+
+
 def display_result(result):
     """
     コマンド実行結果を JSON 形式で表示する
@@ -107,6 +384,8 @@ def display_result(result):
 
     import json
     import fabric
+    from command import Cancelled
+    from fingerprint import Skipped
 
     data = {}
 
@@ -128,9 +407,19 @@ def display_result(result):
                 elif type(v) == fabric.transfer.Result:
                     command = "file transfer {} to {}".format(v.orig_local, v.remote)
                     status = "Success"
-                else:
+                elif type(v) == Cancelled:
+                    command = str(v)
+                    status = "Cancelled"
+                elif type(v) == Skipped:
+                    command = str(v)
+                    status = "Skipped"
+                elif hasattr(v, "result"):
                     command = v.result.command
                     status = "Failed"
+                else:
+                    # 転送するファイルの準備などに失敗した場合
+                    command = str(v)
+                    status = "Failed"
 
                 # クエリの作成
                 query = {
@@ -139,6 +428,11 @@ def display_result(result):
                     "status": status
                 }
 
+                # 出力をログファイルに書き出した場合はそのパスも表示する
+                log = getattr(v, "log", getattr(getattr(v, "result", None), "log", None))
+                if log != None:
+                    query["log"] = log
+
                 # クエリを積み込んで行く
                 data[filename].append(query)
 
@@ -160,13 +454,38 @@ def main():
     # TOML ファイルのロード
     data = load_toml(args.file)
 
+    # 転送するファイルを同時に準備する数
+    prepare.executor.set_max_workers(args.prepare_workers)
+
+    # 実行状況のイベントの出力先
+    if args.events != None:
+        event.writer.open(args.events_file)
+
+    # 処理ごと・ホストごとの実行時間と転送量の記録
+    if args.metrics_json != None or args.metrics_prom != None:
+        metrics.recorder.enable()
+
     # TOML の情報からコマンドの構築
-    command = command_generate(data)
+    command = command_generate(data, args)
 
     # 構築したコマンドの実行
     try:
+        # depends_on で依存する TOML ファイルが先に実行されるよう並び替える
+        # 依存する TOML ファイルが指定されていることは --concurrent の場合のみ確認する
+        command = command_sort(command, command_dependency(command, args.concurrent))
+
+        # 全ターゲットへの接続を先に済ませておく
+        # ワーカープロセス・asyncio で実行する場合はそれぞれが接続を作成する
+        detached = args.parallel and not args.concurrent and \
+                   (args.processes != None or args.engine == "asyncio")
+        if not args.no_prewarm and not detached:
+            command_connect(command, args)
+
         result = None
-        if args.parallel:
+        if args.concurrent:
+            # TOML ファイル・ターゲットごとの並行実行
+            result = command_run_concurrent(command, args)
+        elif args.parallel:
             # コマンドの並列実行
             result = command_run_parallel(command, args)
         else:
@@ -180,14 +499,37 @@ def main():
         # エラーを赤文字で表示する
         print("\033[31m" + str(e) + "\033[0m")
     finally:
+        # 実行中の準備を終了する
+        prepare.executor.shutdown()
+
+        # SSH 接続を閉じる
+        connection.pool.close()
+
+        # 転送に使用した成果物をキャッシュから削除できるようにする
+        artifact.release()
+
+        # 実行時間と転送量の集計結果を書き出す
+        if args.metrics_json != None:
+            metrics.recorder.write_json(args.metrics_json)
+        if args.metrics_prom != None:
+            metrics.recorder.write_prometheus(args.metrics_prom)
+
         # すぐ終了するのを防ぐためキー入力待ちにする
         if not args.no_enter:
             input("終了するにはエンターキーを入力してください")
 
+        # イベントの出力先を閉じる
+        # 終了までの出力も標準エラー出力に書き出すよう最後に閉じる
+        event.writer.close()
+
 
 if __name__ == "__main__":
     """
     このファイルが実行された場合に main 関数を実行する
     """
+    import multiprocessing
+
+    # pyinstaller でビルドした場合にワーカープロセスを起動できるようにする
+    multiprocessing.freeze_support()
     main()
 
@@ -0,0 +1,437 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+import capture
+import connection
+import event
+import fingerprint
+import metrics
+import prepare
+
+
+class Engine():
+    """
+    asyncio のイベントループ一つで全ターゲットへの接続・コマンド実行・転送を行う実行エンジン
+    ターゲットごとにスレッドを作らないため、数千台規模のターゲットに対しても使用できる
+    """
+
+    def __init__(self, max_workers=None, name=None):
+        """
+        Engine クラス コンストラクタ
+        max_workers は同時に処理するターゲットの数の上限
+        name はイベントに書き出す playbook の名前
+        """
+        self.__max_workers = max_workers
+        self.__name = name
+        self.__limit = None
+        self.__release = None
+        self.__fingerprint = None
+        self.__connection = {}  # 接続先ごとの接続処理のタスク
+        self.__executor = None  # fabric の転送やファイルの準備の待機を実行するスレッドプール
+        self.__known_hosts = None # ユーザの known_hosts
+        self.__client = None    # 未知のホスト鍵を受け入れる asyncssh のクライアント
+
+
+    def run(self, parallel_queue, hosts, connect, execute, rollback=False, failback=False,
+            limit=None, release=None, fingerprint=None):
+        """
+        parallel_queue の hosts のキューを実行し、結果をキューに書き込む
+        connect にはホストごとの fabric の接続情報を渡す
+        execute には asyncio で実行できないコマンドプールを実行する関数を渡す
+        failback が True の場合は失敗したその場でそのターゲットの rollback を実行する
+        limit には失敗したターゲットの数の上限 (FailureLimit) を渡す
+        release には失敗したターゲットのコマンドプールを受け取り、中継先に完了を通知する関数を渡す
+        fingerprint にはデプロイ済みのターゲットを飛ばし、成功したターゲットに記録する Fingerprint を渡す
+        """
+
+        self.__limit = limit
+        self.__release = release
+        self.__fingerprint = fingerprint
+        asyncio.run(self.__run(parallel_queue, hosts, connect, execute, rollback, failback))
+
+
+    async def __run(self, parallel_queue, hosts, connect, execute, rollback, failback):
+        """
+        ターゲットごとのキューを並列実行する
+        """
+
+        semaphore = None
+        if self.__max_workers != None:
+            semaphore = asyncio.Semaphore(self.__max_workers)
+
+        # relay の中継元の完了を待つスレッドなどで既定のスレッドプールを使い切らないよう、
+        # 同時に処理するターゲットの数のスレッドを持つ専用のスレッドプールを使用する
+        # 一つのターゲットが同時に使用するスレッドは一つまでのため、待機でスレッドが枯渇することはない
+        workers = self.__max_workers if self.__max_workers != None else len(hosts)
+        self.__executor = ThreadPoolExecutor(max_workers=max(workers, 1))
+
+        tasks = []
+        for host in hosts:
+            queue = parallel_queue[host]
+            tasks.append(self.__host(queue, connect[host], execute, rollback, failback, semaphore))
+
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            await self.__close()
+            self.__executor.shutdown()
+
+
+    async def __host(self, queue, connect, execute, rollback, failback, semaphore):
+        """
+        一つのターゲットのキューを逐次実行する
+        例外はスレッドで実行する場合と同じくキューの error に保存する
+        failback の場合は rollback の実行結果をキューの failback に保存する
+        """
+
+        import contextlib
+
+        if semaphore == None:
+            semaphore = contextlib.nullcontext()
+
+        async with semaphore:
+            started = False
+            try:
+                # 実行が取り消された後のターゲットは実行しない
+                if self.__limit != None:
+                    self.__limit.check()
+                # 前回と同じ内容をデプロイ済みのターゲットは実行しない
+                if not rollback and await self.__deployed(connect):
+                    print("[{}] [{}] already deployed, skipped".format(self.__name, connect.host))
+                    raise fingerprint.Skipped("already deployed")
+                started = True
+                # rollback するターゲットのフィンガープリントを最初に削除する
+                if rollback:
+                    await self.__remove_fingerprint(connect, queue["command_pool"])
+                for pool in queue["command_pool"]:
+                    # 失敗したターゲットの数が上限を超えた場合、実行中のコマンドの後で止める
+                    if self.__limit != None:
+                        self.__limit.check()
+                    queue["result"].extend(await self.__execute(connect, pool, execute, rollback))
+                if not rollback:
+                    await self.__save_fingerprint(connect)
+            except Exception as e:
+                queue["error"] = e
+                if self.__release != None:
+                    self.__release(queue["command_pool"])
+
+                # 実行していないターゲットは失敗として数えず、rollback も行わない
+                if not started:
+                    return
+                if self.__limit != None:
+                    self.__limit.fail(connect.host, e)
+
+                if failback:
+                    print("[{}] [{}] failback now...".format(self.__name, connect.host))
+                    queue["failback"] = []
+                    try:
+                        await self.__remove_fingerprint(connect, queue["command_pool"])
+                        for pool in queue["command_pool"]:
+                            if "target" in pool["type"]:
+                                queue["failback"].extend(
+                                    await self.__execute(connect, pool, execute, True))
+                    except Exception as r:
+                        queue["failback"].append(r)
+
+
+    async def __deployed(self, connect):
+        """
+        ターゲットに記録されたフィンガープリントが今回のデプロイ内容と一致するかどうかを返す
+        """
+
+        if self.__fingerprint == None or not self.__fingerprint.check:
+            return False
+
+        loop = asyncio.get_running_loop()
+        with metrics.recorder.measure("fingerprint", connect.host, self.__name):
+            recorded = await self.__run_command(connect, self.__fingerprint.read_command(), hide=True)
+        return await loop.run_in_executor(self.__executor, self.__fingerprint.deployed,
+                                          connect.host, recorded.stdout)
+
+
+    async def __save_fingerprint(self, connect):
+        """
+        全ての実行に成功したターゲットにフィンガープリントを記録する
+        記録に失敗してもターゲットの実行は失敗にしない
+        """
+
+        if self.__fingerprint == None:
+            return
+
+        loop = asyncio.get_running_loop()
+        try:
+            command = await loop.run_in_executor(self.__executor, self.__fingerprint.write_command, connect.host)
+            with metrics.recorder.measure("fingerprint", connect.host, self.__name):
+                await self.__run_command(connect, command, hide=True)
+        except Exception as e:
+            print("\033[33m[{}] [{}] failed to record fingerprint: {}\033[0m".format(
+                self.__name, connect.host, str(e).strip()))
+
+
+    async def __remove_fingerprint(self, connect, command_pool):
+        """
+        rollback するターゲットに記録したフィンガープリントを削除する
+        """
+
+        if self.__fingerprint == None:
+            return
+
+        for pool in command_pool:
+            if "target" in pool["type"] and pool["rollback"] != None:
+                await self.__run_command(connect, self.__fingerprint.remove_command(), hide=True)
+                return
+
+
+    async def __execute(self, connect, pool, execute, rollback):
+        """
+        コマンドプールの要素を一つ実行し、実行結果の一覧を返す
+        """
+
+        result = []
+
+        if "target" in pool["type"]:
+            arg = pool["rollback"] if rollback else pool["command"]
+            # コマンドが存在すれば実行する
+            if arg != None:
+                # 出力をログファイルに書き出す場合は、実行後に書き出して末尾のみを残す
+                log = pool["run"] if isinstance(pool["run"], capture.Capture) else None
+                result.append(await self.__record(pool, rollback,
+                                                  self.__run_command(connect, arg, log)))
+
+        elif "file" in pool["type"]:
+            result.append(await self.__record(pool, rollback,
+                                              self.__put_file(connect, pool)))
+
+        else:
+            # sync・stream・archive・relay は fabric の実装をスレッドで実行する
+            loop = asyncio.get_running_loop()
+            result.extend(await loop.run_in_executor(self.__executor, functools.partial(execute, pool)))
+
+        return result
+
+
+    async def __record(self, pool, rollback, coroutine):
+        """
+        coroutine を実行し、開始・終了・失敗のイベントを書き出す
+        実行時間と転送量を記録する
+        """
+
+        import time
+
+        info = {
+            "playbook": self.__name,
+            "host": pool["target"],
+            "step": "rollback" if rollback else pool["type"],
+            "command": event.describe(pool, rollback)
+        }
+
+        event.writer.emit("started", **info)
+        start = time.monotonic()
+        try:
+            result = await coroutine
+        except Exception as e:
+            duration = time.monotonic() - start
+            metrics.recorder.record(metrics.phase(info["step"]), info["host"], duration,
+                                    playbook=self.__name)
+            event.writer.emit("failed",
+                              duration=duration,
+                              exited=event.status(e),
+                              error=str(e).strip(),
+                              **info)
+            raise e
+
+        duration = time.monotonic() - start
+        size = event.transferred([result])
+        metrics.recorder.record(metrics.phase(info["step"]), info["host"], duration, size,
+                                playbook=self.__name)
+        event.writer.emit("finished",
+                          duration=duration,
+                          bytes=size,
+                          **info)
+
+        return result
+
+
+    async def __put_file(self, connect, pool):
+        """
+        バックグラウンドで準備しているファイルの完了を待ってから転送する
+        """
+
+        loop = asyncio.get_running_loop()
+        local = await loop.run_in_executor(self.__executor, prepare.resolve, pool["local"])
+        return await self.__put(connect, local, pool["remote"])
+
+
+    async def __run_command(self, connect, command, log=None, hide=False):
+        """
+        ターゲットでコマンドを実行する
+        実行結果は fabric と同じ Result として返し、失敗した場合は UnexpectedExit を送出する
+        log が指定された場合は出力をログファイルに書き出し、実行結果には末尾のみを残す
+        hide が True の場合は出力を表示しない
+        """
+
+        import fabric
+        import invoke
+
+        conn = await self.__connect(connect)
+        # fabric と同じく pty を割り当てて実行する
+        r = await conn.run(command, term_type="xterm", check=False)
+
+        stdout = r.stdout if r.stdout != None else ""
+        stderr = r.stderr if r.stderr != None else ""
+        # 出力をログファイルに書き出す場合は表示しない
+        if stdout != "" and not hide and log == None:
+            print(stdout, end="" if stdout.endswith("\n") else "\n")
+
+        exited = r.exit_status
+        if exited == None:
+            exited = -1
+
+        result = fabric.runners.Result(connection=connect,
+                                       command=command,
+                                       stdout=stdout,
+                                       stderr=stderr,
+                                       exited=exited,
+                                       pty=True
+                                      )
+        if log != None:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self.__executor, log.spill, result)
+
+        if exited != 0:
+            raise invoke.exceptions.UnexpectedExit(result)
+
+        return result
+
+
+    async def __put(self, connect, local_path, remote_path):
+        """
+        SFTP でターゲットにファイルを転送する
+        実行結果は fabric と同じ transfer.Result として返す
+        """
+
+        import fabric.transfer
+
+        conn = await self.__connect(connect)
+        async with conn.start_sftp_client() as sftp:
+            await sftp.put(local_path, remote_path)
+
+        return fabric.transfer.Result(orig_remote=remote_path,
+                                      remote=remote_path,
+                                      orig_local=local_path,
+                                      local=local_path,
+                                      connection=connect
+                                     )
+
+
+    async def __connect(self, connect, phase="connect"):
+        """
+        fabric の接続情報から asyncssh の接続を作成する
+        同じ接続先への接続は共有し、踏み台を経由する場合は踏み台から順番に接続する
+        phase には接続にかかった時間を記録する処理の名前を渡す
+        """
+
+        key = connection.pool.key(connect.host, connect.port, connect.user, connect.gateway)
+
+        if not key in self.__connection:
+            self.__connection[key] = asyncio.ensure_future(self.__open(connect, phase))
+
+        return await self.__connection[key]
+
+
+    async def __open(self, connect, phase):
+        """
+        asyncssh で接続を開く
+        """
+
+        try:
+            import asyncssh
+        except ImportError as e:
+            import sys
+            print("Please install asyncssh.", file=sys.stderr)
+            exit(code=1)
+
+        tunnel = None
+        if connect.gateway != None:
+            tunnel = await self.__connect(connect.gateway, "proxy")
+
+        auth = connection.pool.auth(connect)
+
+        options = {}
+        if auth["key"] != None:
+            # 鍵認証の場合、パスワードは鍵のパスワードとして使用する
+            # 同じ鍵ファイルは一度だけ読み込む
+            pkey = connection.pool.load_key(auth["key"], auth["password"], "asyncssh")
+            if pkey == None:
+                raise ValueError("cannot load the private key: {}".format(auth["key"]))
+            options["client_keys"] = [pkey]
+            options["password"] = None
+        else:
+            options["client_keys"] = None
+            options["password"] = auth["password"]
+
+        # SSH の通信路を圧縮する
+        if connect.connect_kwargs.get("compress", False):
+            options["compression_algs"] = ["zlib@openssh.com", "zlib", "none"]
+
+        # fabric と同じく known_hosts に登録されたホストは鍵を検証し、未知のホスト鍵は受け入れる
+        if self.__known_hosts == None:
+            self.__known_hosts = known_hosts()
+            self.__client = client(self.__known_hosts)
+
+        with metrics.recorder.measure(phase, connect.host, self.__name):
+            return await asyncssh.connect(connect.host,
+                                          port=int(connect.port),
+                                          username=connect.user,
+                                          known_hosts=self.__known_hosts,
+                                          client_factory=self.__client,
+                                          tunnel=tunnel,
+                                          **options
+                                         )
+
+
+    async def __close(self):
+        """
+        作成した全ての接続を閉じる
+        """
+
+        for task in self.__connection.values():
+            try:
+                conn = await task
+                conn.close()
+                await conn.wait_closed()
+            except Exception:
+                pass
+
+        self.__connection.clear()
+
+
+def known_hosts():
+    """
+    ユーザの known_hosts を asyncssh で読み込む
+    known_hosts がない場合は空の known_hosts を返す
+    """
+
+    import asyncssh
+
+    path = os.path.expanduser("~/.ssh/known_hosts")
+    if os.path.isfile(path):
+        return asyncssh.read_known_hosts(path)
+    return asyncssh.import_known_hosts("")
+
+
+def client(known):
+    """
+    known に登録されていないホストの鍵を受け入れる asyncssh のクライアントを返す
+    登録されているホストの鍵と異なる場合は接続しない (paramiko の AutoAddPolicy と同じ動作)
+    """
+
+    import asyncssh
+
+    class Client(asyncssh.SSHClient):
+        def validate_host_public_key(self, host, addr, port, key):
+            trusted, ca, revoked = known.match(host, addr, port)[:3]
+            return len(trusted) == 0 and len(ca) == 0
+
+    return Client
@@ -0,0 +1,138 @@
+import datetime
+import json
+import os
+import sys
+import threading
+
+
+class EventWriter():
+    """
+    ホスト・ステップごとの実行状況を JSON Lines 形式で逐次書き出すクラス
+    出力先が開かれていない場合は何もしない
+    """
+
+    def __init__(self):
+        """
+        EventWriter クラス コンストラクタ
+        """
+        self.__stream = None
+        self.__close = False
+        self.__stdout = None   # イベントを標準出力に書き出す場合の元の標準出力
+        self.__lock = threading.Lock()
+
+
+    def open(self, path=None):
+        """
+        イベントの出力先を開く
+        path が指定されない場合は標準出力に書き出し、指定された場合はファイルに追記する
+        標準出力に書き出す場合、イベントだけを読み込めるよう、それ以外の出力は標準エラー出力に切り替える
+        """
+
+        with self.__lock:
+            if path == None:
+                self.__stream = sys.stdout
+                self.__close = False
+                self.__stdout = sys.stdout
+                sys.stdout = sys.stderr
+            else:
+                self.__stream = open(path, "a", encoding="utf-8")
+                self.__close = True
+
+
+    def enabled(self):
+        """
+        イベントを書き出すかどうかを返す
+        """
+        return self.__stream != None
+
+
+    def emit(self, event, **fields):
+        """
+        イベントを一行の JSON として書き出す
+        """
+
+        if self.__stream == None:
+            return
+
+        data = {
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "event": event
+        }
+        data.update(fields)
+        line = json.dumps(data, ensure_ascii=False, default=str)
+
+        with self.__lock:
+            if self.__stream != None:
+                self.__stream.write(line + "\n")
+                self.__stream.flush()
+
+
+    def close(self):
+        """
+        イベントの出力先を閉じる
+        """
+
+        with self.__lock:
+            if self.__close:
+                self.__stream.close()
+            if self.__stdout != None:
+                sys.stdout = self.__stdout
+            self.__stream = None
+            self.__close = False
+            self.__stdout = None
+
+
+def describe(pool, rollback=False):
+    """
+    コマンドプールの要素を表す文字列を返す
+    """
+
+    if "target" in pool["type"]:
+        if rollback:
+            return pool["rollback"]
+        return pool["command"]
+
+    if "cleanup" in pool["type"]:
+        return "cleanup {}".format(pool["remote"])
+
+    local = pool["local"]
+    if not isinstance(local, (str, os.PathLike)):
+        # ファイル一覧や準備中の Future の場合は転送先のみを表示する
+        return "{} to {}".format(pool["type"], pool["remote"])
+
+    return "{} {} to {}".format(pool["type"], local, pool["remote"])
+
+
+def transferred(results):
+    """
+    実行結果の一覧から転送したファイルの合計サイズ (bytes) を返す
+    stream・incremental・relay のようにチャネルに直接書き込んだ実行結果は、その転送量 (transferred) を使用する
+    """
+
+    import fabric.transfer
+
+    size = 0
+    for r in results:
+        if type(r) == fabric.transfer.Result:
+            try:
+                size += os.path.getsize(r.local)
+            except (OSError, TypeError):
+                pass
+        else:
+            size += getattr(r, "transferred", 0)
+
+    return size
+
+
+def status(e):
+    """
+    例外から終了コードを取り出す
+    終了コードがない場合は None を返す
+    """
+
+    result = getattr(e, "result", None)
+    return getattr(result, "exited", None)
+
+
+# プロセス全体で共有するイベントの出力先
+writer = EventWriter()
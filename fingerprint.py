@@ -0,0 +1,187 @@
+from pathlib import Path
+import functools
+import hashlib
+import json
+import shlex
+import threading
+import artifact
+import prepare
+
+
+# フィンガープリントを記録する送信先のディレクトリ (ログインユーザのホームディレクトリからの相対パス)
+MARKER_DIR = ".dolphin-fingerprint"
+
+
+class Skipped(Exception):
+    """
+    前回と同じ内容をデプロイ済みのため実行しなかったターゲットの実行結果
+    """
+    pass
+
+
+class Fingerprint():
+    """
+    TOML ファイルのターゲットごとのデプロイ内容を表すハッシュ値
+    file・repo の指定、転送するファイルのキー、repo のコミット、ターゲットの command・rollback から計算し、
+    全ての実行に成功したターゲットに記録する
+    """
+
+    def __init__(self, name, force=False, prefetch=True, content=False):
+        """
+        Fingerprint クラス コンストラクタ
+        force が True の場合はハッシュ値を計算せず、デプロイ済みかどうかの確認と記録を行わない
+        prefetch が True の場合は転送するファイルのキーをバックグラウンドで先に計算する
+        content が True の場合は成果物のキャッシュと同様にファイルの中身もキーに含める
+        """
+        self.check = not force
+        self.prefetch = prefetch and self.check
+        self.content = content
+        self.path = "{}/{}".format(MARKER_DIR, marker(name))
+        self.__sources = []    # file・repo の指定と中身を表す値
+        self.__targets = {}    # ホストごとの (command, rollback)
+        self.__common = None   # 全ターゲットに共通する部分のハッシュ値
+        self.__value = {}      # (command, rollback) ごとのハッシュ値
+        self.__preset = {}     # 親プロセスで計算したホストごとのハッシュ値
+        self.__lock = threading.Lock()
+
+
+    def add_file(self, entry):
+        """
+        file の指定を追加する
+        ファイルのキーは成果物のキャッシュと同じくパス・サイズ・更新日時・パーミッションから作成し、
+        prefetch の場合はバックグラウンドで、それ以外の場合は必要になった時に計算する
+        """
+
+        content = functools.partial(artifact.fingerprint, entry["path"], "fingerprint", self.content)
+        if self.prefetch:
+            content = prepare.executor.submit("fingerprint " + str(entry["path"]), content)
+        self.__sources.append(("file", entry, content))
+
+
+    def add_repo(self, entry, cloned, local_path):
+        """
+        repo の指定を追加する
+        cloned には local_path に clone している Future を渡し、取り出したコミットを使用する
+        """
+
+        self.__sources.append(("repo", entry, functools.partial(commit, cloned, local_path)))
+
+
+    def add_target(self, host, command, rollback):
+        """
+        ターゲットの command・rollback を追加する
+        """
+
+        self.__targets[host] = (command, rollback)
+
+
+    def preset(self, values):
+        """
+        プロセスプールのワーカーで、親プロセスで計算したホストごとのフィンガープリントを設定する
+        設定したホストでは file・repo のキーを計算しない
+        """
+
+        self.__preset.update(values)
+
+
+    def value(self, host):
+        """
+        ターゲットのフィンガープリントを返す
+        転送するファイルの準備が終わっていない場合は完了を待つ
+        """
+
+        if host in self.__preset:
+            return self.__preset[host]
+
+        command, rollback = self.__targets.get(host, (None, None))
+        key = (id(command), id(rollback))
+
+        with self.__lock:
+            if self.__common == None:
+                self.__common = self.__digest_sources()
+
+            if not key in self.__value:
+                h = hashlib.sha256(self.__common.encode())
+                h.update(json.dumps([command, rollback]).encode())
+                self.__value[key] = h.hexdigest()
+
+            return self.__value[key]
+
+
+    def deployed(self, host, recorded):
+        """
+        ターゲットに記録されていた値がフィンガープリントと一致するかどうかを返す
+        記録がない場合は転送するファイルの準備を待たずに False を返す
+        """
+
+        if not self.check or len(recorded.strip()) <= 0:
+            return False
+
+        return recorded.strip() == self.value(host)
+
+
+    def read_command(self):
+        """
+        ターゲットに記録したフィンガープリントを読み込むコマンドを返す
+        """
+
+        return "cat {} 2>/dev/null || true".format(shlex.quote(self.path))
+
+
+    def write_command(self, host):
+        """
+        ターゲットにフィンガープリントを記録するコマンドを返す
+        force の場合は古い記録で省略されないよう、記録を削除するコマンドを返す
+        """
+
+        if not self.check:
+            return self.remove_command()
+
+        return "mkdir -p {} && echo {} > {}".format(shlex.quote(MARKER_DIR),
+                                                    self.value(host),
+                                                    shlex.quote(self.path))
+
+
+    def remove_command(self):
+        """
+        ターゲットに記録したフィンガープリントを削除するコマンドを返す
+        """
+
+        return "rm -f {}".format(shlex.quote(self.path))
+
+
+    def __digest_sources(self):
+        """
+        file・repo の指定と中身から全ターゲットに共通する部分のハッシュ値を計算する
+        """
+
+        h = hashlib.sha256()
+        for kind, entry, content in self.__sources:
+            if callable(content):
+                value = content()
+            else:
+                value = prepare.resolve(content)
+            h.update(json.dumps([kind, entry, value], sort_keys=True, default=str).encode())
+
+        return h.hexdigest()
+
+
+def marker(name):
+    """
+    TOML ファイルの記録を保存するファイル名を返す
+    別のディレクトリにある同じ名前の TOML ファイルと区別するため、パスのハッシュ値を付ける
+    """
+
+    path = str(Path(name).resolve())
+    return "{}-{}".format(Path(name).stem, hashlib.sha256(path.encode()).hexdigest()[:12])
+
+
+def commit(cloned, local_path):
+    """
+    clone の完了を待ち、取り出したコミットを返す
+    """
+
+    from git import Repo
+
+    prepare.resolve(cloned)
+    return Repo(local_path).head.commit.hexsha
@@ -0,0 +1,142 @@
+import re
+from pathlib import Path
+
+
+# ホストの範囲指定 web[001-500].dc1・db[1:3]・app[a,b]
+RANGE = re.compile(r"\[([^\[\]]+)\]")
+
+# 範囲指定の一つの要素 001-500・1:3・a-c
+SPAN = re.compile(r"^(\d+|[a-zA-Z])[-:](\d+|[a-zA-Z])$")
+
+# ターゲットに設定できる項目のうち、ホストごとに異なるもの
+HOST_KEYS = ["host", "group"]
+
+
+def expand(pattern):
+    """
+    ホストの範囲指定を展開し、ホスト名を順番に返すジェネレーター
+    web[001-500].dc1 は web001.dc1 から web500.dc1 まで、app[a,b] は appa・appb になる
+    範囲指定が複数ある場合は全ての組み合わせを返す
+    """
+
+    match = RANGE.search(pattern)
+    if match == None:
+        yield pattern
+        return
+
+    head = pattern[:match.start()]
+    tail = pattern[match.end():]
+    for value in values(match.group(1)):
+        for rest in expand(tail):
+            yield head + value + rest
+
+
+def values(spec):
+    """
+    範囲指定の括弧の中身を展開し、値を順番に返すジェネレーター
+    数値の範囲は開始の桁数で 0 埋めする
+    """
+
+    for part in spec.split(","):
+        part = part.strip()
+        match = SPAN.match(part)
+        if match == None:
+            if len(part) <= 0:
+                raise ValueError("invalid host range [{}]".format(spec))
+            yield part
+            continue
+
+        start, end = match.group(1), match.group(2)
+        if start.isdigit() and end.isdigit():
+            # 001-500 のように 0 から始まる場合は桁数を揃える
+            width = len(start) if start.startswith("0") else 0
+            for number in range(int(start), int(end) + 1):
+                yield str(number).zfill(width)
+        elif start.isalpha() and end.isalpha():
+            for code in range(ord(start), ord(end) + 1):
+                yield chr(code)
+        else:
+            raise ValueError("invalid host range [{}]".format(spec))
+
+
+def load(path):
+    """
+    インベントリファイルを読み込み、target・group・defaults を持つ dict を返す
+    拡張子が .toml の場合は TOML ファイルとして、それ以外は 1 行に 1 ホストのテキストとして読み込む
+    テキストの [name] の行から下のホストは name のグループに属し、グループは設定を持たずに定義される
+    ホストの後に port=2222 のように設定を書くことができる
+    """
+
+    if Path(path).suffix == ".toml":
+        import toml
+
+        with open(path, "r", encoding="utf-8") as f:
+            return toml.load(f)
+
+    targets = []
+    groups = {}
+    group = None
+    with open(path, "r", encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            # コメント・空行は読み飛ばす
+            line = line.split("#")[0].strip()
+            if len(line) <= 0:
+                continue
+
+            # グループの開始
+            if RANGE.fullmatch(line):
+                group = line[1:-1].strip()
+                groups.setdefault(group, {})
+                continue
+
+            fields = line.split()
+            target = {"host": fields[0]}
+            if group != None:
+                target["group"] = group
+            for field in fields[1:]:
+                if not "=" in field:
+                    raise ValueError("{}:{}: invalid setting {}".format(path, number, field))
+                key, value = field.split("=", 1)
+                target[key] = value
+            targets.append(target)
+
+    return {"target": targets, "group": groups}
+
+
+def targets(data, base="."):
+    """
+    TOML ファイルのデータからターゲットを (ホスト名, 設定) の組で順番に返すジェネレーター
+    設定は defaults・group・target の順に上書きしたもので、同じ target から展開したホストでは
+    同じ dict を共有する
+    inventory に指定されたファイルは base からの相対パスで読み込み、TOML ファイルの target の後に並べる
+    """
+
+    defaults = data.get("defaults", {})
+    groups = dict(data.get("group", {}))
+    entries = list(data.get("target", []))
+
+    # インベントリファイルのターゲットを追加する
+    # グループの設定は TOML ファイルのものを優先する
+    inventories = data.get("inventory", [])
+    if isinstance(inventories, str):
+        inventories = [inventories]
+    for inventory in inventories:
+        loaded = load(Path(base) / Path(inventory).expanduser())
+        for name, group in loaded.get("group", {}).items():
+            groups.setdefault(name, group)
+        defaults = dict(loaded.get("defaults", {}), **defaults)
+        entries.extend(loaded.get("target", []))
+
+    for entry in entries:
+        settings = dict(defaults)
+        if "group" in entry:
+            name = entry["group"]
+            if not name in groups:
+                raise ValueError("group {} is not defined".format(name))
+            settings.update(groups[name])
+        for key, value in entry.items():
+            if not key in HOST_KEYS:
+                settings[key] = value
+
+        for host in expand(entry["host"]):
+            yield host, settings
@@ -0,0 +1,248 @@
+import contextlib
+import json
+import math
+import os
+import threading
+import time
+
+
+# ホストに紐付かないローカルの処理を集計するホスト名
+LOCAL = "local"
+
+# TOML ファイル全体の実行として集計する処理
+RUNS = ["run", "parallel_run", "failback", "rollback", "parallel_rollback"]
+
+
+class Metrics():
+    """
+    処理ごと・ホストごとの実行時間と転送量を記録し、集計結果を書き出すクラス
+    有効にされていない場合は何も記録しない
+    """
+
+    def __init__(self):
+        """
+        Metrics クラス コンストラクタ
+        """
+        self.__enabled = False
+        self.__samples = []
+        self.__lock = threading.Lock()
+
+
+    def enable(self):
+        """
+        記録を有効にする
+        """
+        self.__enabled = True
+
+
+    def enabled(self):
+        """
+        記録が有効かどうかを返す
+        """
+        return self.__enabled
+
+
+    def record(self, phase, host, duration, size=0, playbook=None):
+        """
+        一回の処理の実行時間(秒)と転送量(bytes)を記録する
+        host が None の場合はローカルの処理として記録する
+        """
+
+        if not self.__enabled:
+            return
+
+        sample = {
+            "phase": phase,
+            "host": host if host != None else LOCAL,
+            "duration": duration,
+            "bytes": size,
+            "playbook": playbook
+        }
+
+        with self.__lock:
+            self.__samples.append(sample)
+
+
+    @contextlib.contextmanager
+    def measure(self, phase, host, playbook=None):
+        """
+        with 文の中の処理の実行時間を記録する
+        例外が発生した場合も記録する
+        """
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(phase, host, time.monotonic() - start, playbook=playbook)
+
+
+    def samples(self):
+        """
+        記録した内容の一覧を返す
+        """
+
+        with self.__lock:
+            return list(self.__samples)
+
+
+    def extend(self, samples):
+        """
+        ワーカープロセスで記録した内容を追加する
+        """
+
+        if not self.__enabled:
+            return
+
+        with self.__lock:
+            self.__samples.extend(samples)
+
+
+    def summary(self):
+        """
+        記録した内容を処理ごと・ホストごとに集計した辞書を返す
+        処理ごとの集計にはホストごとの合計時間の p50・p95・最大値を含む
+        """
+
+        hosts = {}
+        runs = {}
+        for sample in self.samples():
+            phase = sample["phase"]
+            if sample["host"] == LOCAL and phase in RUNS:
+                # TOML ファイルごとの全体の実行時間
+                data = runs.setdefault(sample["playbook"], {})
+                data[phase] = data.get(phase, 0) + sample["duration"]
+                continue
+
+            data = hosts.setdefault(sample["host"], {}).setdefault(phase, {
+                "count": 0,
+                "duration": 0,
+                "bytes": 0
+            })
+            data["count"] += 1
+            data["duration"] += sample["duration"]
+            data["bytes"] += sample["bytes"]
+
+        phases = {}
+        for host, host_phases in hosts.items():
+            for phase, data in host_phases.items():
+                if data["bytes"] > 0 and data["duration"] > 0:
+                    data["throughput"] = data["bytes"] / data["duration"]
+                phases.setdefault(phase, []).append((data["duration"], data["bytes"], host))
+
+        result = {}
+        for phase, values in phases.items():
+            durations = sorted(v[0] for v in values)
+            slowest = max(values, key=lambda v: v[0])
+            result[phase] = {
+                "hosts": len(values),
+                "bytes": sum(v[1] for v in values),
+                "p50": percentile(durations, 50),
+                "p95": percentile(durations, 95),
+                "max": durations[-1],
+                "slowest": slowest[2]
+            }
+
+        return {
+            "runs": runs,
+            "phases": result,
+            "hosts": hosts
+        }
+
+
+    def write_json(self, path):
+        """
+        集計結果を JSON 形式でファイルに書き出す
+        """
+
+        write(path, json.dumps(self.summary(), indent=4, separators=(',', ': ')) + "\n")
+
+
+    def write_prometheus(self, path):
+        """
+        集計結果を Prometheus の textfile collector の形式でファイルに書き出す
+        """
+
+        summary = self.summary()
+        lines = []
+
+        lines.append("# HELP dolphin_run_duration_seconds Duration of each playbook run.")
+        lines.append("# TYPE dolphin_run_duration_seconds gauge")
+        for playbook, modes in sorted(summary["runs"].items()):
+            for mode, duration in sorted(modes.items()):
+                lines.append('dolphin_run_duration_seconds{{playbook="{}",mode="{}"}} {}'.format(
+                    label(playbook), mode, duration))
+
+        lines.append("# HELP dolphin_phase_duration_seconds Duration of each phase across hosts.")
+        lines.append("# TYPE dolphin_phase_duration_seconds gauge")
+        for phase, data in sorted(summary["phases"].items()):
+            for stat in ["p50", "p95", "max"]:
+                lines.append('dolphin_phase_duration_seconds{{phase="{}",stat="{}"}} {}'.format(
+                    label(phase), stat, data[stat]))
+
+        lines.append("# HELP dolphin_phase_bytes Bytes transferred in each phase across hosts.")
+        lines.append("# TYPE dolphin_phase_bytes gauge")
+        for phase, data in sorted(summary["phases"].items()):
+            lines.append('dolphin_phase_bytes{{phase="{}"}} {}'.format(label(phase), data["bytes"]))
+
+        lines.append("# HELP dolphin_host_duration_seconds Duration of each phase per host.")
+        lines.append("# TYPE dolphin_host_duration_seconds gauge")
+        for host, host_phases in sorted(summary["hosts"].items()):
+            for phase, data in sorted(host_phases.items()):
+                lines.append('dolphin_host_duration_seconds{{host="{}",phase="{}"}} {}'.format(
+                    label(host), label(phase), data["duration"]))
+
+        lines.append("# HELP dolphin_host_bytes Bytes transferred in each phase per host.")
+        lines.append("# TYPE dolphin_host_bytes gauge")
+        for host, host_phases in sorted(summary["hosts"].items()):
+            for phase, data in sorted(host_phases.items()):
+                lines.append('dolphin_host_bytes{{host="{}",phase="{}"}} {}'.format(
+                    label(host), label(phase), data["bytes"]))
+
+        write(path, "\n".join(lines) + "\n")
+
+
+def phase(step):
+    """
+    コマンドプールの要素の種類を記録する処理の名前に変換する
+    """
+
+    if step == "target":
+        return "command"
+
+    return step
+
+
+def percentile(values, p):
+    """
+    昇順に並んだ値の p パーセンタイルを最近傍法で返す
+    """
+
+    if len(values) <= 0:
+        return None
+
+    index = max(math.ceil(p / 100 * len(values)) - 1, 0)
+    return values[index]
+
+
+def label(value):
+    """
+    Prometheus のラベルの値をエスケープする
+    """
+
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def write(path, text):
+    """
+    書き込み途中のファイルが読まれないよう、一時ファイルに書き込んでから置き換える
+    """
+
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+# プロセス全体で共有する記録先
+recorder = Metrics()
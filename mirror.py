@@ -0,0 +1,105 @@
+from pathlib import Path
+import contextlib
+import hashlib
+import threading
+
+
+# ミラーを保存するデフォルトのディレクトリ
+CACHE_DIR = Path.home() / ".cache" / "dolphin" / "repos"
+
+# ミラーごとの更新用のロック
+lock = {}
+lock_guard = threading.Lock()
+
+# このプロセスで更新済みのミラー
+updated = set()
+
+
+def path(cache_dir, url):
+    """
+    リポジトリの URL に対応するミラーのパスを返す
+    """
+
+    name = Path(url.rstrip("/")).name
+    if name.endswith(".git"):
+        name = name[:-len(".git")]
+    digest = hashlib.sha256(url.encode()).hexdigest()[:16]
+
+    return Path(cache_dir).expanduser() / "{}-{}.git".format(name, digest)
+
+
+@contextlib.contextmanager
+def file_lock(mirror):
+    """
+    複数のプロセスから同じミラーを同時に更新しないようロックを取る
+    fcntl が使えない環境ではプロセス内のロックのみを使用する
+    """
+
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+
+    with open(str(mirror) + ".lock", "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def update(cache_dir, url):
+    """
+    リポジトリのミラーを作成、または差分のみを取得して更新し、ミラーのパスを返す
+    同じリポジトリの更新は一回の実行につき一度だけ行う
+    """
+
+    from git import Repo
+
+    mirror = path(cache_dir, url)
+
+    with lock_guard:
+        l = lock.setdefault(str(mirror), threading.Lock())
+
+    with l:
+        if str(mirror) in updated:
+            return mirror
+
+        mirror.parent.mkdir(parents=True, exist_ok=True)
+        with file_lock(mirror):
+            if (mirror / "HEAD").exists():
+                # 既にミラーがあれば差分のみ取得する
+                Repo(str(mirror)).git.fetch("--prune", "origin")
+            else:
+                Repo.clone_from(url, str(mirror), mirror=True)
+
+        updated.add(str(mirror))
+
+    return mirror
+
+
+def checkout(mirror, url, local_path, branch, commit=None):
+    """
+    ミラーから指定されたブランチ・コミットの作業ツリーを浅く取り出す
+    取り出したリポジトリの origin は元のリポジトリの URL にする
+    """
+
+    from git import Repo
+
+    source = Path(mirror).resolve().as_uri()
+
+    if commit == None:
+        cloned = Repo.clone_from(source, local_path, depth=1, branch=branch)
+        cloned.remote("origin").set_url(url)
+        return cloned
+
+    # 短縮されたハッシュ値・タグなどをコミットのハッシュ値に変換する
+    sha = Repo(str(mirror)).git.rev_parse(commit + "^{commit}")
+
+    cloned = Repo.init(local_path)
+    cloned.git.fetch("--depth", "1", source, sha)
+    cloned.git.checkout("--detach", "FETCH_HEAD")
+    cloned.create_remote("origin", url)
+
+    return cloned
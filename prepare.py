@@ -0,0 +1,105 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import os
+import threading
+import time
+import metrics
+
+
+class Prepare():
+    """
+    clone・アーカイブ作成などの転送するファイルの準備をバックグラウンドで行う実行器
+    準備の結果は Future で返し、転送する時に完了を待つ
+    """
+
+    def __init__(self, max_workers=None):
+        """
+        Prepare クラス コンストラクタ
+        """
+        self.__executor = None
+        self.__max_workers = max_workers
+        self.__lock = threading.Lock()
+
+
+    def set_max_workers(self, max_workers):
+        """
+        同時に準備する数の上限を設定する
+        実行器を作成する前に呼び出す必要がある
+        """
+
+        with self.__lock:
+            self.__max_workers = max_workers
+
+
+    def submit(self, name, fn, *args, **kwargs):
+        """
+        準備の処理をバックグラウンドで実行し Future を返す
+        name には進捗の表示に使用する成果物の名前を渡す
+        name が None の場合は進捗を表示しない
+        実行器は最初に使用する時に作成する
+        """
+
+        with self.__lock:
+            if self.__executor == None:
+                self.__executor = ThreadPoolExecutor(max_workers=self.__max_workers,
+                                                     thread_name_prefix="prepare")
+
+        if name == None:
+            return self.__executor.submit(fn, *args, **kwargs)
+
+        return self.__executor.submit(report, name, fn, *args, **kwargs)
+
+
+    def shutdown(self):
+        """
+        実行中の準備の完了を待ち、実行器を終了する
+        """
+
+        with self.__lock:
+            executor = self.__executor
+            self.__executor = None
+
+        if executor != None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def report(name, fn, *args, **kwargs):
+    """
+    準備の処理を実行し、かかった時間を表示する
+    結果がファイルのパスの場合はそのサイズも表示する
+    """
+
+    print("[prepare] {}: started".format(name))
+    start = time.monotonic()
+    try:
+        result = fn(*args, **kwargs)
+    except Exception as e:
+        print("\033[31m[prepare] {}: failed after {:.2f}s: {}\033[0m".format(
+            name, time.monotonic() - start, e))
+        raise e
+
+    elapsed = time.monotonic() - start
+    if isinstance(result, str) and os.path.isfile(result):
+        size = os.path.getsize(result)
+        metrics.recorder.record("prepare", None, elapsed, size)
+        print("[prepare] {}: done in {:.2f}s ({:.1f} MiB)".format(name, elapsed, size / 1024 / 1024))
+    else:
+        metrics.recorder.record("prepare", None, elapsed)
+        print("[prepare] {}: done in {:.2f}s".format(name, elapsed))
+
+    return result
+
+
+def resolve(value):
+    """
+    Future の場合は準備の完了を待って結果を返す
+    それ以外の場合はそのまま返す
+    """
+
+    if isinstance(value, Future):
+        return value.result()
+
+    return value
+
+
+# プロセス全体で共有する準備の実行器
+executor = Prepare()
@@ -0,0 +1,123 @@
+import codecs
+import re
+import threading
+import uuid
+
+
+class Session():
+    """
+    ターゲットごとに一つのリモートシェルを開き続け、コマンドを順番に実行するセッション
+    コマンドごとにチャンネル・pty・シェルを作成しないため、短いコマンドが多い場合に速くなる
+    cd や変数などのシェルの状態は次のコマンドに引き継がれる
+    """
+
+    def __init__(self, connect):
+        """
+        Session クラス コンストラクタ
+        """
+        self.__connect = connect
+        self.__channel = None
+        self.__buffer = ""
+        self.__decoder = None
+        self.__lock = threading.Lock()
+        # コマンドの終了を判別するための文字列
+        self.__marker = "__DOLPHIN_{}__".format(uuid.uuid4().hex)
+        self.__pattern = re.compile(r"\r?\n{} (\d+)\r?\n".format(self.__marker))
+
+
+    def run(self, command, **kwargs):
+        """
+        セッションのシェルでコマンドを実行する
+        connect.run と同じく実行結果を Result で返し、失敗した場合は UnexpectedExit を送出する
+        out_stream が指定された場合は出力を標準出力の代わりにそちらに書き出す
+        """
+
+        import fabric
+        import invoke
+
+        with self.__lock:
+            if self.__channel == None:
+                self.__open()
+
+            self.__send(command)
+            stdout, exited = self.__receive()
+
+        out_stream = kwargs.get("out_stream", None)
+        if stdout != "":
+            print(stdout, end="" if stdout.endswith("\n") else "\n", file=out_stream)
+
+        result = fabric.runners.Result(connection=self.__connect,
+                                       command=command,
+                                       stdout=stdout,
+                                       stderr="",
+                                       exited=exited,
+                                       pty=True
+                                      )
+        if exited != 0:
+            raise invoke.exceptions.UnexpectedExit(result)
+
+        return result
+
+
+    def close(self):
+        """
+        セッションのシェルを終了する
+        """
+
+        with self.__lock:
+            if self.__channel != None:
+                try:
+                    self.__channel.close()
+                except Exception:
+                    pass
+            self.__channel = None
+            self.__buffer = ""
+
+
+    def __open(self):
+        """
+        pty を割り当ててログインシェルを起動する
+        プロンプトと入力のエコーを無効にし、準備ができるまでの出力は読み捨てる
+        """
+
+        self.__channel = self.__connect.create_session()
+        self.__channel.get_pty()
+        self.__channel.invoke_shell()
+        self.__buffer = ""
+        self.__decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+        self.__send("stty -echo 2>/dev/null; PS1=''; PS2=''; unset PROMPT_COMMAND")
+        self.__receive()
+
+
+    def __send(self, command):
+        """
+        コマンドと終了コードを出力するコマンドをシェルに送る
+        """
+
+        line = "{}\nprintf '\\n%s %s\\n' '{}' \"$?\"\n".format(command, self.__marker)
+        self.__channel.sendall(line.encode())
+
+
+    def __receive(self):
+        """
+        終了コードが出力されるまで読み込み、出力と終了コードを返す
+        """
+
+        while True:
+            match = self.__pattern.search(self.__buffer)
+            if match != None:
+                stdout = self.__buffer[:match.start()]
+                self.__buffer = self.__buffer[match.end():]
+                return stdout.replace("\r\n", "\n"), int(match.group(1))
+
+            data = self.__channel.recv(32768)
+            if not data:
+                # exit などでシェルが終了した場合は次のコマンドで開き直す
+                stdout = self.__buffer.replace("\r\n", "\n")
+                exited = self.__channel.recv_exit_status()
+                self.__channel = None
+                self.__buffer = ""
+                return stdout, exited
+
+            self.__buffer += self.__decoder.decode(data)